@@ -6,7 +6,9 @@ from injectable import inject
 from hddmondtools.hddmanager import ListModel
 from hddmondtools.websocket import WebsocketServer
 from hddmondtools.hddmon_dataclasses import ImageData
+from hddmondtools.delta import DeltaPublisher
 from hddmontools.image import ImageManager
+from hddmontools.config_service import ConfigService
 
 class App:
     def __init__(self):
@@ -14,13 +16,28 @@ class App:
         self.logger.setLevel(logging.DEBUG)
         self.logger.info("Initializing application...")
         self.images = inject(ImageManager)
-        self.list = ListModel(taskChangedCallback = self.task_changed_cb)
+        self.list = ListModel(taskChangedCallback = self.task_changed_cb, taskChangedWants = self.has_clients)
     
         self.ws = inject(WebsocketServer)
         self.ws.connect_instance(self.list) #All API functions are defined in ListModel
 
+        # Clients can subscribe to versioned snapshots and patches instead of whole objects on every update.
+        ws_cfg = inject(ConfigService).data.get('websocket_host', {})
+        self.delta = DeltaPublisher(lambda: self.list.hdds, max_pending=ws_cfg.get('delta_max_pending', 64))
+        self.delta_interval = ws_cfg.get('delta_interval', 5)
+        self._delta_task = None
+        self.ws.delta = self.delta
+
     async def ws_update(self, payload):
         await self.ws.broadcast_data(payload)
+        data = payload.get('data', None)
+        serial = data.get('serial', None) if isinstance(data, dict) else getattr(data, 'serial', None)
+        if serial == None:
+            return
+        if payload.get('update', None) == 'remove':
+            self.delta.remove(serial) #Even with nobody subscribed, or the next subscriber's snapshot still has it
+        elif self.delta.subscribed:
+            await self.delta.update(serial)
         
     def image_shim(self, *args, **kw):
         imags = []
@@ -36,13 +53,19 @@ class App:
         await self.images.start()
         await self.ws.start()
         await self.list.start()
+        self._delta_task = asyncio.get_event_loop().create_task(self.delta.run(self.delta_interval))
 
     async def stop(self, *args, **kwargs):
         self.logger.info("Stopping application...")
+        if self._delta_task != None:
+            self._delta_task.cancel()
         await self.ws.stop()
         await self.list.stop()
         await self.images.stop()
         
+    def has_clients(self, *args, **kw):
+        return len(self.ws.clientlist) > 0
+
     def task_changed_cb(self, payload):
         loop = asyncio.get_event_loop()
         loop.create_task(self.ws_update(payload))
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from hddmondtools.hdd_snapshot import HddSnapshot
+from hddmondtools.fast_json import to_plain, dumps
+
+#
+#   The DeltaPublisher serves websocket clients that subscribed in delta mode. Instead of whole HddData objects on
+#   every change, they get:
+#
+#       snapshot    Every drive and its version, once when they subscribe, and again whenever they fall behind.
+#       add         A new drive and its version.
+#       patch       The fields of a drive that changed between two versions, as JSON-Patch (RFC 6902) operations.
+#       remove      The serial of a drive that went away.
+#
+#   A patch carries the version it applies to ('from') and the one it makes ('version'). A client that gets a patch
+#   for a version it doesn't have has missed something, and asks for a resync. A client whose queue grows longer than
+#   max_pending isn't keeping up: its queue is dropped and replaced by a fresh snapshot.
+#
+#   Patches are worked out once per drive version from the last state that was published, and encoded once for each
+#   encoding the delta clients use, then queued to every one of them. The drive versions come from its HddSnapshot.
+#
+#   What was published is kept whether or not anyone is subscribed, so a late subscriber's snapshot is current. A drive
+#   that is gone from hdds() is dropped from it on the next full update. A drive plugged back in gets a new
+#   HddSnapshot, whose versions start over, so it is published again as an add instead of compared with the old one.
+#
+
+def _pointer(path: str, key) -> str:
+    return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+
+def json_patch(old, new, path: str = '') -> List[Dict[str, Any]]:
+    """
+    The JSON-Patch operations that turn old into new. Dicts are compared key by key, lists of the same length item by
+    item, anything else is replaced whole.
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for k, v in old.items():
+            if k not in new:
+                ops.append({'op': 'remove', 'path': _pointer(path, k)})
+            else:
+                ops.extend(json_patch(v, new[k], _pointer(path, k)))
+        for k, v in new.items():
+            if k not in old:
+                ops.append({'op': 'add', 'path': _pointer(path, k), 'value': v})
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for i, (o, n) in enumerate(zip(old, new)):
+            ops.extend(json_patch(o, n, _pointer(path, i)))
+        return ops
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+class DeltaPublisher:
+
+    def __init__(self, hdds: Callable[[], Iterable[Any]], encode: Callable[[Any], Any] = None, max_pending: int = 64):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.hdds = hdds #Returns the connected drives
+        self.encode = encode if encode != None else dumps
+        self.max_pending = max_pending
+        self._queues: Dict[Any, list] = {} #{client address: its outgoing message queue}
+        self._encoders: Dict[Any, Callable[[Any], Any]] = {} #{client address: how its messages are encoded}
+        self._sent: Dict[str, Tuple[int, Any, HddSnapshot]] = {} #{serial: (version, plain data, its snapshot) last published}
+
+    @property
+    def subscribed(self) -> bool:
+        return len(self._queues) > 0
+
+    async def subscribe(self, address, queue: list, encode: Callable[[Any], Any] = None):
+        """
+        Starts sending deltas to a client through its queue, beginning with a snapshot. Messages to the client are
+        encoded with encode, or the publisher's encode if not given.
+        """
+        await self.update() #Publish what changed to the others first, so everyone's on the same versions.
+        self._queues[address] = queue
+        self._encoders[address] = encode if encode != None else self.encode
+        self.resync(address) #Anything still queued for the client predates the snapshot.
+        self.logger.debug(f"{address} subscribed to deltas.")
+
+    def unsubscribe(self, address):
+        self._encoders.pop(address, None)
+        if self._queues.pop(address, None) != None:
+            self.logger.debug(f"{address} unsubscribed from deltas.")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'update': 'snapshot', 'data': {
+            'hdds': {s: d for s, (v, d, _) in self._sent.items()},
+            'versions': {s: v for s, (v, d, _) in self._sent.items()},
+        }}
+
+    def resync(self, address):
+        """
+        Replaces whatever a client still has queued with a fresh snapshot.
+        """
+        queue = self._queues.get(address, None)
+        if queue == None:
+            return
+        queue.clear()
+        queue.append(self._encoders.get(address, self.encode)(self.snapshot()))
+
+    async def update(self, serial: str = None):
+        """
+        Publishes what changed on a drive, or on all of them. Updating all of them also removes the drives that are gone.
+        """
+        hdds = [h for h in self.hdds() if serial == None or h.serial == serial]
+        if serial == None:
+            connected = set(h.serial for h in hdds)
+            for s in [s for s in self._sent.keys() if s not in connected]:
+                self.remove(s)
+        for hdd in hdds:
+            try:
+                data, version = await self._get(hdd)
+            except Exception as e:
+                self.logger.error(f"Couldn't get data from {hdd.serial}: {str(e)}")
+                continue
+            if data == None:
+                continue
+            snapshot = HddSnapshot.of(hdd)
+            sent = self._sent.get(hdd.serial, None)
+            if sent != None and sent[2] is not snapshot:
+                sent = None #The drive was plugged back in, its versions started over.
+            if sent != None and sent[0] >= version:
+                continue #Nothing new, or a newer version was published while we waited.
+            plain = to_plain(data)
+            self._sent[hdd.serial] = (version, plain, snapshot)
+            if sent == None:
+                self._publish({'update': 'add', 'data': {'serial': hdd.serial, 'version': version, 'hdd': plain}})
+            else:
+                patch = json_patch(sent[1], plain)
+                self._publish({'update': 'patch', 'data': {'serial': hdd.serial, 'from': sent[0], 'version': version, 'patch': patch}})
+
+    def remove(self, serial: str):
+        """
+        Forgets a drive and tells the subscribers it's gone. Call it whether or not anyone is subscribed.
+        """
+        if self._sent.pop(serial, None) != None:
+            self._publish({'update': 'remove', 'data': {'serial': serial}})
+
+    async def _get(self, hdd) -> Tuple[Optional[Any], int]:
+        if hdd.locality == 'local':
+            return HddSnapshot.of(hdd).get() #Never blocks on the drive
+        return await asyncio.get_event_loop().run_in_executor(None, HddSnapshot.of(hdd).get)
+
+    def _publish(self, message: Dict[str, Any]):
+        if len(self._queues) <= 0:
+            return
+        encoded = {} #Encoded once for each encoding in use
+        for address, queue in self._queues.items():
+            if len(queue) >= self.max_pending:
+                self.logger.debug(f"{address} fell behind by {len(queue)} messages, sending it a fresh snapshot.")
+                self.resync(address)
+            else:
+                encode = self._encoders.get(address, self.encode)
+                if encode not in encoded:
+                    encoded[encode] = encode(message)
+                queue.append(encoded[encode])
+
+    async def run(self, interval: float):
+        """
+        Publishes changes nobody told us about (i.e. SMART refreshes) every interval seconds, while anyone is subscribed.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if self.subscribed:
+                await self.update()
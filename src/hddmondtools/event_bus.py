@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import threading
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from hddmondtools.hddmon_dataclasses import TaskQueueData
+from hddmontools.thread_drain import ThreadDrain
+
+#
+#   The TaskEventBus hands task queue events to whoever subscribed to them (the database, the websocket clients).
+#
+#   Progress ticks are coalesced per drive: at most events.progress_rate of them per second reach subscribers, and
+#   a tick that comes too soon is held back and replaced by newer ones, so the last progress always gets through.
+#   Any other event for the drive carries the newest state anyway, so it replaces a held-back tick.
+#
+#   Events don't carry a copy of the task queue. TaskEvent.taskqueue builds the TaskQueueData the first time a
+#   subscriber asks for it, and only once for all of them. Subscribers can also pass a wants() check, so events nobody
+#   is listening for (i.e. no websocket clients are connected) don't build anything.
+#
+#   publish() may be called from any thread. Events from other threads reach the loop through its ThreadDrain.
+#
+
+class TaskEvent:
+
+    def __init__(self, hdd, action: str, data: Dict[str, Any]):
+        self.hdd = hdd
+        self.serial = hdd.serial
+        self.action = action
+        self.data = data
+        self._taskqueue = None
+
+    @property
+    def taskqueue(self) -> TaskQueueData:
+        if self._taskqueue == None:
+            self._taskqueue = TaskQueueData.FromTaskQueue(self.hdd.TaskQueue)
+        return self._taskqueue
+
+    def payload(self) -> Dict[str, Any]:
+        return {'update': self.action, 'data': {'serial': self.serial, 'taskqueue': self.taskqueue}}
+
+class TaskEventBus:
+
+    def __init__(self, progress_rate: float = 2):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.progress_interval = 1 / progress_rate if progress_rate > 0 else 0 #seconds between progress events of a drive
+        self._subscribers: List[Tuple[Callable[[TaskEvent], None], Optional[Callable[[TaskEvent], bool]]]] = []
+        self._loop = None
+        self._thread = None
+        self._held: Dict[str, TaskEvent] = {} #{serial: newest progress event not delivered yet}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._last_progress: Dict[str, float] = {} #{serial: loop time of the last progress event delivered}
+
+    def subscribe(self, callback: Callable[[TaskEvent], None], wants: Callable[[TaskEvent], bool] = None):
+        self._subscribers.append((callback, wants))
+
+    def unsubscribe(self, callback: Callable[[TaskEvent], None]):
+        self._subscribers = [s for s in self._subscribers if s[0] != callback]
+
+    def bind(self, loop: asyncio.AbstractEventLoop = None):
+        """
+        Ties the bus to the loop that delivers its events. Call from the loop's thread.
+        """
+        self._loop = loop if loop != None else asyncio.get_event_loop()
+        self._thread = threading.get_ident()
+
+    def publish(self, hdd, action: str, data: Dict[str, Any] = None):
+        if self._loop != None and threading.get_ident() != self._thread:
+            ThreadDrain.for_loop(self._loop).call(self.publish, hdd, action, data)
+            return
+        event = TaskEvent(hdd, action, data if data != None else {})
+        if action == 'taskprogress':
+            self._progress(event)
+        else:
+            self.logger.debug(f"TaskQueue {action} callback from {event.serial}")
+            self._drop_held(event.serial)
+            self._deliver(event)
+
+    def forget(self, serial: str):
+        """
+        Drops what the bus remembers about a drive, i.e. when it is removed.
+        """
+        self._drop_held(serial)
+        self._last_progress.pop(serial, None)
+
+    def _progress(self, event: TaskEvent):
+        if self._loop == None or self.progress_interval <= 0:
+            self._deliver(event)
+            return
+        now = self._loop.time()
+        due = self._last_progress.get(event.serial, None)
+        due = now if due == None else due + self.progress_interval
+        self._held[event.serial] = event #Replaces an older one that is waiting.
+        if due <= now:
+            self._release(event.serial)
+        elif event.serial not in self._timers:
+            self._timers[event.serial] = self._loop.call_later(due - now, self._release, event.serial)
+
+    def _release(self, serial: str):
+        timer = self._timers.pop(serial, None)
+        if timer != None:
+            timer.cancel()
+        event = self._held.pop(serial, None)
+        if event != None:
+            self._last_progress[serial] = self._loop.time()
+            self._deliver(event)
+
+    def _drop_held(self, serial: str):
+        self._held.pop(serial, None)
+        timer = self._timers.pop(serial, None)
+        if timer != None:
+            timer.cancel()
+
+    def _deliver(self, event: TaskEvent):
+        for callback, wants in self._subscribers:
+            try:
+                if wants != None and not wants(event):
+                    continue
+                callback(event)
+            except Exception as e:
+                self.logger.error(f"Exception raised by a subscriber to {event.action} from {event.serial}: {str(e)}")
@@ -0,0 +1,135 @@
+import json
+import logging
+import datetime
+import dataclasses
+import typing
+import jsonpickle
+
+from typing import Any, Callable, Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+#
+#   Fast JSON encoding for the data classes in hddmon_dataclasses.py, which make up nearly all of our websocket traffic.
+#
+#   jsonpickle works out what every object is as it walks it. These classes already tell us: the first time one is
+#   encoded, its fields and their types are compiled into a function that builds the plain dict straight away. Fields
+#   holding another data class, or a list of them, call that class's function. Fields declared as a plain type are
+#   passed through as long as they really hold one, anything else goes through to_plain().
+#
+#   The plain result is written by orjson or ujson if one is installed, else by the json module. Types we don't know
+#   (neither data classes nor JSON types) still go through jsonpickle, so the output is the same as before.
+#
+#   util/bench_json.py compares this against jsonpickle.
+#
+
+logger = logging.getLogger(__name__)
+
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+if orjson != None:
+    BACKEND = 'orjson'
+elif ujson != None:
+    BACKEND = 'ujson'
+else:
+    BACKEND = 'json'
+
+_encoders: Dict[type, Callable[[Any], Dict[str, Any]]] = {}
+
+def to_plain(obj) -> Any:
+    """
+    The JSON form of an object, as plain dicts, lists and values.
+    """
+    cls = obj.__class__
+    if cls in PLAIN_TYPES:
+        return obj
+    if cls in _encoders:
+        return _encoders[cls](obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return encoder(cls)(obj)
+    if isinstance(obj, dict):
+        return {(k if k.__class__ is str else str(k)): to_plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, set)):
+        return [to_plain(v) for v in obj]
+    return json.loads(jsonpickle.dumps(obj, unpicklable=False, make_refs=False))
+
+def dumps(obj) -> str:
+    """
+    Encodes an object as JSON text, like jsonpickle.dumps(obj, unpicklable=False, make_refs=False) would.
+    """
+    plain = to_plain(obj)
+    if orjson != None:
+        try:
+            return orjson.dumps(plain).decode()
+        except TypeError:
+            pass #i.e. an int too large for orjson
+    if ujson != None:
+        return ujson.dumps(plain, ensure_ascii=False)
+    return json.dumps(plain, ensure_ascii=False)
+
+def encoder(cls: type) -> Callable[[Any], Dict[str, Any]]:
+    """
+    The compiled encoder of a data class, compiled on first use.
+    """
+    f = _encoders.get(cls, None)
+    if f == None:
+        f = _compile(cls)
+        _encoders[cls] = f
+    return f
+
+def _field_expr(hint, value: str, names: Dict[str, Any]) -> str:
+
+    #   The Python expression that turns a field's value into its plain form, given its type hint.
+
+    origin = typing.get_origin(hint)
+    args = typing.get_args(hint)
+    if origin is typing.Union and len(args) == 2 and type(None) in args:
+        inner = _field_expr(args[0] if args[1] is type(None) else args[1], value, names)
+        return f"(None if {value} is None else {inner})"
+    if isinstance(hint, type) and dataclasses.is_dataclass(hint):
+        name = f"_enc_{hint.__name__}"
+        names[name] = _Lazy(hint)
+        return f"(None if {value} is None else {name}({value}))"
+    if origin in (list, typing.List) and len(args) == 1 and isinstance(args[0], type) and dataclasses.is_dataclass(args[0]):
+        name = f"_enc_{args[0].__name__}"
+        names[name] = _Lazy(args[0])
+        return f"(None if {value} is None else [{name}(x) for x in {value}])"
+    if hint in PLAIN_TYPES:
+        return f"({value} if {value}.__class__ in _plain_types else _to_plain({value}))"
+    return f"_to_plain({value})"
+
+class _Lazy:
+
+    #   Stands in for another class's encoder until it is needed, so classes can refer to each other.
+
+    def __init__(self, cls: type):
+        self.cls = cls
+        self.f = None
+
+    def __call__(self, obj):
+        if self.f == None:
+            self.f = encoder(self.cls)
+        if obj.__class__ is not self.cls:
+            return to_plain(obj) #A subclass, or something else entirely
+        return self.f(obj)
+
+def _compile(cls: type) -> Callable[[Any], Dict[str, Any]]:
+    try:
+        hints = typing.get_type_hints(cls)
+    except Exception:
+        hints = {}
+    names = {'_plain_types': PLAIN_TYPES, '_to_plain': to_plain}
+    items = []
+    for f in dataclasses.fields(cls):
+        items.append(f"{f.name!r}: {_field_expr(hints.get(f.name, Any), 'o.' + f.name, names)}")
+    source = f"def _encode_{cls.__name__}(o):\n    return {{{', '.join(items)}}}\n"
+    exec(source, names)
+    logger.debug(f"Compiled a JSON encoder for {cls.__qualname__}.")
+    return names[f"_encode_{cls.__name__}"]
@@ -0,0 +1,141 @@
+import time
+import logging
+import threading
+import dataclasses
+
+from typing import Any, Dict, Optional, Tuple
+from injectable import inject
+
+from hddmondtools.hddmon_dataclasses import HddData, TaskQueueData
+from hddmontools.config_service import ConfigService
+
+#
+#   The HddSnapshot keeps one HddData per device, along with a version number that goes up whenever the data actually
+#   changes. Readers get the cached object, so the websocket and the database can tell an unchanged drive by its
+#   version and skip it.
+#
+#   The data is built in sections, and only the sections marked dirty are built again:
+#
+#       identity    serial, model, node, port, seen... Marked by the Hdd's setters and when its port is located.
+#       smart       SMART data and assessment. A local drive's section is rebuilt when its SMART cache holds a new
+#                   snapshot (every refresh makes a new one). A remote drive's is rebuilt once it is smart.cache_ttl old.
+#       tasks       The task queue. Marked by every task queue event.
+#       supported   The task types the drive supports. Marked along with the task queue.
+#
+#   A rebuilt section that comes out equal to the old one doesn't change the version. The SMART data's last_captured
+#   changes with every refresh and isn't compared: the new timestamp is carried in the data, at the same version.
+#
+
+SECTIONS = ('identity', 'smart', 'tasks', 'supported')
+
+class HddSnapshot:
+
+    @staticmethod
+    def of(hdd) -> 'HddSnapshot':
+        """
+        The device's snapshot, made on first use.
+        """
+        s = getattr(hdd, '_data_snapshot', None)
+        if s == None:
+            s = HddSnapshot(hdd)
+            hdd._data_snapshot = s
+        return s
+
+    @staticmethod
+    def mark(hdd, *sections):
+        """
+        Marks sections of a device's snapshot dirty, if it has one. Without sections, marks all of them.
+        """
+        s = getattr(hdd, '_data_snapshot', None)
+        if s != None:
+            s.invalidate(*sections)
+
+    def __init__(self, hdd):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.hdd = hdd
+        self.version = 0
+        self.data: Optional[HddData] = None
+        self._dirty = set(SECTIONS)
+        self._parts: Dict[str, Dict[str, Any]] = {}
+        self._smart_source = None #The SmartData the smart section was built from
+        self._smart_built = 0
+        self._smart_ttl = inject(ConfigService).data.get('smart', {}).get('cache_ttl', 30)
+        self._lock = threading.Lock() #get() is called from the loop, executor threads and onboarding workers
+
+    def invalidate(self, *sections):
+        self._dirty.update(sections if len(sections) > 0 else SECTIONS)
+
+    def get(self) -> Tuple[Optional[HddData], int]:
+        """
+        Returns the device's HddData and its version, building only what changed since last time. Doesn't block on the
+        drive for a local device, the SMART section uses the cached snapshot.
+        """
+        with self._lock:
+            return self._get()
+
+    def _get(self) -> Tuple[Optional[HddData], int]:
+        self._check_smart()
+        if len(self._dirty) <= 0 and self.data != None:
+            return self.data, self.version
+
+        dirty, self._dirty = self._dirty, set() #Sections marked while we are building land in the new set.
+        try:
+            parts = {s: getattr(self, '_build_' + s)() for s in dirty}
+        except Exception as e:
+            self._dirty |= dirty
+            self.logger.error(f"Error while building data for {getattr(self.hdd, 'serial', '?')} {getattr(self.hdd, 'node', '?')}: {str(e)}")
+            return self.data, self.version
+
+        changed = any(not self._same(s, self._parts.get(s, None), p) for s, p in parts.items())
+        self._parts.update(parts)
+        fields = {}
+        for p in self._parts.values():
+            fields.update(p)
+        self.data = HddData(**fields)
+        if changed or self.version == 0:
+            self.version += 1
+        return self.data, self.version
+
+    @staticmethod
+    def _same(section: str, old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> bool:
+        if section == 'smart' and old != None:
+            return HddSnapshot._untimed(old) == HddSnapshot._untimed(new)
+        return old == new
+
+    @staticmethod
+    def _untimed(part: Dict[str, Any]) -> Dict[str, Any]:
+        smart = part.get('smart', None)
+        if dataclasses.is_dataclass(smart):
+            return dict(part, smart=dataclasses.replace(smart, last_captured=None))
+        return part
+
+    def _check_smart(self):
+        cache = getattr(self.hdd, 'smart_cache', None)
+        if cache != None:
+            if cache.peek() is not self._smart_source or getattr(self.hdd, 'degraded', False) != self._parts.get('smart', {}).get('degraded', None):
+                self._dirty.add('smart')
+        elif time.monotonic() - self._smart_built >= self._smart_ttl:
+            self._dirty.add('smart')
+
+    def _build_identity(self) -> Dict[str, Any]:
+        h = self.hdd
+        return {
+            'serial': h.serial, 'model': h.model, 'wwn': h.wwn, 'capacity': h.capacity, 'status': None,
+            'node': h.node, 'port': str(h.port), 'notes': [], 'seen': h.seen, 'locality': h.locality,
+        }
+
+    def _build_smart(self) -> Dict[str, Any]:
+        cache = getattr(self.hdd, 'smart_cache', None)
+        smart = cache.peek() if cache != None else None
+        if smart == None:
+            smart = self.hdd.smart_data #Nothing cached yet, or a remote device.
+        self._smart_source = cache.peek() if cache != None else smart
+        self._smart_built = time.monotonic()
+        return {'smart': smart, 'assessment': str(smart.assessment), 'degraded': getattr(self.hdd, 'degraded', False)}
+
+    def _build_tasks(self) -> Dict[str, Any]:
+        return {'task_queue': TaskQueueData.FromTaskQueue(self.hdd.TaskQueue)}
+
+    def _build_supported(self) -> Dict[str, Any]:
+        return {'supported_tasks': self.hdd.get_available_tasks()}
@@ -3,7 +3,6 @@ import os, sys
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
 import subprocess
 import multiprocessing.connection as ipc
-import proc.core
 import pyudev
 from pySMART import Device
 from hddmontools.hdd import Hdd, HddInterface
@@ -12,11 +11,17 @@ from hddmontools.task import ExternalTask, Task, ImageTask, EraseTask
 from hddmontools.test import Test
 from hddmontools.image import DiskImage, Partition
 from hddmontools.smartctl_hdd_detector import SmartctlDetector
+from hddmontools.uevent_hdd_detector import UeventDetector
+from hddmontools.detector_coalescer import CoalescingDetector
+from hddmontools.sysfs_enumerator import SysfsEnumerator
+from hddmontools.process_snapshot import ProcessSnapshot
+from hddmontools.config_service import ConfigService
 import pySMART
 import time
 import threading
 import hddmontools.sasdetection
 import hddmontools.portdetection
+from hddmontools.portdetection import PortDetection
 import signal
 import logging
 from socket import timeout
@@ -26,8 +31,13 @@ from hddmondtools.databaseinterface import GenericDatabase
 from hddmondtools.couchdb import CouchDatabase
 from hddmontools.hdd_remote import HddRemoteRecieverServer, HddRemoteReciever
 from hddmondtools.websocket import WebsocketServer
+from hddmondtools.onboarding import OnboardingPipeline, OnboardingJob
+from hddmondtools.refresh_scheduler import RefreshScheduler
+from hddmondtools.event_bus import TaskEventBus, TaskEvent
+from hddmondtools.hdd_snapshot import HddSnapshot
 from injectable import inject
 from pathlib import Path
+from typing import Tuple
 
 import asyncio
 
@@ -36,12 +46,13 @@ class ListModel:
     Data model that holds hdd list.
     """
 
-    def __init__(self, taskChangedCallback = None):
+    def __init__(self, taskChangedCallback = None, taskChangedWants = None):
         self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
         self.logger.setLevel(logging.DEBUG)
         self.logger.debug("Initializing ListModel...")
         self.updateInterval = 3 #Interval for scanning for running SMART tests
         self.task_change_outside_callback = taskChangedCallback #callback for when any hdd's task stuff calls back
+        self.task_change_outside_wants = taskChangedWants #Optional check of whether the outside callback wants a task event at all
         self.task_svc = TaskService()
         self.task_svc.initialize()
         self.hdds = [] #The list of hdd's (HddInterface class)
@@ -49,23 +60,58 @@ class ListModel:
         self.blacklist_path = self.blacklist_path.absolute() # Normalize the path.
         self.blacklist_hdds = self.load_blacklist_file() #The list of hdd's to ignore when seen
 
-        # This has replaced the UDEV detector since it doesn't work in a container
-        self.detector = SmartctlDetector()
-        self.detector.add_change_callback(self.deviceAdded)
+        # The uevent detector picks netlink, inotify (in a container) or sysfs polling on its own.
+        # The smartctl poller is kept around for systems where none of those behave.
+        # Either way, hot-plug storms are debounced and delivered to us in batches.
+        cfg_svc = inject(ConfigService)
+        detection_cfg = cfg_svc.data.get('detection', {})
+        if detection_cfg.get('method', 'uevent') == 'smartctl':
+            detector = SmartctlDetector()
+        else:
+            detector = UeventDetector()
+        self.detector = CoalescingDetector(detector, debounce=detection_cfg.get('debounce', 1.5), max_delay=detection_cfg.get('max_delay', 10))
+        self.detector.add_batch_callback(self.devicesChanged)
+
+        # New devices are identified, located and registered in stages, several at a time.
+        self.onboarding = OnboardingPipeline(max_workers=cfg_svc.data.get('onboarding', {}).get('max_workers', 8))
+        self.onboarding.add_stage('identify', self._onboard_identify)
+        self.onboarding.add_stage('register', self._onboard_register)
+        self.onboarding.add_stage('locate port', self._onboard_locate_port)
+        self.onboarding.add_stage('smart snapshot', self._onboard_smart)
+        self.onboarding.add_stage('database', self._onboard_database)
+        self.onboarding.add_stage('broadcast', self._onboard_broadcast)
+
+        # Local drives have their SMART data refreshed on their own jittered schedules, a few at a time.
+        refresh_cfg = cfg_svc.data.get('refresh', {})
+        self.refresher = RefreshScheduler(
+            self._refresh_smart,
+            self._refresh_priority,
+            intervals={
+                'idle': refresh_cfg.get('idle_interval', 30),
+                'error': refresh_cfg.get('error_interval', 15),
+                'testing': refresh_cfg.get('testing_interval', 300),
+            },
+            max_concurrent=refresh_cfg.get('max_concurrent', 4),
+            jitter=refresh_cfg.get('jitter', 0.1),
+        )
+
+        # Task queue events go through a bus that rate-limits progress ticks, and only builds queue snapshots for
+        # subscribers that want the event.
+        self.events = TaskEventBus(progress_rate=cfg_svc.data.get('events', {}).get('progress_rate', 2))
+        self.events.subscribe(self._task_event_database, wants=lambda e: e.action == 'taskfinished')
+        self.events.subscribe(self._task_event_outside, wants=self._outside_wants)
+        self.events.subscribe(self._task_event_refresh, wants=lambda e: e.action in ('tasklistmod', 'taskfinished', 'taskabort', 'errorchange')) #Tasks starting, ending or failing change a drive's refresh priority.
 
-        # TODO: Detect if in container or not!
         # TODO: Add a way to tell us of new devices using a user's external script!
 
-        # self._udev_context = pyudev.Context() #The UDEV context. #TODO: Autowire? If we decide to use this.
-        # self.monitor = pyudev.Monitor.from_netlink(self._udev_context) #The monitor that watches for UDEV object actions (uses C bindings)
-        # self.monitor.filter_by(subsystem='block', device_type='disk') #Filter the incoming object actions
-
         self.remote_hdd_server = inject(HddRemoteRecieverServer)
         self.remote_hdd_server.register_devchange_callback(self.remote_hdd_callback)
         self.AutoShortTest = False #Do auto short test on new detected drives?
         self._loopgo = True #Condition for the SMART scan loop
         self.stuffRunning = False #Is stuff running? I don't know
+        self.processes = ProcessSnapshot() #Which processes are working on which devices
         self.database = inject(CouchDatabase) #The database
+        self._db_versions = {} #{serial: version of the drive's HddData last written to the database}
 
         if self.database != None:
             if( not self.database.connect()):
@@ -94,26 +140,39 @@ class ListModel:
         #   taskfinished    (data is {task: Task, returncode: Int})
         #   tasklistmod     (data is {tasklist: Task[]})
         #   taskabort       (data is {})
+        #   errorchange     (data is {error: bool})
+        #
+        # Outside of the task queue, the outside callback will also see:
+        #
+        #   add             (data is HddData, sent as soon as a device is identified)
+        #   hddupdate       (data is HddData, sent when onboarding fills in the port, SMART and database info)
+        #   remove          (data is HddData)
         #
         #####
 
-        Tqd = TaskQueueData.FromTaskQueue(hdd.TaskQueue)
-        
         data = kwargs.get('data', None)
         action = kwargs.get('action', None)
 
-        self.logger.debug(f"TaskQueue {action} callback from {hdd.serial}")
-
         if(data == None) or (action == None):
             return
 
         data.update({'serial': hdd.serial})
+        HddSnapshot.mark(hdd, 'tasks', 'supported')
+        self.events.publish(hdd, action, data) #May be called from a task's thread, the bus takes care of that.
 
-        if(action == "taskfinished"):
-            self.database_task_finished(hdd, Tqd)
+    def _task_event_database(self, event: TaskEvent):
+        self.database_task_finished(event.hdd, event.taskqueue)
 
-        if self.task_change_outside_callback != None and callable(self.task_change_outside_callback):
-            self.task_change_outside_callback({'update': action, 'data': {'serial': hdd.serial, 'taskqueue': Tqd}})
+    def _task_event_refresh(self, event: TaskEvent):
+        self.refresher.reclassify(event.hdd)
+
+    def _outside_wants(self, event: TaskEvent) -> bool:
+        if self.task_change_outside_callback == None or not callable(self.task_change_outside_callback):
+            return False
+        return self.task_change_outside_wants == None or self.task_change_outside_wants(event)
+
+    def _task_event_outside(self, event: TaskEvent):
+        self.task_change_outside_callback(event.payload())
 
     def database_task_finished(self, hdd:HddInterface, task_queue_data: TaskQueueData):
         if self.database == None:
@@ -126,8 +185,30 @@ class ListModel:
 
         self.database.add_task(hdd.serial, t)
         if 'test' in t.name.lower():
-            self.database.insert_attribute_capture(HddData.FromHdd(hdd))
-            self.logger.info("Captured SMART data into database from {0}".format(hdd.serial))
+            self._database_capture(hdd)
+
+    def _database_capture(self, hdd: HddInterface, see=False) -> HddData:
+        """
+        Writes the drive's data and a SMART attribute capture to the database, unless this version of it is already
+        there. With see, also counts the drive as seen again. Returns the drive's data.
+        """
+        data, version = HddSnapshot.of(hdd).get()
+        if self.database == None or data == None:
+            return data
+        if see:
+            self.database.update_hdd(data)
+            hdd.seen = self.database.see_hdd(hdd.serial)
+            HddSnapshot.mark(hdd, 'identity') #Remote devices don't mark it themselves.
+            data, version = HddSnapshot.of(hdd).get()
+        elif self._db_versions.get(hdd.serial, None) == version:
+            self.logger.debug(f"Data from {hdd.serial} hasn't changed since it was last captured.")
+            return data
+        else:
+            self.database.update_hdd(data)
+        self.database.insert_attribute_capture(data)
+        self._db_versions[hdd.serial] = version
+        self.logger.info("Captured SMART data into database from {0}".format(hdd.serial))
+        return data
 
     def update_blacklist_file(self):
         self.logger.debug("Updating blacklist file with latest changes...")
@@ -198,6 +279,10 @@ class ListModel:
     async def sendHdds(self, *args, **kw):
         """
         Retreive a list of the currently connected HDDs, or a single one if `serial` is specified.
+
+        Every HDD's data comes with its version. A client that passes the versions it already has (`versions`, as
+        {serial: version}, or `version` along with `serial`) only gets the HDDs that changed since, and the serials of
+        the others in `unchanged`.
         """
         
         serial = kw.get('serial', None)
@@ -206,25 +291,39 @@ class ListModel:
             self.logger.debug(f"Got request for HDD data from {serial}...")
             for h in self.hdds:
                 if (h.serial == serial):
+                    data, version = await self._hdd_data(h)
+                    if kw.get('version', None) == version:
+                        return {'unchanged': [h.serial], 'version': version}
                     self.logger.debug(f"Sending data for HDD {h.serial}.")
-                    return {'hdd': HddData.FromHdd(h)}
+                    return {'hdd': data, 'version': version}
             #This runs if the return statement doesn't execute
             self.logger.debug(f"Couldn't find a connected HDD with serial {serial}.")
             return {'error': 'No hdd found with serial {0}'.format(serial)}
 
         else:
             self.logger.debug("Got request for all connected HDDs...")
-            futures = []
-            loop = asyncio.get_event_loop()
-            for h in self.hdds:
-                future = loop.run_in_executor(None, HddData.FromHdd, h)
-                futures.append(future)
-
-            results = await asyncio.gather(*futures)
-            self.logger.debug(f"Returning {len(results)} HDDs.")
-            return {'hdds': results}
+            known = kw.get('versions', None) or {}
+            hdds = list(self.hdds) #Drives may come and go while we wait.
+            results = await asyncio.gather(*(self._hdd_data(h) for h in hdds))
+            versions = {h.serial: v for h, (d, v) in zip(hdds, results) if d != None}
+            changed = [d for d, v in results if d != None and known.get(d.serial, None) != v]
+            unchanged = [s for s, v in versions.items() if known.get(s, None) == v]
+            self.logger.debug(f"Returning {len(changed)} HDDs, {len(unchanged)} unchanged.")
+            return {'hdds': changed, 'versions': versions, 'unchanged': unchanged}
         return {'error': 'No hdd(s) found for constraints!'}
 
+    async def _hdd_data(self, hdd: HddInterface) -> Tuple[HddData, int]:
+        """
+        The drive's cached HddData and its version, rebuilt where it changed.
+        """
+        if isinstance(hdd, Hdd):
+            try:
+                await hdd.smart_cache.get_async() #Refreshes through smartctl's JSON output if the snapshot is stale
+            except Exception as e:
+                self.logger.warn(f"Couldn't refresh SMART data for {hdd.serial}, sending the last snapshot: {str(e)}")
+            return HddSnapshot.of(hdd).get()
+        return await asyncio.get_event_loop().run_in_executor(None, HddSnapshot.of(hdd).get)
+
     async def sendTaskTypes(self, *args, **kw):
         """
         Returns each HDD's supported task types.
@@ -422,32 +521,37 @@ class ListModel:
 
     async def updateLoop(self):
         '''
-        This loop should be run in a separate thread. Watches for external processes and smart tests not initialized by this program.
+        Watches for external processes working on our drives. SMART data is kept fresh by the refresh scheduler.
         '''
-        smart_coldcall_interval = 30.0 #seconds
         while self._loopgo:
             busy = False
+            scanned = False
             for hdd in self.hdds:
                 if not isinstance(hdd, Hdd): #Only perform on local Hdd devices
                     continue
 
-                if not (isinstance(hdd.TaskQueue.CurrentTask, Test)): #Check if the current task is a test or not
-                    if(time.time() - hdd._smart_last_call > smart_coldcall_interval): #If we're not testing, occasionally check to see if a test was started externally.
-                        #print("smart cold-call to " + str(hdd.serial))
-                        try:
-                            hdd.update_smart()
-                            hdd._smart_last_call = time.time()
-                        except Exception as e:
-                            self.logger.warn("Exception raised during SMART refresh!: " + str(e))
                 if(hdd.TaskQueue.CurrentTask != None): #If there is a task operating on the drive's data
                     busy = True
                 else:
+                    if not scanned: #One scan of the process table serves every idle drive.
+                        self.processes.update()
+                        scanned = True
                     task = self.findProcAssociated(hdd.name)
                     if(task != None):
                         hdd.TaskQueue.AddTask(ExternalTask(hdd, task.pid))
             self.stuffRunning = busy
             await asyncio.sleep(1)
 
+    async def _refresh_smart(self, hdd: Hdd):
+        await hdd.update_smart_async()
+
+    def _refresh_priority(self, hdd: Hdd) -> str:
+        if hdd.TaskQueue.Error or hdd.degraded:
+            return 'error'
+        if isinstance(hdd.TaskQueue.CurrentTask, Test):
+            return 'testing'
+        return 'idle'
+
     def updateDevices(self, ignoreNodes = []):
         """
         Checks the system's existing device list and gatheres already connected hdds.
@@ -456,27 +560,18 @@ class ListModel:
         """
         #This should be run at the beginning of the program, or only if the hdd array is cleared.
         #Check to see if this device path already exists in our application.
-        self.logger.debug(pySMART.DeviceList().devices)
-        for d in pySMART.DeviceList().devices:
-            
-            notFound = True
-            if("/dev/" + d.name in ignoreNodes): #Check if this is our boot drive.
-                notFound = False
-
-            for hdd in self.hdds:
-                #print("Testing: /dev/" + d.name + " == " + hdd.node)
-                if(hdd.node == "/dev/" + d.name) : #This device path exists. Do not add it.
-                    notFound = False
-                    break
-            
-            if(notFound): #If we didn't find it already in our list, go ahead and add it.
-                h = Hdd.FromSmartDevice(d)
-                if self.addHdd(h):
-                    self.logger.info("Added /dev/"+d.name)
-                else:
-                    self.logger.info("Skipped adding /dev/"+d.name)
-
-        self.logger.info("Finished adding existing devices")
+        devices = SysfsEnumerator().enumerate()
+        self.logger.debug(list(devices.keys()))
+        known_nodes = {hdd.node for hdd in self.hdds}
+        queued = 0
+        for node in devices.keys():
+            if (node in ignoreNodes) or (node in known_nodes): #Our boot drive, or a device path that already exists. Do not add it.
+                continue
+
+            self.onboarding.submit(node)
+            queued += 1
+
+        self.logger.info(f"Queued {queued} existing devices for onboarding")
             
     def addHdd(self, hdd: HddInterface):
         if(self.check_in_blacklist(hdd)):
@@ -485,20 +580,15 @@ class ListModel:
             return False
 
         self.hdds.append(hdd)
+        if isinstance(hdd, Hdd):
+            self.refresher.add(hdd)
         if(self.AutoShortTest == True) and (not isinstance(hdd.TaskQueue.CurrentTask, Test)):
             pass #No autotests yet.
         hdd.add_task_changed_callback(self.task_change_callback)
-
-        if(self.database != None):
-            self.database.update_hdd(HddData.FromHdd(hdd))
-            hdd.seen = self.database.see_hdd(hdd.serial)
-
-        if self.database:
-            self.database.insert_attribute_capture(HddData.FromHdd(hdd))
-            self.logger.info("Captured SMART data into database from {0}".format(hdd.serial))
+        data = self._database_capture(hdd, see=True)
 
         if self.task_change_outside_callback != None and callable(self.task_change_outside_callback):
-            self.task_change_outside_callback({'update': 'add', 'data': HddData.FromHdd(hdd)})
+            self.task_change_outside_callback({'update': 'add', 'data': data})
         
         return True
 
@@ -509,11 +599,15 @@ class ListModel:
         for h in self.hdds:
             if (h.node == node):
                 try:
+                    data, version = HddSnapshot.of(h).get()
                     if self.task_change_outside_callback != None and callable(self.task_change_outside_callback):
-                        self.task_change_outside_callback({'update': 'remove', 'data': HddData.FromHdd(h)})
-                    if(self.database != None):
-                        self.database.update_hdd(HddData.FromHdd(h))
+                        self.task_change_outside_callback({'update': 'remove', 'data': data})
+                    if(self.database != None) and (data != None) and (self._db_versions.get(h.serial, None) != version):
+                        self.database.update_hdd(data)
+                    self._db_versions.pop(h.serial, None)
                     self.hdds.remove(h)
+                    self.refresher.remove(h)
+                    self.events.forget(h.serial)
                 except KeyError as e:
                     self.logger.error("Error removing hdd by node!:\n" + str(e))
                 break
@@ -521,27 +615,109 @@ class ListModel:
     def deviceAdded(self, action: str, serial: str, node: str):
         self.logger.info("Device change: " + str(action) + " " + str(serial))
         if(action == 'add') and (node != None):
-            hdd = Hdd(node)
-            self.addHdd(hdd)
+            self.onboarding.submit(node)
         elif(action == 'remove') and (node != None):
+            self.onboarding.cancel(node)
             self.removeHddStr(node)
 
+    def devicesChanged(self, events):
+        """
+        Handles a batch of coalesced device changes from the detector. See CoalescingDetector for the event format.
+        """
+        to_onboard = []
+        port_detector = inject(PortDetection)
+        stale_controllers = set()
+        for e in events:
+            action = e['action']
+            node = e['node']
+
+            #Only the controllers that saw a hot-plug event need their port maps refreshed.
+            for n in (node, e['old_node']):
+                for h in self.hdds:
+                    if h.node == n and getattr(h, '_pci_address', None) != None:
+                        stale_controllers.update(port_detector.Invalidate(h._pci_address))
+            if action != 'remove':
+                stale_controllers.update(port_detector.InvalidateNode(node))
+
+            self.logger.info(f"Device change: {action} {e['serial']} on {node}" + (f" (was {e['old_node']})" if e['old_node'] not in (None, node) else ''))
+            if action == 'remove':
+                self.onboarding.cancel(node)
+                self.removeHddStr(node)
+            elif action == 'reenumerated':
+                if e['old_node'] != node:
+                    self.onboarding.cancel(e['old_node'])
+                    self.removeHddStr(e['old_node'])
+                    to_onboard.append(node)
+                elif not (node in (h.node for h in self.hdds)):
+                    to_onboard.append(node) #It flapped before we finished onboarding it the first time.
+            elif action == 'add':
+                to_onboard.append(node)
+
+        if len(stale_controllers) > 0:
+            asyncio.get_event_loop().create_task(port_detector.RefreshAsync(stale_controllers))
+
+        if len(to_onboard) > 0:
+            self.logger.info(f"Onboarding {len(to_onboard)} device(s)...")
+        for node in to_onboard:
+            self.onboarding.submit(node)
+
+    def _onboard_identify(self, job: OnboardingJob):
+        job.hdd = Hdd(job.node, locate_port=False)
+
+    async def _onboard_register(self, job: OnboardingJob):
+        hdd = job.hdd
+        if hdd.node in (h.node for h in self.hdds):
+            self.logger.debug(f"{hdd.node} was already added. Skipping.")
+            return False
+        if(self.check_in_blacklist(hdd)):
+            await hdd.disconnect()
+            self.logger.info("Skipped adding " + hdd.node)
+            return False
+
+        self.hdds.append(hdd)
+        self.refresher.add(hdd)
+        hdd.add_task_changed_callback(self.task_change_callback)
+        self.logger.info("Added " + hdd.node)
+
+        job.data = (await self.onboarding.run_blocking(HddSnapshot.of(hdd).get))[0]
+        if self.task_change_outside_callback != None and callable(self.task_change_outside_callback):
+            self.task_change_outside_callback({'update': 'add', 'data': job.data})
+
+    def _onboard_locate_port(self, job: OnboardingJob):
+        job.hdd.locate_port()
+
+    async def _onboard_smart(self, job: OnboardingJob):
+        try:
+            await job.hdd.smart_cache.get_async() #Uses the snapshot taken while identifying, if it is still fresh. Goes through the SmartGuard otherwise.
+        except Exception as e:
+            self.logger.warn(f"Couldn't refresh SMART data for {job.hdd.serial} while onboarding: {str(e)}")
+        job.data = (await self.onboarding.run_blocking(HddSnapshot.of(job.hdd).get))[0] #Without any snapshot yet, building reads the drive.
+
+    def _onboard_database(self, job: OnboardingJob):
+        if self.database == None or job.data == None:
+            return
+
+        job.data = self._database_capture(job.hdd, see=True)
+
+    async def _onboard_broadcast(self, job: OnboardingJob):
+        if job.data == None:
+            return
+        if self.task_change_outside_callback != None and callable(self.task_change_outside_callback):
+            self.task_change_outside_callback({'update': 'hddupdate', 'data': job.data})
+
     def findProcAssociated(self, name):
-        #print("Looking for " + str(name) + " in process cmdline list...")
-        plist = proc.core.find_processes()
-        for p in plist:
-            for cmdlet in p.cmdline:
-                if str(name) in cmdlet and not 'smartct' in p.exe:
-                    self.logger.info("Found process " + str(p) + " containing name " + str(name) + " in cmdline.")
-                    return p
-        #print("No process found for " + str(name) + ".")
-        return None
+        p = self.processes.find(name)
+        if p != None:
+            self.logger.info("Found process " + str(p) + " containing name " + str(name) + " in cmdline.")
+        return p
 
     async def start(self):
         self._loopgo = True
+        self.events.bind()
         self.remote_hdd_server.start()
         await self.detector.start()
         asyncio.get_event_loop().create_task(self.updateLoop())
+        self.refresher.start()
         self.logger.info("Done initializing.")
 
     async def stop(self):
@@ -549,8 +725,10 @@ class ListModel:
         self._loopgo = False
         # print("Stopping udev observer...")
         # self.observer.stop()
-        self.logger.debug("Stopping Smartctl poller...")
+        self.logger.debug("Stopping device detector...")
         await self.detector.stop()
+        self.onboarding.shutdown()
+        self.refresher.stop()
         self.logger.debug("Stopping HDDs...")
         #TODO: Schedule all disconnections concurrently!
         for h in self.hdds:
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from py_ts_interfaces import Interface
 from typing import *
+import re
 import datetime
 #
 #   The purpose of this file is to hold data classes that correspond to typescript interface definitions on the web app thing.
@@ -69,6 +70,22 @@ class NoteData(Interface):
     def FromNote(note):
         return NoteData(note.tags, note.note, note.note_taker, str(note.timestamp.isoformat()))
 
+def smart_int(value) -> Optional[int]:
+    """
+    A SMART attribute field as an int, whichever backend read it. pySMART hands over the columns smartctl printed as
+    strings, i.e. flags as '0x0033' and raw values as '37 (Min/Max 18/45)', which become 0x33 and 37.
+    """
+    if value == None or isinstance(value, int):
+        return value
+    value = str(value).strip()
+    if value.lower().startswith('0x'):
+        try:
+            return int(value, 16)
+        except ValueError:
+            return None
+    m = re.match(r'-?\d+', value)
+    return int(m.group(0)) if m != None else None
+
 @dataclass
 class AttributeData(Interface):
     index: int
@@ -82,6 +99,13 @@ class AttributeData(Interface):
     when_failed: str
     worst: int
 
+    #   Every backend (pySMART, smartctl's JSON, SG_IO) gives the numeric fields as ints, so switching backends doesn't
+    #   change what clients see.
+
+    @staticmethod
+    def FromSmartAttribute(a):
+        return AttributeData(smart_int(a.num), a.name, smart_int(a.flags), smart_int(a.raw), smart_int(a.thresh), a.type, a.updated, smart_int(a.value), a.when_failed, smart_int(a.worst))
+
 @dataclass
 class SmartData(Interface):
     last_captured: str
@@ -100,8 +124,7 @@ class SmartData(Interface):
         formatted_attrs = []
         for a in device.attributes:
             if a != None:
-                attr = AttributeData(a.num, a.name, a.flags, a.raw, a.thresh, a.type, a.updated, a.value, a.when_failed, a.worst)
-                formatted_attrs.append(attr)
+                formatted_attrs.append(AttributeData.FromSmartAttribute(a))
         
         test_capabilities = []
         for k in device.test_capabilities:
@@ -120,13 +143,14 @@ class TaskData(Interface):
     notes: List[NoteData]
     time_started: str
     time_ended: str
+    statistics: Dict[str, Any] = None #Task specific figures, i.e. a sample verify's coverage and confidence
 
     @staticmethod
     def FromTask(task):
         notes = []
         for n in task.notes.entries:
             notes.append(NoteData.FromNote(n))
-        return TaskData(task.name, (task.Progress != -1), task.Progress, task.ProgressString, task.returncode, notes, (task.time_started.isoformat() if task.time_started != None else None), (task.time_ended.isoformat() if task.time_ended != None else None))
+        return TaskData(task.name, (task.Progress != -1), task.Progress, task.ProgressString, task.returncode, notes, (task.time_started.isoformat() if task.time_started != None else None), (task.time_ended.isoformat() if task.time_ended != None else None), getattr(task, 'statistics', None))
 
 @dataclass
 class TaskQueueData(Interface):
@@ -163,6 +187,7 @@ class HddData(Interface):
     seen: int
     locality: str
     supported_tasks: Dict[str, str]
+    degraded: bool = False #SMART calls to the drive keep failing and are being held off
 
     @staticmethod
     def FromHdd(hdd): #HddInterface
@@ -171,7 +196,8 @@ class HddData(Interface):
         #     #notes.append(NoteData.FromNote(n))
         #     pass
         try:
-            return HddData(hdd.serial, hdd.model, hdd.wwn, hdd.capacity, None, str(hdd.smart_data.assessment), TaskQueueData.FromTaskQueue(hdd.TaskQueue), hdd.node, str(hdd.port), hdd.smart_data, notes, hdd.seen, hdd.locality, hdd.get_available_tasks())
+            smart = hdd.smart_data
+            return HddData(hdd.serial, hdd.model, hdd.wwn, hdd.capacity, None, str(smart.assessment), TaskQueueData.FromTaskQueue(hdd.TaskQueue), hdd.node, str(hdd.port), smart, notes, hdd.seen, hdd.locality, hdd.get_available_tasks(), getattr(hdd, 'degraded', False))
         except Exception as e:
             ("Error while parsing HDD {0} {1}".format(hdd.serial, hdd.node))
             print(str(e))
@@ -0,0 +1,92 @@
+import asyncio
+import inspect
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+#
+#   The onboarding pipeline brings newly detected devices into hddmond in stages, with several devices moving through
+#   it at once. Each stage is either a blocking function (ran in the pipeline's bounded worker pool) or a coroutine
+#   (ran on the event loop). A stage returning False stops the job, so later stages never see a blacklisted or vanished
+#   device.
+#
+
+class OnboardingJob:
+    def __init__(self, node: str):
+        self.node = node
+        self.hdd = None #Set by the identification stage
+        self.data = None #The latest HddData built for the device, if any
+        self.stage = None #The name of the stage the job is currently in
+
+class OnboardingPipeline:
+
+    def __init__(self, max_workers=8):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.debug(f"Initializing OnboardingPipeline with {max_workers} workers...")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='onboarding')
+        self._stages: List[Tuple[str, Callable]] = []
+        self._jobs: Dict[str, asyncio.Task] = {} #{node: task}
+
+    def add_stage(self, name: str, func: Callable):
+        """
+        Appends a stage. func receives the OnboardingJob and should return False to stop the job.
+        """
+        self._stages.append((name, func))
+
+    def run_blocking(self, func, *args):
+        """
+        Runs a blocking call in the pipeline's worker pool. Meant for use inside coroutine stages.
+        """
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def submit(self, node: str) -> asyncio.Task:
+        """
+        Starts onboarding a device node. A node that is already being onboarded isn't started twice.
+        """
+        if node in self._jobs:
+            return self._jobs[node]
+        task = asyncio.get_event_loop().create_task(self._run(OnboardingJob(node)))
+        self._jobs[node] = task
+        task.add_done_callback(lambda t: self._job_done(node, t))
+        return task
+
+    def cancel(self, node: str) -> bool:
+        """
+        Stops onboarding a node, i.e. when it was removed mid-way. The stage already running in a worker will finish,
+        but its result is thrown away.
+        """
+        task = self._jobs.pop(node, None)
+        if task == None:
+            return False
+        task.cancel()
+        return True
+
+    async def _run(self, job: OnboardingJob):
+        for name, func in self._stages:
+            job.stage = name
+            if inspect.iscoroutinefunction(func):
+                result = await func(job)
+            else:
+                result = await self.run_blocking(func, job)
+            if result == False:
+                self.logger.debug(f"Onboarding of {job.node} stopped at stage '{name}'.")
+                return job
+        job.stage = None
+        self.logger.debug(f"Finished onboarding {job.node}.")
+        return job
+
+    def _job_done(self, node: str, task: asyncio.Task):
+        if self._jobs.get(node, None) is task:
+            del self._jobs[node]
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e != None:
+            self.logger.error(f"Error while onboarding {node}: {str(e)}")
+
+    def shutdown(self):
+        for node in list(self._jobs.keys()):
+            self.cancel(node)
+        self._executor.shutdown(wait=False)
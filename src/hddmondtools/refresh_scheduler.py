@@ -0,0 +1,181 @@
+import heapq
+import random
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Dict, List
+
+#
+#   The RefreshScheduler keeps the SMART data of every local drive fresh without refreshing them all at once. Each
+#   drive has its own deadline in a heap, and only a few refreshes run at a time.
+#
+#   Drives are put in a class each time they are scheduled, and each class has its own interval:
+#
+#       error       The drive's task queue is in error, or its SMART calls are failing. Refreshed most often.
+#       testing     A self-test is running. The SelfTestMonitor already polls the test, so attributes can wait longer.
+#       idle        Everything else.
+#
+#   When more drives are due than can be refreshed at once, error drives go first, then testing, then idle.
+#
+#   Deadlines are jittered, and a newly added drive's first deadline lands anywhere in its interval, so drives that
+#   were inserted together spread out instead of expiring together. Once per idle interval (a cycle) the scheduler
+#   logs how many refreshes it started, and how late they were.
+#
+
+class _Entry:
+    def __init__(self, hdd):
+        self.hdd = hdd
+        self.deadline = 0
+        self.priority = 'idle'
+        self.cancelled = False
+
+class RefreshScheduler:
+
+    priorities = ('error', 'testing', 'idle') #Most urgent first
+
+    def __init__(self, refresh: Callable[[object], Awaitable], classify: Callable[[object], str], intervals: Dict[str, float] = None, max_concurrent=4, jitter=0.1):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self._refresh = refresh
+        self._classify = classify
+        self.intervals = {'error': 15, 'testing': 300, 'idle': 30} #seconds
+        if intervals != None:
+            self.intervals.update(intervals)
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter #Fraction of the interval each deadline may move by
+        self._heap = [] #[(deadline, sequence, entry)]
+        self._entries: Dict[object, _Entry] = {} #{hdd: entry}
+        self._sequence = 0
+        self._running = 0
+        self._wakeup = None
+        self._task = None
+        self.last_lag = (0, 0) #(average, maximum) seconds of lag in the last cycle
+        self._cycle = [None, 0, 0.0, 0.0, 0] #[start, refreshes, total lag, max lag, most deferred at once]
+
+    def add(self, hdd):
+        if hdd in self._entries:
+            return
+        entry = _Entry(hdd)
+        entry.priority = self._classify_safe(hdd)
+        self._entries[hdd] = entry
+        loop = asyncio.get_event_loop()
+        self._push(entry, loop.time() + random.uniform(0, self.intervals[entry.priority]))
+
+    def remove(self, hdd):
+        entry = self._entries.pop(hdd, None)
+        if entry != None:
+            entry.cancelled = True #Its heap item is skipped when it comes up.
+
+    def refresh_soon(self, hdd):
+        """
+        Moves a drive's deadline to now, i.e. when its state changed and it should be reclassified.
+        """
+        entry = self._entries.get(hdd, None)
+        if entry == None:
+            return
+        entry.cancelled = True
+        fresh = _Entry(hdd)
+        fresh.priority = self._classify_safe(hdd)
+        self._entries[hdd] = fresh
+        self._push(fresh, asyncio.get_event_loop().time())
+
+    def reclassify(self, hdd):
+        """
+        Refreshes a drive soon if its priority class changed (i.e. a test started, or it went into error), so it doesn't
+        wait out a deadline set for its old class.
+        """
+        entry = self._entries.get(hdd, None)
+        if entry != None and self._classify_safe(hdd) != entry.priority:
+            self.refresh_soon(hdd)
+
+    def _classify_safe(self, hdd) -> str:
+        try:
+            priority = self._classify(hdd)
+        except Exception as e:
+            self.logger.warn(f"Couldn't classify {hdd}: {str(e)}")
+            priority = 'idle'
+        return priority if priority in self.intervals else 'idle'
+
+    def _push(self, entry: _Entry, deadline: float):
+        entry.deadline = deadline
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, entry))
+        if self._wakeup != None:
+            self._wakeup.set()
+
+    def _next_deadline(self, entry: _Entry) -> float:
+        interval = self.intervals[entry.priority]
+        # Following the old deadline rather than the time the refresh finished keeps drives spread out.
+        deadline = entry.deadline + interval * (1 + random.uniform(-self.jitter, self.jitter))
+        now = asyncio.get_event_loop().time()
+        if deadline < now: #We fell behind, don't try to catch up with a burst.
+            deadline = now + interval * random.uniform(0, self.jitter)
+        return deadline
+
+    def start(self):
+        if self._task == None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task != None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            due: List[_Entry] = []
+            now = loop.time()
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                _, _, entry = heapq.heappop(self._heap)
+                if not entry.cancelled:
+                    due.append(entry)
+
+            if len(due) > 0:
+                free = self.max_concurrent - self._running
+                due.sort(key=lambda e: (self.priorities.index(e.priority), e.deadline))
+                started, deferred = due[:max(0, free)], due[max(0, free):]
+                for entry in deferred: #They stay due, and go first when a slot frees up.
+                    self._sequence += 1
+                    heapq.heappush(self._heap, (entry.deadline, self._sequence, entry))
+                self._account(now, [now - e.deadline for e in started], len(deferred))
+                for entry in started:
+                    self._running += 1
+                    loop.create_task(self._do_refresh(entry))
+
+            self._wakeup.clear()
+            if len(self._heap) > 0 and self._running < self.max_concurrent:
+                delay = max(0, self._heap[0][0] - loop.time())
+            else:
+                delay = None #Wait for a refresh to finish, or for a drive to be added.
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _account(self, now: float, lags: List[float], deferred: int):
+        cycle = self._cycle
+        if cycle[0] == None:
+            cycle[0] = now
+        cycle[1] += len(lags)
+        cycle[2] += sum(lags)
+        cycle[3] = max([cycle[3]] + lags)
+        cycle[4] = max(cycle[4], deferred)
+        if now - cycle[0] >= self.intervals['idle']:
+            self.last_lag = (cycle[2] / cycle[1] if cycle[1] > 0 else 0, cycle[3])
+            self.logger.debug(f"Refreshed {cycle[1]} drive(s) in the last {now - cycle[0]:.0f}s, lag avg {self.last_lag[0]:.2f}s max {self.last_lag[1]:.2f}s, up to {cycle[4]} waiting for a slot.")
+            self._cycle = [now, 0, 0.0, 0.0, 0]
+
+    async def _do_refresh(self, entry: _Entry):
+        try:
+            await self._refresh(entry.hdd)
+        except Exception as e:
+            self.logger.warn(f"Exception raised during SMART refresh of {entry.hdd}: {str(e)}")
+        finally:
+            self._running -= 1
+            if not entry.cancelled:
+                entry.priority = self._classify_safe(entry.hdd)
+                self._push(entry, self._next_deadline(entry))
+            elif self._wakeup != None:
+                self._wakeup.set()
@@ -1,7 +1,6 @@
 import asyncio
 import threading
 import websockets
-import jsonpickle
 import logging
 
 from asyncio import AbstractEventLoop
@@ -9,14 +8,18 @@ from injectable import inject, injectable
 from typing import Coroutine, List
 from controllermodel import GenericControllerContext
 from websockets import WebSocketClientProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 from hddmondtools.apiinterface import ApiInterface
+from hddmondtools import ws_protocols
+from hddmondtools.ws_protocols import Codec
 from hddmontools.config_service import ConfigService
 
 
 class ClientDataMulticaster: #This is used to keep track of all clients connected, to allow multicasting. 
     def __init__(self):
         self._client_data = {} #{client: data[]}
+        self._client_codec = {} #{client: Codec}
     
     #TODO: Add async iterator for async message broadcasting.
     async def __aiter__(self):
@@ -26,26 +29,34 @@ class ClientDataMulticaster: #This is used to keep track of all clients connecte
     async def __anext__(self):
         raise StopAsyncIteration
 
-    def register_client(self, address):
+    def register_client(self, address, codec: Codec = ws_protocols.JSON):
         self._client_data.update({address: []})
+        self._client_codec.update({address: codec})
         return self._client_data[address]
 
-    async def broadcast(self, data):
+    async def broadcast(self, data, exclude=()):
+        encoded = {} #Encoded once for each codec in use
         for k in self._client_data.keys():
-            self._client_data[k].append(data)
+            if k not in exclude:
+                codec = self._client_codec.get(k, ws_protocols.JSON)
+                if codec.name not in encoded:
+                    encoded[codec.name] = codec.dumps(data)
+                self._client_data[k].append(encoded[codec.name])
 
     def unregister_client(self, address):
         #print("Unregistering websocket at " + str(address) + " from broadcast list")
         try:
             del self._client_data[address]
+            self._client_codec.pop(address, None)
         except KeyError:
             print("Error: Tried to delete a websocket that was never registered!")
             pass
 
 class WebsocketServerContext(GenericControllerContext):
-    def __init__(self, client_socket: WebSocketClientProtocol, message_queue: list):
+    def __init__(self, client_socket: WebSocketClientProtocol, message_queue: list, codec: Codec = ws_protocols.JSON):
         self.socket = client_socket
         self.message_queue = message_queue
+        self.codec = codec #How messages to and from the client are encoded
 
 @injectable(singleton=True)
 class WebsocketServer(ApiInterface):
@@ -65,9 +76,13 @@ class WebsocketServer(ApiInterface):
 
         cfg_svc = inject(ConfigService)
         self.port = cfg_svc.data["websocket_host"]["port"]
+        self.compression = cfg_svc.data["websocket_host"].get('compression', {}) #permessage-deflate settings
 
         self.clientlist = {} #{address: websocket, ...}
         self.clientdata_multicast = ClientDataMulticaster()
+        self.delta = None #The DeltaPublisher serving clients that subscribe in delta mode, if there is one
+        self.delta_clients = set() #Addresses of the clients in delta mode, they don't get full broadcasts
+        self.builtin_actions = {'subscribe': self.subscribe, 'resync': self.resync} #Actions about the connection itself
 
     async def register_client(self, websocket):
         self.clientlist.update({websocket.remote_address: websocket})
@@ -75,17 +90,51 @@ class WebsocketServer(ApiInterface):
     async def unregister_client(self, websocket_addr):
         del self.clientlist[websocket_addr]
         self.clientdata_multicast.unregister_client(websocket_addr)
+        self.delta_clients.discard(websocket_addr)
+        if self.delta != None:
+            self.delta.unsubscribe(websocket_addr)
+
+    async def subscribe(self, context: WebsocketServerContext, mode: str = 'full', **kw):
+        """
+        Chooses how the client gets updates. In 'full' mode (the default) every update carries whole objects. In 'delta'
+        mode the client gets a snapshot of every HDD first, then only the changes. See DeltaPublisher.
+        """
+        address = context.socket.remote_address
+        if mode == 'delta':
+            if self.delta == None:
+                return {'error': 'Delta updates are not available!'}
+            self.delta_clients.add(address)
+            await self.delta.subscribe(address, context.message_queue, context.codec.dumps)
+        elif mode == 'full':
+            self.delta_clients.discard(address)
+            if self.delta != None:
+                self.delta.unsubscribe(address)
+        else:
+            return {'error': 'Unknown subscription mode {0}'.format(mode)}
+        self.logger.debug(f"{address} subscribed to {mode} updates.")
+        return {'subscribed': mode}
+
+    async def resync(self, context: WebsocketServerContext, **kw):
+        """
+        Sends a delta client a fresh snapshot, i.e. after it missed a patch.
+        """
+        address = context.socket.remote_address
+        if self.delta == None or address not in self.delta_clients:
+            return {'error': 'Not subscribed to delta updates!'}
+        self.delta.resync(address)
+        return None
 
     async def consumer_handler(self, ws, path, data_list, *args, **kwargs):
         await self.register_client(ws)
-        context = WebsocketServerContext(ws, data_list)
+        codec = ws_protocols.codec_for(ws.subprotocol)
+        context = WebsocketServerContext(ws, data_list, codec)
         async for message in ws:
             m = {}
             try:
-                m = jsonpickle.loads(message)
+                m = codec.loads(message)
             except Exception:
                 self.logger.error("Error decoding message from " + str(ws.remote_address) + ". Message: " + str(message))
-                send = jsonpickle.dumps({"error": "Couldn't parse JSON data!"}, unpicklable=False, make_refs=False)
+                send = codec.dumps({"error": "Couldn't parse {0} data!".format('JSON' if codec == ws_protocols.JSON else codec.name)})
                 await ws.send(send)
             else:
                 if(m != None):
@@ -94,7 +143,10 @@ class WebsocketServer(ApiInterface):
 
                     if command != None:
                         try:
-                            r = self.find_action(str(command), _context=context, **data) #The main application will register functions to various commands. See if we can find one registered for the command sent.
+                            if str(command) in self.builtin_actions:
+                                r = self.builtin_actions[str(command)](context, **data)
+                            else:
+                                r = self.find_action(str(command), _context=context, **data) #The main application will register functions to various commands. See if we can find one registered for the command sent.
 
                             if isinstance(r, Coroutine):
                                 r = await r
@@ -102,14 +154,14 @@ class WebsocketServer(ApiInterface):
                             r = {"error": str(e)}
                         finally:
                             if r != None:
-                                r_json = jsonpickle.dumps(r, unpicklable=False, make_refs=False)
+                                r_json = codec.dumps(r)
                                 await ws.send(r_json) 
                     else:
-                        send = jsonpickle.dumps({"error": "No command to process!"}, unpicklable=False, make_refs=False)
+                        send = codec.dumps({"error": "No command to process!"})
                         await ws.send(send)
 
                 else:
-                    send = jsonpickle.dumps({"error": "No data to parse!"}, unpicklable=False, make_refs=False)
+                    send = codec.dumps({"error": "No data to parse!"})
                     await ws.send(send)
 
         await self.unregister_client(ws.remote_address)
@@ -122,8 +174,8 @@ class WebsocketServer(ApiInterface):
                 await ws.send(data_list.pop(0))
 
     async def handler(self, ws: WebSocketClientProtocol, path, *args, **kw):
-        self.logger.debug(f"New websocket client from {ws.remote_address}.")
-        data_list = self.clientdata_multicast.register_client(ws.remote_address)
+        self.logger.debug(f"New websocket client from {ws.remote_address}, speaking {ws.subprotocol or ws_protocols.JSON.name}.")
+        data_list = self.clientdata_multicast.register_client(ws.remote_address, ws_protocols.codec_for(ws.subprotocol))
         c_task = asyncio.ensure_future(self.consumer_handler(ws, path, data_list, *args, **kw))
         p_task = asyncio.ensure_future(self.producer_handler(ws, path, data_list, *args, **kw))
         done, pending = await asyncio.wait([c_task, p_task,], return_when=asyncio.FIRST_COMPLETED)
@@ -132,12 +184,31 @@ class WebsocketServer(ApiInterface):
             task.cancel() #Cancel any remaining task. 
 
     async def broadcast_data(self, data, *a, **kw):
-        data_s = jsonpickle.dumps(data, unpicklable=False, make_refs=False)
-        await self.clientdata_multicast.broadcast(data_s)
+        """
+        Sends data to every client in full mode.
+        """
+        if len(self.clientlist) <= len(self.delta_clients):
+            return #Nobody to send it to, don't bother encoding it.
+        await self.clientdata_multicast.broadcast(data, exclude=self.delta_clients)
 
     async def start(self):
         self.logger.info("Starting WebsocketServer...")
-        self.ws = await websockets.serve(self.handler, "0.0.0.0", self.port)
+        self.ws = await websockets.serve(self.handler, "0.0.0.0", self.port, subprotocols=ws_protocols.subprotocols(), **self._compression_args())
+
+    def _compression_args(self):
+
+        #   permessage-deflate, tuned from websocket_host.compression. A larger window and memory level compress the big
+        #   snapshot frames better, keeping the context between messages helps with the many similar small ones.
+
+        c = self.compression
+        if not c.get('enabled', True):
+            return {'compression': None}
+        factory = ServerPerMessageDeflateFactory(
+            server_no_context_takeover=not c.get('context_takeover', True),
+            server_max_window_bits=c.get('max_window_bits', 15),
+            compress_settings={'level': c.get('level', 6), 'memLevel': c.get('mem_level', 8)},
+        )
+        return {'compression': 'deflate', 'extensions': [factory]}
 
     async def stop(self):
         self.logger.info("Stopping WebsocketServer...")
@@ -0,0 +1,77 @@
+import logging
+import jsonpickle
+
+from typing import Any, Dict, List, Optional, Union
+
+from hddmondtools import fast_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+#
+#   The encodings a websocket client can ask for, through the Sec-WebSocket-Protocol header:
+#
+#       hddmon.json     Text frames of JSON. What clients get when they don't ask for anything.
+#       hddmon.msgpack  Binary frames of MessagePack, if the msgpack package is installed.
+#       hddmon.cbor     Binary frames of CBOR, if the cbor2 package is installed.
+#
+#   Every encoding carries the same messages: {command, data} from the client, and the same replies and updates from
+#   us. The binary ones are built from the same plain form as the JSON (see fast_json.to_plain()), so a client sees
+#   the same fields whichever it picks. They are smaller, and quicker to parse on both ends for the big SMART tables.
+#
+
+class Codec:
+
+    name = 'hddmon.json'
+    binary = False
+
+    def dumps(self, obj) -> Union[str, bytes]:
+        return fast_json.dumps(obj)
+
+    def loads(self, message: Union[str, bytes]) -> Any:
+        return jsonpickle.loads(message)
+
+class MsgpackCodec(Codec):
+
+    name = 'hddmon.msgpack'
+    binary = True
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(fast_json.to_plain(obj), use_bin_type=True)
+
+    def loads(self, message: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(message, raw=False)
+
+class CborCodec(Codec):
+
+    name = 'hddmon.cbor'
+    binary = True
+
+    def dumps(self, obj) -> bytes:
+        return cbor2.dumps(fast_json.to_plain(obj))
+
+    def loads(self, message: Union[str, bytes]) -> Any:
+        return cbor2.loads(message)
+
+JSON = Codec()
+
+CODECS: Dict[str, Codec] = {JSON.name: JSON} #{subprotocol: codec} of the encodings we can offer
+if msgpack != None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 != None:
+    CODECS[CborCodec.name] = CborCodec()
+
+def subprotocols() -> List[str]:
+    """
+    The subprotocols to offer, the binary ones first. A client that offers several gets the first one both know.
+    """
+    return sorted(CODECS.keys(), key=lambda name: not CODECS[name].binary)
+
+def codec_for(subprotocol: Optional[str]) -> Codec:
+    return CODECS.get(subprotocol, JSON)
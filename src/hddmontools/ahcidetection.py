@@ -2,14 +2,31 @@ import subprocess
 import logging
 
 from hddmontools.pciaddress import PciAddress
-from injectable import injectable
+from hddmontools.pcitopology import PciTopology
+from injectable import injectable, inject
 
 class AhciDevice():
     def __init__(self):
         self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
         self.logger.setLevel(logging.DEBUG)
         self.PciAddress = None
+        self.PciAddresses = set() #Every AHCI controller, in case there is more than one
         self.logger.debug("Initializing AhciDevice...")
+
+        topology = inject(PciTopology)
+        if topology.available:
+            controllers = topology.DevicesForDriver('ahci')
+            self.PciAddresses = set(controllers)
+            if len(controllers) > 0:
+                self.PciAddress = controllers[0]
+                self.logger.debug(f"Found AHCI controller(s) {', '.join(str(c) for c in controllers)}.")
+            else:
+                self.logger.warn("No AHCI device found! Native motherboard port detection will not work.")
+        else:
+            self.logger.warn("Can't read PCI drivers from sysfs. Falling back to dmesg for the AHCI controller.")
+            self._parse_dmesg()
+
+    def _parse_dmesg(self):
         dmesg = subprocess.run(['dmesg'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
         if dmesg.returncode == 0:
             self.logger.debug("Parsing dmesg...")
@@ -40,6 +57,7 @@ class AhciDevice():
                 fun = str(devfun[1])
 
                 self.PciAddress = PciAddress(seg,bus,dev,fun)
+                self.PciAddresses = {self.PciAddress}
             else:
                 self.logger.warn("No AHCI device found! Native motherboard port detection will not work.")
         else:
@@ -22,10 +22,70 @@ class ConfigService:
                 'password': None,
             },
             'websocket_host': {
-                'port': 8765
+                'port': 8765,
+                'delta_interval': 5,
+                'delta_max_pending': 64,
+                'compression': {
+                    'enabled': True,
+                    'level': 6,
+                    'mem_level': 8,
+                    'max_window_bits': 15,
+                    'context_takeover': True,
+                },
             },
             'hddmon_remote_host': {
                 'port': 56567
+            },
+            'detection': {
+                'method': 'uevent',
+                'debounce': 1.5,
+                'max_delay': 10
+            },
+            'onboarding': {
+                'max_workers': 8
+            },
+            'smart': {
+                'cache_ttl': 30,
+                'timeout': 60,
+                'breaker_threshold': 3,
+                'backoff_min': 60,
+                'backoff_max': 3600,
+                'sgio': False
+            },
+            'selftest': {
+                'min_interval': 5,
+                'max_interval': 300,
+                'max_errors': 5
+            },
+            'refresh': {
+                'idle_interval': 30,
+                'error_interval': 15,
+                'testing_interval': 300,
+                'max_concurrent': 4,
+                'jitter': 0.1
+            },
+            'erase': {
+                'passes': ['ff'],
+                'chunk_size': 4194304,
+                'checkpoint_interval': 30,
+                'journal_dir': '/var/lib/hddmond/erase'
+            },
+            'verify': {
+                'max_ranges': 100,
+                'confidence': 0.99,
+                'defect_rate': 0.001,
+                'sample_size': 1048576,
+                'zones': 64,
+                'workers': 4
+            },
+            'io': {
+                'max_concurrent': 0,
+                'bandwidth': 0,
+                'controllers': {},
+                'cgroup': '/sys/fs/cgroup/hddmond'
+            },
+            'events': {
+                'progress_rate': 2
             }
         }
         self._path = (Path(__file__).parent / '../config/config.json').resolve()
@@ -0,0 +1,138 @@
+from hddmontools.hdd_detector import HddDetector
+
+import asyncio
+import logging
+
+from typing import Dict, List
+
+#
+#   The CoalescingDetector sits between a real HddDetector and whoever listens to it. Hot-plug storms (a tray of drives
+#   being inserted, an HBA reset) produce bursts of add/remove flaps, so events are held until the detector has been
+#   quiet for a moment, then merged per node and serial and delivered as one batch.
+#
+#   A batch is a list of dicts with the keys 'action', 'serial', 'node' and 'old_node'. Actions are:
+#
+#       add             A device appeared on node.
+#       remove          A device disappeared from node.
+#       reenumerated    The same device (by serial) went away and came back, on node. old_node is where it was before,
+#                       which may be the same as node.
+#
+
+class CoalescingDetector(HddDetector):
+
+    def __init__(self, detector: HddDetector, debounce=1.5, max_delay=10):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.info(f"Initializing CoalescingDetector around {detector.__class__.__qualname__}...")
+        self.detector = detector
+        self.detector.add_change_callback(self._on_change)
+        self._debounce = debounce #seconds of quiet before a batch is delivered
+        self._max_delay = max_delay #seconds a batch may be held back during a continuous storm
+        self._pending = []
+        self._first_event = None
+        self._flush_handle = None
+        self._callbacks = []
+        self._batch_callbacks = []
+
+    async def start(self):
+        await self.detector.start()
+
+    async def stop(self):
+        await self.detector.stop()
+        if self._flush_handle != None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending.clear()
+        self._first_event = None
+
+    def add_change_callback(self, callback):
+        """
+        Registers a callback that is called once per coalesced event, with kwargs 'action': 'add'|'remove', 'serial' and
+        'node', like any other HddDetector. Re-enumerations on a new node are delivered as a remove and an add.
+        """
+        self._callbacks.append(callback)
+
+    def add_batch_callback(self, callback):
+        """
+        Registers a callback that is called with the whole list of coalesced events at once.
+        """
+        self._batch_callbacks.append(callback)
+
+    def _on_change(self, action: str, serial: str, node: str, **kw):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        self._pending.append({'action': action, 'serial': serial, 'node': node})
+        if self._first_event == None:
+            self._first_event = now
+        if self._flush_handle != None:
+            self._flush_handle.cancel()
+        delay = min(self._debounce, max(0, self._first_event + self._max_delay - now))
+        self._flush_handle = loop.call_later(delay, self._flush)
+
+    def _flush(self):
+        events = CoalescingDetector.coalesce(self._pending)
+        raw = len(self._pending)
+        self._pending = []
+        self._first_event = None
+        self._flush_handle = None
+        if len(events) <= 0:
+            self.logger.debug(f"{raw} device events cancelled each other out.")
+            return
+        self.logger.info(f"Delivering {len(events)} device changes coalesced from {raw} events.")
+
+        for c in self._batch_callbacks:
+            if callable(c):
+                c(events)
+
+        for e in events:
+            if e['action'] == 'reenumerated':
+                if e['old_node'] == e['node']:
+                    continue #Nothing changed from the point of view of a single-event listener.
+                self._do_callback('remove', e['serial'], e['old_node'])
+                self._do_callback('add', e['serial'], e['node'])
+            else:
+                self._do_callback(e['action'], e['serial'], e['node'])
+
+    def _do_callback(self, action, serial, node):
+        for c in self._callbacks:
+            if callable(c):
+                c(action=action, serial=serial, node=node)
+
+    @staticmethod
+    def coalesce(events: List[Dict]) -> List[Dict]:
+        """
+        Merges an ordered list of raw add/remove events into their net effect.
+        """
+        per_node = {} #{node: [first event, last event]}
+        for e in events:
+            if e['node'] in per_node:
+                per_node[e['node']][1] = e
+            else:
+                per_node[e['node']] = [e, e]
+
+        adds = []
+        removes = []
+        reenumerated = []
+        for node, (first, last) in per_node.items():
+            if first['action'] == 'add' and last['action'] == 'add':
+                adds.append({'action': 'add', 'serial': last['serial'], 'node': node, 'old_node': None})
+            elif first['action'] == 'remove' and last['action'] == 'remove':
+                removes.append({'action': 'remove', 'serial': first['serial'], 'node': node, 'old_node': None})
+            elif first['action'] == 'remove' and last['action'] == 'add':
+                if first['serial'] != None and first['serial'] == last['serial']:
+                    reenumerated.append({'action': 'reenumerated', 'serial': last['serial'], 'node': node, 'old_node': node})
+                else: #A different drive was swapped in on the same node.
+                    removes.append({'action': 'remove', 'serial': first['serial'], 'node': node, 'old_node': None})
+                    adds.append({'action': 'add', 'serial': last['serial'], 'node': node, 'old_node': None})
+            #else: added then removed, it was never really here.
+
+        #A drive that disappeared from one node and showed up on another was re-enumerated.
+        removed_by_serial = {r['serial']: r for r in removes if r['serial'] != None}
+        for a in adds.copy():
+            r = removed_by_serial.pop(a['serial'], None)
+            if r != None:
+                removes.remove(r)
+                adds.remove(a)
+                reenumerated.append({'action': 'reenumerated', 'serial': a['serial'], 'node': a['node'], 'old_node': r['node']})
+
+        return removes + reenumerated + adds
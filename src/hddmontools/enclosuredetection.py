@@ -0,0 +1,125 @@
+import os
+import re
+import logging
+
+from pathlib import Path
+from typing import Dict, Optional
+from injectable import injectable
+
+#
+#   The EnclosureDetective finds the slot a drive sits in straight from sysfs, without running any controller
+#   utilities. It looks, in order, at:
+#
+#       1. The SES enclosure class (/sys/class/enclosure/<enclosure>/<component>/device), for drives in a backplane
+#          with an enclosure processor.
+#       2. The bay_identifier of the SAS end device (/sys/class/sas_device/end_device-*/), for expanders that report bays.
+#       3. The phy number of the HBA port the end device hangs off of (/sys/class/sas_phy/phy-*/phy_identifier), for
+#          drives cabled directly to the HBA.
+#
+#   The sysfs root can be changed so all of this can be pointed at a fake sysfs tree.
+#
+
+@injectable(singleton=True)
+class EnclosureDetective():
+
+    _component_number = re.compile(r'(\d+)\s*$')
+    _end_device = re.compile(r'^end_device-[\d:]+$')
+    _port = re.compile(r'^port-[\d:]+$')
+
+    def __init__(self, sysfs_root='/sys'):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.debug("Initializing EnclosureDetective...")
+        self._root = Path(sysfs_root)
+        self._slots = None #{real path of the SCSI device: slot}
+
+    def _path(self, syspath) -> Path:
+        """
+        Translates an absolute /sys/... path into our sysfs root.
+        """
+        syspath = str(syspath)
+        if syspath.startswith('/sys/'):
+            return self._root / syspath[len('/sys/'):]
+        return Path(syspath)
+
+    def _read_int(self, path: Path) -> Optional[int]:
+        try:
+            return int(path.read_text().strip(), 0)
+        except (OSError, ValueError):
+            return None
+
+    def Update(self):
+        """
+        Forgets the enclosure slot map. It is rebuilt on the next lookup.
+        """
+        self._slots = None
+
+    def _build_slot_map(self) -> Dict[str, int]:
+        slots = {}
+        enclosures = self._root / 'class' / 'enclosure'
+        try:
+            enclosure_list = list(enclosures.iterdir())
+        except OSError:
+            return slots
+
+        for enclosure in enclosure_list:
+            try:
+                components = list(enclosure.iterdir())
+            except OSError:
+                continue
+            for component in components:
+                device = component / 'device'
+                if not device.is_symlink():
+                    continue #Empty slot, or one of the enclosure's own attributes.
+                slot = self._read_int(component / 'slot') #Only newer kernels have this.
+                if slot == None:
+                    m = self._component_number.search(component.name) #"Slot 01", "Disk001", "ArrayDevice05", "3"...
+                    if m == None:
+                        continue
+                    slot = int(m.group(1))
+                slots[os.path.realpath(device)] = slot
+        self.logger.debug(f"Found {len(slots)} occupied enclosure slots.")
+        return slots
+
+    def GetSlotFromSysPath(self, syspath) -> Optional[int]:
+
+#     0    1     2        3           4             5        6       7          8             9         10      11   12
+#EX:    '/sys/devices/pci0000:00/0000:00:01.0/0000:01:00.0/host0/port-0:3/end_device-0:3/target0:0:3/0:0:3:0/block/sdc'
+
+        cols = str(syspath).split('/')
+        if 'block' not in cols:
+            return None
+        scsi_device = self._path('/'.join(cols[:cols.index('block')]))
+
+        if self._slots == None:
+            self._slots = self._build_slot_map()
+        slot = self._slots.get(os.path.realpath(scsi_device), None)
+        if slot != None:
+            self.logger.debug(f"Found {syspath} in enclosure slot {slot}.")
+            return slot
+
+        end_devices = [c for c in cols if self._end_device.match(c)]
+        if len(end_devices) <= 0:
+            return None #Not a SAS attached drive.
+        end_device = end_devices[-1]
+
+        bay = self._read_int(self._root / 'class' / 'sas_device' / end_device / 'bay_identifier')
+        if bay != None and bay >= 0:
+            self.logger.debug(f"Found {syspath} in bay {bay}.")
+            return bay
+
+        # A drive cabled straight to the HBA has exactly one port between the host and itself, with one phy in it.
+        ports = [c for c in cols if self._port.match(c)]
+        if len(ports) != 1:
+            return None
+        port = self._path('/'.join(cols[:cols.index(ports[0]) + 1]))
+        try:
+            phys = [p.name for p in port.iterdir() if p.name.startswith('phy-')]
+        except OSError:
+            return None
+        if len(phys) != 1:
+            return None
+        phy = self._read_int(self._root / 'class' / 'sas_phy' / phys[0] / 'phy_identifier')
+        if phy != None:
+            self.logger.debug(f"Found {syspath} on HBA phy {phy}.")
+        return phy
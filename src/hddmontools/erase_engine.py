@@ -0,0 +1,231 @@
+import os
+import mmap
+import fcntl
+import array
+import errno
+import logging
+import threading
+import time
+
+from typing import Callable, List, Optional
+
+#
+#   The EraseEngine overwrites a block device from inside the daemon. It runs on its own thread per drive and writes
+#   large O_DIRECT chunks straight out of one page-aligned mmap buffer that holds the pattern, so nothing is copied or
+#   allocated per write and the page cache is left alone. Progress is the exact number of bytes written.
+#
+#   A pass is a pattern: a hex string of 1, 2, 4, ... bytes ('ff', '00', '55aa') repeated over the whole device, or
+#   'random' for a buffer of random bytes (refilled every pass). Passes run one after another. A pattern's length
+#   divides the sector size, so every sector holds the pattern from its first byte and can be checked on its own.
+#
+#   Given a checkpoint_callback, the engine flushes the drive every checkpoint_interval seconds, and when it stops
+#   early, then reports how far it durably got. run() can start from any such point.
+#
+#   Given a ControllerBudget (see io_scheduler.py), the engine waits for its turn on the controller before it starts,
+#   and takes every chunk's bytes from the controller's bandwidth before writing it.
+#
+
+BLKGETSIZE64 = 0x80081272
+BLKSSZGET = 0x1268
+
+class EraseError(Exception):
+    pass
+
+class EraseAborted(EraseError):
+    pass
+
+def parse_pattern(pattern: str) -> Optional[bytes]:
+    """
+    Turns a pass description into the bytes it repeats, or None for a random pass.
+    """
+    pattern = str(pattern).strip().lower()
+    if pattern == 'random':
+        return None
+    if pattern.startswith('0x'):
+        pattern = pattern[2:]
+    try:
+        b = bytes.fromhex(pattern)
+    except ValueError:
+        raise EraseError(f"'{pattern}' isn't a hex pattern or 'random'")
+    if len(b) <= 0 or 512 % len(b) != 0:
+        raise EraseError(f"An erase pattern has to be 1, 2, 4, ... or 512 bytes long, not {len(b)}")
+    return b
+
+def describe_pattern(pattern: str) -> str:
+    p = parse_pattern(pattern)
+    return "random data" if p == None else "0x" + p.hex().upper()
+
+def fill_pattern(buf, pattern: Optional[bytes]):
+    """
+    Fills a buffer with a pattern from parse_pattern().
+    """
+    if pattern == None:
+        buf[:] = os.urandom(len(buf))
+        return
+    buf[:len(pattern)] = pattern
+    filled = len(pattern)
+    while filled < len(buf): #Doubling copies, so filling takes log(n) steps.
+        n = min(filled, len(buf) - filled)
+        buf[filled:filled + n] = buf[:n]
+        filled += n
+
+def device_size(fd: int) -> int:
+    buf = array.array('Q', [0])
+    try:
+        fcntl.ioctl(fd, BLKGETSIZE64, buf, True)
+    except OSError as e:
+        if e.errno != errno.ENOTTY:
+            raise
+        return os.lseek(fd, 0, os.SEEK_END) #Not a block device, i.e. an image file.
+    return buf[0]
+
+def logical_block_size(fd: int) -> int:
+    buf = array.array('i', [0])
+    try:
+        fcntl.ioctl(fd, BLKSSZGET, buf, True)
+    except OSError as e:
+        if e.errno != errno.ENOTTY:
+            raise
+        return 512
+    return buf[0]
+
+class EraseEngine:
+
+    def __init__(self, node: str, passes: List[str] = ['ff'], chunk_size: int = 4 * 1024 * 1024, progress_callback: Callable[[int, int], None] = None,
+                 checkpoint_callback: Callable[['EraseEngine'], None] = None, checkpoint_interval: float = 30, budget=None):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__ + f'[{node}]')
+        self.logger.setLevel(logging.DEBUG)
+        self.node = node
+        self.passes = list(passes)
+        self.patterns = [parse_pattern(p) for p in self.passes] #Fails early on a bad pattern
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback #Called from the engine's thread with (bytes done, total bytes)
+        self.checkpoint_callback = checkpoint_callback #Called from the engine's thread once pass_index/offset are durable
+        self.checkpoint_interval = checkpoint_interval #seconds
+        self.budget = budget #The controller's ControllerBudget, if it has one
+        self.size = None #Bytes per pass, known once the device is opened
+        self.sector_size = None
+        self.pass_index = 0
+        self.offset = 0 #Bytes written in the current pass
+        self.direct = True #Whether the device took O_DIRECT
+        self.error = None
+        self._abort = threading.Event()
+        self._thread = None
+
+    @property
+    def total_bytes(self) -> Optional[int]:
+        return None if self.size == None else self.size * len(self.passes)
+
+    @property
+    def bytes_done(self) -> int:
+        return (self.size or 0) * self.pass_index + self.offset
+
+    @property
+    def running(self) -> bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def start(self, done_callback: Callable[['EraseEngine'], None] = None, start_pass=0, start_offset=0, expected_size=None):
+        """
+        Starts erasing on a dedicated thread. done_callback is called from that thread when the engine stops, with
+        error set if it failed or was aborted.
+        """
+        def target():
+            try:
+                self.run(start_pass, start_offset, expected_size)
+            except Exception as e:
+                self.error = e
+            if done_callback != None:
+                done_callback(self)
+        self._thread = threading.Thread(target=target, name=f"{self.node}_erase", daemon=True)
+        self._thread.start()
+
+    def abort(self):
+        self._abort.set()
+
+    def _open(self) -> int:
+        try:
+            return os.open(self.node, os.O_WRONLY | os.O_DIRECT | os.O_EXCL)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+        self.logger.warn("The device doesn't take O_DIRECT, falling back to buffered writes.")
+        self.direct = False
+        return os.open(self.node, os.O_WRONLY | os.O_EXCL)
+
+    def _checkpoint(self, fd: int, flush=True):
+        if flush:
+            os.fsync(fd) #O_DIRECT skips our cache, not the drive's.
+        try:
+            self.checkpoint_callback(self)
+        except Exception as e:
+            self.logger.warn(f"Couldn't checkpoint the erase at byte {self.bytes_done}: {str(e)}") #Not worth stopping the erase for.
+
+    def run(self, start_pass=0, start_offset=0, expected_size=None):
+        """
+        Erases the device on the calling thread. Resumes from start_pass/start_offset if given, unless the device isn't
+        expected_size bytes anymore.
+        """
+        if self.budget != None and not self.budget.acquire(self._abort):
+            raise EraseAborted("Aborted while waiting for the controller")
+        try:
+            self._run(start_pass, start_offset, expected_size)
+        finally:
+            if self.budget != None:
+                self.budget.release()
+
+    def _run(self, start_pass, start_offset, expected_size):
+        fd = self._open()
+        buf = None
+        try:
+            self.size = device_size(fd)
+            sector = self.sector_size = logical_block_size(fd)
+            chunk = max(sector, self.chunk_size - self.chunk_size % sector)
+            buf = mmap.mmap(-1, chunk) #Anonymous mappings are page aligned, as O_DIRECT wants.
+            view = memoryview(buf)
+            if expected_size != None and expected_size != self.size:
+                self.logger.warn(f"The device is {self.size} bytes, not {expected_size} as checkpointed. Starting over.")
+                start_pass, start_offset = 0, 0
+            self.pass_index = start_pass
+            self.offset = start_offset - start_offset % sector
+            last_checkpoint = time.monotonic()
+            self.logger.info(f"Erasing {self.size} bytes in {len(self.passes) - start_pass} pass(es) of {chunk} byte writes" + (f", resuming at {self.offset}" if self.offset > 0 else '') + ".")
+
+            while self.pass_index < len(self.patterns):
+                fill_pattern(buf, self.patterns[self.pass_index])
+                while self.offset < self.size:
+                    if self._abort.is_set():
+                        raise EraseAborted(f"Aborted at byte {self.bytes_done}")
+                    n = min(chunk, self.size - self.offset)
+                    if self.budget != None:
+                        self.budget.consume(n, self._abort)
+                    try:
+                        written = os.pwrite(fd, view[:n], self.offset)
+                    except OSError as e:
+                        raise EraseError(f"Write failed at byte {self.offset} of pass {self.pass_index + 1}: {os.strerror(e.errno)}")
+                    if written <= 0:
+                        raise EraseError(f"The device stopped taking writes at byte {self.offset} of pass {self.pass_index + 1}")
+                    self.offset += written - written % sector #A short write is retried from the last whole sector.
+                    if self.progress_callback != None:
+                        self.progress_callback(self.bytes_done, self.total_bytes)
+                    if self.checkpoint_callback != None and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        self._checkpoint(fd)
+                        last_checkpoint = time.monotonic()
+                os.fsync(fd) #Nothing of this pass may linger in a cache when we call it done.
+                self.pass_index += 1
+                if self.pass_index < len(self.patterns):
+                    self.offset = 0
+                    if self.checkpoint_callback != None:
+                        self._checkpoint(fd, flush=False) #Already flushed
+                        last_checkpoint = time.monotonic()
+        except EraseError:
+            if self.checkpoint_callback != None and self.size != None:
+                try:
+                    self._checkpoint(fd) #Keep what was written before stopping.
+                except Exception as e:
+                    self.logger.warn(f"Couldn't checkpoint the erase: {str(e)}")
+            raise
+        finally:
+            if buf != None:
+                view.release()
+                buf.close()
+            os.close(fd)
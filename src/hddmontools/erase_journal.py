@@ -0,0 +1,97 @@
+import os
+import re
+import json
+import datetime
+import logging
+
+from dataclasses import dataclass, asdict, field
+from typing import List, Optional
+from injectable import injectable, inject
+
+from hddmontools.config_service import ConfigService
+
+#
+#   The EraseJournal remembers how far each erase got, so an erase that was interrupted by a restart or a disconnect
+#   can pick up where it left off. There is one small JSON file per drive, named after its serial and WWN, and each
+#   checkpoint replaces it atomically (write, fsync, rename), so a crash leaves either the old or the new checkpoint.
+#
+#   The engine flushes the drive before every checkpoint, so everything a checkpoint says was written really is on
+#   the platters. Writing is sequential, so a pass's completed range is always [0, completed_lba).
+#
+
+@dataclass
+class EraseCheckpoint:
+    serial: str
+    wwn: str
+    size: int #bytes
+    sector_size: int
+    passes: List[str]
+    pass_index: int = 0 #The pass in progress
+    completed_lba: int = 0 #Sectors [0, completed_lba) of the pass in progress are written
+    updated: str = field(default_factory=lambda: datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+    @property
+    def offset(self) -> int:
+        return self.completed_lba * self.sector_size
+
+    @property
+    def progress(self) -> int:
+        total = self.size * len(self.passes)
+        return int((self.size * self.pass_index + self.offset) * 100 / total) if total > 0 else 0
+
+@injectable(singleton=True)
+class EraseJournal:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        cfg = inject(ConfigService).data.get('erase', {})
+        self.path = cfg.get('journal_dir', '/var/lib/hddmond/erase')
+
+    @staticmethod
+    def key(serial: str, wwn: str) -> str:
+        return re.sub(r'[^A-Za-z0-9._-]', '_', f"{serial}_{wwn or 'nowwn'}")
+
+    def _file(self, serial: str, wwn: str) -> str:
+        return os.path.join(self.path, EraseJournal.key(serial, wwn) + '.json')
+
+    def load(self, serial: str, wwn: str, size: int = None) -> Optional[EraseCheckpoint]:
+        """
+        Returns the checkpoint of an unfinished erase of this drive, if there is one. With a size, a checkpoint for a
+        drive of another size (same serial, different device) is ignored.
+        """
+        try:
+            with open(self._file(serial, wwn), 'r') as fd:
+                c = EraseCheckpoint(**json.load(fd))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            self.logger.warn(f"Couldn't read the erase checkpoint of {serial}: {str(e)}")
+            return None
+        if c.serial != serial or c.wwn != wwn or (size != None and c.size != size):
+            return None
+        return c
+
+    def save(self, checkpoint: EraseCheckpoint):
+        checkpoint.updated = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        path = self._file(checkpoint.serial, checkpoint.wwn)
+        tmp = path + '.tmp'
+        os.makedirs(self.path, exist_ok=True)
+        with open(tmp, 'w') as fd:
+            json.dump(asdict(checkpoint), fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, path)
+        dirfd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dirfd) #Makes the rename itself durable.
+        finally:
+            os.close(dirfd)
+
+    def clear(self, serial: str, wwn: str):
+        try:
+            os.remove(self._file(serial, wwn))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warn(f"Couldn't remove the erase checkpoint of {serial}: {str(e)}")
@@ -1,21 +1,29 @@
 import pyudev
 import pySMART
 import time
+import asyncio
 import subprocess
 import datetime
 import enum
 import logging
 
 from injectable import inject
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from hddmontools.task_service import TaskService
 from hddmontools.test import Test
-from hddmontools.task import Task, TaskQueue, ExternalTask
+from hddmontools.task import Task, TaskQueue, ExternalTask, EraseTask
 from hddmontools.portdetection import PortDetection
 from hddmontools.notes import Notes
 from hddmontools.hdd_interface import HddInterface, TaskQueueInterface
+from hddmontools.smart_cache import SmartSnapshotCache
+from hddmontools.smartctl_client import SmartctlClient, SmartctlUnsupported, SmartctlError
+from hddmontools.smart_guard import SmartGuard
+from hddmontools.sgio_smart import SgioSmartReader, SgioError, SgioUnsupported
+from hddmontools.config_service import ConfigService
+from hddmontools.erase_journal import EraseJournal
 from hddmondtools.hddmon_dataclasses import SmartData
+from hddmondtools.hdd_snapshot import HddSnapshot
 
 #
 #   This file holds the class definition for Hdd. Hdd holds all of the information about a hard-drive (or solid-state drive) in the system.  
@@ -47,6 +55,13 @@ class Hdd(HddInterface):
         """
         return self._model
 
+    @property
+    def pci_address(self):
+        """
+        Returns the PCI address of the controller the device is attached to, if it was found
+        """
+        return self._pci_address
+
     @property
     def wwn(self) -> str:
         """
@@ -102,6 +117,7 @@ class Hdd(HddInterface):
         Sets how many times this drive has been seen
         """
         self._seen = value
+        HddSnapshot.mark(self, 'identity')
 
     @property
     def notes(self):
@@ -113,10 +129,32 @@ class Hdd(HddInterface):
     @property
     def smart_data(self) -> SmartData:
         """
-        The smart_data object
+        The smart_data object. This is a cached snapshot, refreshed when it is older than the configured freshness window.
+        A degraded drive only gets the last snapshot, reading it again could hang. So does a drive whose refresh fails.
         """
-        self.update_smart()
-        return SmartData.FromSmartDev(self._smart)
+        if self.degraded and self._smart_cache.peek() != None:
+            return self._smart_cache.peek()
+        try:
+            return self._smart_cache.get()
+        except SmartctlError as e:
+            if self._smart_cache.peek() == None:
+                raise
+            self.logger.warn(f"Couldn't refresh SMART data, using the last snapshot: {str(e)}")
+            return self._smart_cache.peek()
+
+    @property
+    def degraded(self) -> bool:
+        """
+        True while SMART calls to the drive keep failing or timing out, and are being held off.
+        """
+        return inject(SmartGuard).degraded(self.node)
+
+    @property
+    def smart_cache(self) -> SmartSnapshotCache:
+        """
+        The cache holding the SMART snapshot for the device
+        """
+        return self._smart_cache
         
     @property
     def locality(self) -> str:
@@ -134,6 +172,8 @@ class Hdd(HddInterface):
         # Remove the unpicklable entries. Udev referres to CDLL which won't pickle.
         state['_udev'] = None
         state['_task_changed_callbacks'] = None
+        state['_smart_cache'] = None # Locks won't pickle.
+        state['_data_snapshot'] = None
         return state
 
     def __setstate__(self, state):
@@ -141,10 +181,12 @@ class Hdd(HddInterface):
         self.__dict__.update(state)
         # Restore the udev link
         self._udev = pyudev.Devices.from_device_file(pyudev.Context(), self.node)
+        self._smart_cache = self._make_smart_cache()
 
-    def __init__(self, node: str):
+    def __init__(self, node: str, locate_port=True):
         '''
         Create a hdd object from its symlink node '/dev/sd?'
+        If locate_port is False, the port is left as None until locate_port() is called.
         '''
         self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__ + f'[{node}]')
         self.logger.setLevel(logging.DEBUG)
@@ -158,21 +200,13 @@ class Hdd(HddInterface):
         self._udev = pyudev.Devices.from_device_file(pyudev.Context(), node)
         self._task_changed_callbacks = []
         self.logger.debug("Getting SMART device context...")
-        self._smart = pySMART.Device(self.node)
+        self._smart = inject(SmartGuard).call_sync(self.node, pySMART.Device, self.node) #Probes the drive, so a hung one can't hold up an onboarding worker for good.
         self._port = None
         self._TaskQueue = TaskQueue(continue_on_error=False, task_change_callback=self._task_changed)
         self._size = self._smart.capacity
         self._pci_address = None
         self._notes = Notes()
         self._seen = 0
-        self.logger.debug("Trying to get PCI and port...")
-        port_detector = inject(PortDetection)
-        port_detector.Update()
-        self._pci_address = port_detector.GetPci(self._udev.sys_path)
-        self.logger.debug(f"Got PCI as {self._pci_address}.")
-        self._port = port_detector.GetPort(self._udev.sys_path, self._pci_address, self.serial)
-        self.logger.debug(f"Got port as {self._port}.")
-
         try:
             sizeunit = self._smart.capacity.split()
             unit = sizeunit[1]
@@ -190,6 +224,9 @@ class Hdd(HddInterface):
             self.logger.error("Exception occurred while parsing capacity of drive " + self.serial + f". This drive may not function properly. {str(e)}")
 
         self._smart_last_call = time.time()
+        self._sgio = inject(SgioSmartReader).enabled #Read SMART in-process, until the drive turns out not to support it
+        self._smart_cache = self._make_smart_cache()
+        self._smart_cache.seed(SmartData.FromSmartDev(self._smart)) #We just probed the drive, no need to do it again right away.
         self._medium = None #SSD or HDD
 
         #Check interface
@@ -204,11 +241,30 @@ class Hdd(HddInterface):
             self._serial = "Unknown HDD"
             self._model = ""
             #Idk where we go from here
+        self._wwn = str(self._udev.properties.get('ID_WWN_WITH_EXTENSION', self._udev.properties.get('ID_WWN', '')))
         self.logger.debug(f"My serial is {self._serial}.")
+        checkpoint = inject(EraseJournal).load(self._serial, self._wwn)
+        if checkpoint != None:
+            self.logger.info(f"An erase of this drive was interrupted at {checkpoint.progress}%. It can be resumed.")
         n = 'n' if self._medium == "" else ''
         med = self._medium if self._medium != "" else "unknown medium"
         self.logger.debug(f"I am a{n} {med}.")
-        
+
+        if locate_port:
+            self.locate_port()
+
+    def locate_port(self):
+        """
+        Finds the PCI address and port the device is attached to. This may call out to controller utilities.
+        """
+        self.logger.debug("Trying to get PCI and port...")
+        port_detector = inject(PortDetection)
+        self._pci_address = port_detector.GetPci(self._udev.sys_path)
+        self.logger.debug(f"Got PCI as {self._pci_address}.")
+        self._port = port_detector.GetPort(self._udev.sys_path, self._pci_address, self.serial)
+        self.logger.debug(f"Got port as {self._port}.")
+        HddSnapshot.mark(self, 'identity')
+
     @staticmethod
     def FromSmartDevice(d: pySMART.Device):
         '''
@@ -238,7 +294,7 @@ class Hdd(HddInterface):
     def add_task(self, task_name: str, parameters: Dict[str, Any], *a, **kw):
         task_svc = TaskService()
         task_obj = task_svc.task_types[task_name]
-        parameter_schema = Task.GetTaskParameterSchema(task_obj)
+        parameter_schema = Task.GetTaskParameterSchema(task_obj, hdd=self)
         if(parameter_schema != None and len(parameters.keys()) <= 0):
             return {'need_parameters': parameter_schema, 'task': task_name}
         else:
@@ -258,8 +314,67 @@ class Hdd(HddInterface):
     def add_task_changed_callback(self, callback, *a, **kw) -> None:
         self._task_changed_callbacks.append(callback)
 
-    def update_smart(self) -> None:
+    def _make_smart_cache(self) -> SmartSnapshotCache:
+        cfg_svc = inject(ConfigService)
+        max_age = cfg_svc.data.get('smart', {}).get('cache_ttl', 30)
+        return SmartSnapshotCache(self._read_smart_sync, max_age=max_age, name=self.node, async_refresh_func=self._read_smart_async)
+
+    def _read_smart_sync(self) -> SmartData:
+        return inject(SmartGuard).call_sync(self.node, self._read_smart)
+
+    def _read_smart(self) -> SmartData:
+        data = self._read_smart_sgio()
+        if data != None:
+            return data
         self._smart.update()
+        self._smart_last_call = time.time()
+        return SmartData.FromSmartDev(self._smart)
+
+    def _read_smart_sgio(self) -> Optional[SmartData]:
+        """
+        Reads the SMART attributes through SG_IO, or returns None if the drive isn't read that way.
+        """
+        if not self._sgio:
+            return None
+        previous = self._smart_cache.peek()
+        if previous == None:
+            previous = SmartData.FromSmartDev(self._smart)
+        try:
+            data = inject(SgioSmartReader).read_smart(self.node, previous)
+        except SgioUnsupported as e:
+            self.logger.debug(f"Can't read SMART data through SG_IO, using smartctl from now on: {str(e)}")
+            self._sgio = False
+            return None
+        self._smart_last_call = time.time()
+        return data
+
+    async def _read_smart_async(self) -> SmartData:
+        guard = inject(SmartGuard)
+        if self._sgio:
+            data = await guard.call_blocking(self.node, self._read_smart_sgio) #A thread of its own, a hung ioctl can't starve the loop's executor
+            if data != None:
+                return data
+        try:
+            return await guard.call(self.node, self._read_smart_smartctl)
+        except SmartctlUnsupported:
+            return await guard.call_blocking(self.node, self._read_smart)
+
+    async def _read_smart_smartctl(self) -> SmartData:
+        data = await inject(SmartctlClient).read_smart(self.node)
+        self._smart_last_call = time.time()
+        return data
+
+    def update_smart(self) -> None:
+        """
+        Refreshes the SMART snapshot now, regardless of its age. This blocks, use update_smart_async() on the event loop.
+        """
+        self._smart_cache.refresh()
+
+    async def update_smart_async(self) -> SmartData:
+        """
+        Refreshes the SMART snapshot now without blocking the event loop.
+        """
+        return await self._smart_cache.refresh_async()
 
     def get_available_tasks(self):
         task_svc = TaskService()
@@ -270,12 +385,13 @@ class Hdd(HddInterface):
         Block and finalize anything on the HDD
         """
         if(self.TaskQueue.CurrentTask != None) and (self.TaskQueue.Error != True):
-            if(isinstance(self.TaskQueue.CurrentTask, ExternalTask)) or (isinstance(self.TaskQueue.CurrentTask, Test)):
+            if(isinstance(self.TaskQueue.CurrentTask, ExternalTask)) or (isinstance(self.TaskQueue.CurrentTask, Test)) or (isinstance(self.TaskQueue.CurrentTask, EraseTask)): #An erase keeps its checkpoint to be resumed.
                 self.logger.info("Detaching task " + str(self.TaskQueue.CurrentTask.name) + " on " + self.serial)
                 await self.TaskQueue.CurrentTask.detach()
             else:
                 self.logger.info("Aborting task " + str(self.TaskQueue.CurrentTask.name) + " (PID: " + str(self.TaskQueue.CurrentTask.PID) + ") on " + self.serial)
                 await self.TaskQueue.CurrentTask.abort(wait=True) #Wait for abortion so database entries can be entered before we disconnect the database.
+        inject(SmartGuard).forget(self.node)
             
     def __str__(self):
         if(self.serial):
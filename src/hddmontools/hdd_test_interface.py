@@ -139,7 +139,7 @@ class HddTestInterface(HddInterface):
         """
         task_svc = self._tasksvc
         task_obj = task_svc.task_types[task_name]
-        parameter_schema = Task.GetTaskParameterSchema(task_obj)
+        parameter_schema = Task.GetTaskParameterSchema(task_obj, hdd=self)
         if(parameter_schema != None and len(parameters.keys()) <= 0):
             return {'need_parameters': parameter_schema, 'task': task_name}
         else:
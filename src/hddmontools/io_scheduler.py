@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+import threading
+
+from typing import Dict, Optional
+from injectable import injectable, inject
+
+from hddmontools.config_service import ConfigService
+from hddmontools.pciaddress import PciAddress
+
+#
+#   The IoScheduler shares each controller's bandwidth between the bulk I/O tasks (erase, verify, image) running on its
+#   drives. Sixteen erases on one HBA otherwise saturate it: every drive slows to a crawl, unevenly, and SMART calls
+#   through the same controller time out.
+#
+#   Drives are grouped by the PCI address of their controller, and every controller gets a ControllerBudget:
+#
+#       max_concurrent  How many bulk tasks may move data through the controller at once. The rest wait their turn.
+#       bandwidth       Bytes per second shared by all of them (0 is unlimited), through a token bucket.
+#
+#   The defaults come from io.max_concurrent and io.bandwidth, and io.controllers can override them per PCI address
+#   (i.e. "0000:03:00.0", or "03:00.0" for segment 0).
+#   The native engines ask their budget before every chunk. Subprocess tasks can't be asked, so they are put in a
+#   cgroup v2 group of their own, whose io.max caps the device at an even share of the controller's bandwidth.
+#
+
+class ControllerBudget:
+
+    def __init__(self, controller: str, max_concurrent: int = 0, bandwidth: int = 0, burst: float = 0.5):
+        self.controller = controller
+        self.max_concurrent = max_concurrent #0 is unlimited
+        self.bandwidth = bandwidth #bytes per second, 0 is unlimited
+        self.burst = burst #seconds of bandwidth that may be spent at once after being idle
+        self.active = 0
+        self._cond = threading.Condition()
+        self._tokens = bandwidth * burst
+        self._refilled = time.monotonic()
+
+    def acquire(self, abort: threading.Event = None) -> bool:
+        """
+        Waits for a turn to use the controller. Returns False if abort was set first. Called from an I/O thread.
+        """
+        with self._cond:
+            while self.max_concurrent > 0 and self.active >= self.max_concurrent:
+                if abort != None and abort.is_set():
+                    return False
+                self._cond.wait(0.5)
+            self.active += 1
+        return True
+
+    def release(self):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._cond.notify()
+
+    def consume(self, nbytes: int, abort: threading.Event = None):
+        """
+        Takes nbytes of bandwidth from the bucket, sleeping until they are available. Called from an I/O thread.
+        """
+        if self.bandwidth <= 0:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = min(self.bandwidth * self.burst, self._tokens + (now - self._refilled) * self.bandwidth)
+            self._refilled = now
+            self._tokens -= nbytes #Reserve them now, so waiters are served in the order they asked.
+            wait = -self._tokens / self.bandwidth
+        if wait > 0:
+            if abort != None:
+                abort.wait(wait)
+            else:
+                time.sleep(wait)
+
+    @property
+    def share(self) -> int:
+        """
+        An even share of the bandwidth between max_concurrent tasks, 0 if unlimited.
+        """
+        if self.bandwidth <= 0:
+            return 0
+        return int(self.bandwidth / max(1, self.max_concurrent))
+
+@injectable(singleton=True)
+class IoScheduler:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        cfg = inject(ConfigService).data.get('io', {})
+        self.max_concurrent = cfg.get('max_concurrent', 0)
+        self.bandwidth = cfg.get('bandwidth', 0)
+        self.overrides = {self._controller(a): o for a, o in cfg.get('controllers', {}).items()} #{pci address: {max_concurrent, bandwidth}}
+        self.cgroup = cfg.get('cgroup', '/sys/fs/cgroup/hddmond')
+        self._budgets: Dict[str, ControllerBudget] = {}
+        self._lock = threading.Lock()
+
+    def budget(self, hdd) -> ControllerBudget:
+        """
+        The budget of the controller the drive is attached to. Drives we can't place share one 'unknown' budget.
+        """
+        return self.controller_budget(getattr(hdd, 'pci_address', None))
+
+    def controller_budget(self, pci_address) -> ControllerBudget:
+        controller = self._controller(pci_address)
+        with self._lock:
+            b = self._budgets.get(controller, None)
+            if b == None:
+                o = self.overrides.get(controller, {})
+                b = ControllerBudget(controller, o.get('max_concurrent', self.max_concurrent), o.get('bandwidth', self.bandwidth))
+                self._budgets[controller] = b
+            return b
+
+    @staticmethod
+    def _controller(pci_address) -> str:
+
+        #   The key of a controller's budget: its address as "0000:03:00.0", however it was given.
+
+        if pci_address == None:
+            return 'unknown'
+        if not isinstance(pci_address, PciAddress):
+            pci_address = PciAddress.ParseAddr(pci_address) or str(pci_address)
+        return pci_address.Address if isinstance(pci_address, PciAddress) else pci_address
+
+    def limit_process(self, pid: int, node: str, pci_address) -> Optional[str]:
+        """
+        Puts a process in a cgroup of its own that caps its I/O to the drive at an even share of the controller's
+        bandwidth. Its children inherit the cap. Returns the cgroup's path, or None if there is nothing to cap or
+        cgroup v2 isn't usable here.
+        """
+        share = self.controller_budget(pci_address).share
+        if share <= 0:
+            return None
+        try:
+            rdev = os.stat(node).st_rdev
+            path = os.path.join(self.cgroup, f"{os.path.basename(node)}-{pid}")
+            self._enable_io(self.cgroup)
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'io.max'), 'w') as fd:
+                fd.write(f"{os.major(rdev)}:{os.minor(rdev)} rbps={share} wbps={share}")
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as fd:
+                fd.write(str(pid))
+        except OSError as e:
+            self.logger.warn(f"Couldn't cap the I/O of process {pid} on {node} through cgroups: {str(e)}")
+            return None
+        self.logger.debug(f"Capped process {pid} at {share} bytes/s on {node}.")
+        return path
+
+    def release_process(self, path: Optional[str]):
+        """
+        Removes a cgroup made by limit_process(), once its processes have exited.
+        """
+        if path == None:
+            return
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            self.logger.debug(f"Couldn't remove {path}: {str(e)}")
+
+    def _enable_io(self, path: str):
+
+        #   Every cgroup above ours has to hand the io controller down.
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as fd:
+            fd.write('+io')
+        with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as fd:
+            fd.write('+io')
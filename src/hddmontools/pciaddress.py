@@ -1,4 +1,5 @@
 import logging
+import functools
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +11,7 @@ class PciAddress():
         self.function = str(function)[0:2]
 
     def __eq__(self, other):
-        if other == None:
+        if not isinstance(other, PciAddress):
             return False
 
         if (self.segment == other.segment) and (self.bus == other.bus) and (self.device == other.device) and (self.function == other.function):
@@ -18,6 +19,9 @@ class PciAddress():
         else:
             return False
 
+    def __hash__(self):
+        return hash((self.segment, self.bus, self.device, self.function))
+
     @property
     def Address(self):
         return self.segment + ":" + self.bus + ":" + self.device + "." + self.function
@@ -27,11 +31,16 @@ class PciAddress():
 
     @staticmethod
     def ParseAddr(addr: str):
+        return PciAddress._parse_addr(str(addr).strip())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _parse_addr(addr: str):
+        # The same handful of addresses get parsed over and over, so results are cached. Don't modify the returned objects!
         logger.debug(f"Trying to parse PCI address {addr}...")
         p = None
         
-        addr = str(addr).strip()
-        addr.replace('[', '').replace(']', '')
+        addr = addr.replace('[', '').replace(']', '')
         pci_seg_bus_devfun = addr.split(':')
 
         if(len(pci_seg_bus_devfun) >= 3):
@@ -0,0 +1,60 @@
+import os
+import logging
+
+from pathlib import Path
+from typing import List, Optional, Set
+from injectable import injectable
+
+from hddmontools.pciaddress import PciAddress
+
+#
+#   PciTopology reads the PCI devices, their classes and their drivers straight out of sysfs. This replaces parsing
+#   lspci and dmesg, which were slow and (for dmesg) stopped working once the kernel ring buffer rotated.
+#
+
+@injectable(singleton=True)
+class PciTopology():
+
+    bridge_class = 0x0604 #PCI-to-PCI bridge
+
+    def __init__(self, sysfs_root='/sys'):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.debug("Initializing PciTopology...")
+        self._pci = Path(sysfs_root) / 'bus' / 'pci'
+        self.Bridges: Set[PciAddress] = set()
+        self.Update()
+
+    @property
+    def available(self) -> bool:
+        return (self._pci / 'devices').is_dir()
+
+    def Update(self):
+        self.Bridges = {addr for addr in self.Devices() if self.GetClass(addr) == self.bridge_class}
+        self.logger.debug(f"Found {len(self.Bridges)} PCI bridges.")
+
+    def Devices(self) -> List[PciAddress]:
+        try:
+            names = os.listdir(self._pci / 'devices')
+        except OSError:
+            return []
+        return [a for a in (PciAddress.ParseAddr(n) for n in sorted(names)) if a != None]
+
+    def GetClass(self, addr: PciAddress) -> Optional[int]:
+        """
+        Returns the base class and sub class of a device, i.e. 0x0604 for a PCI bridge.
+        """
+        try:
+            return int((self._pci / 'devices' / addr.Address / 'class').read_text().strip(), 16) >> 8
+        except (OSError, ValueError):
+            return None
+
+    def DevicesForDriver(self, driver: str) -> List[PciAddress]:
+        """
+        Returns the addresses of the devices bound to a kernel driver, like 'ahci'.
+        """
+        try:
+            names = os.listdir(self._pci / 'drivers' / driver)
+        except OSError:
+            return []
+        return [a for a in (PciAddress.ParseAddr(n) for n in sorted(names) if n[:1].isdigit()) if a != None]
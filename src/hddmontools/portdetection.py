@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 
+import os
+import asyncio
 import subprocess
 import logging
 
 from injectable import injectable, inject
 from hddmontools.pciaddress import PciAddress
+from hddmontools.pcitopology import PciTopology
 from hddmontools.ahcidetection import AhciDetective
 from hddmontools.sasdetection import SasDetective
+from hddmontools.enclosuredetection import EnclosureDetective
 
 @injectable(singleton=True)
 class PortDetection():
@@ -15,44 +19,99 @@ class PortDetection():
         self.logger.setLevel(logging.DEBUG)
         self.ahcidet = inject(AhciDetective)
         self.sasdet = inject(SasDetective)
+        self.encdet = inject(EnclosureDetective)
         self.logger.debug("Initializing PortDetection...")
 
-        lspci = subprocess.run(['lspci'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        lines = str(lspci.stdout).splitlines()
-        pcisToParse = []
-        for line in lines:
-            if "PCI bridge" in line:
-                pcisToParse.append(line.split()[0])
-        self.blacklistPcis = []
-        for p in pcisToParse:
+        topology = inject(PciTopology)
+        if topology.available:
+            self.blacklistPcis = set(topology.Bridges)
+        else:
+            self.logger.warn("Can't read PCI devices from sysfs. Falling back to lspci for PCI bridges.")
+            lspci = subprocess.run(['lspci'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            lines = str(lspci.stdout).splitlines()
+            pcisToParse = []
+            for line in lines:
+                if "PCI bridge" in line:
+                    pcisToParse.append(line.split()[0])
+            self.blacklistPcis = set()
+            for p in pcisToParse:
+                self.blacklistPcis.add(PciAddress.ParseAddr(p))
+        for p in self.blacklistPcis:
             self.logger.debug(f"Found PCI bridge {p}...")
-            self.blacklistPcis.append(PciAddress.ParseAddr(p))
+
+        # The topology doesn't change unless something is hot-plugged, so lookups are cached until a controller is invalidated.
+        self._pci_cache = {} #{syspath: PciAddress}
+        self._port_cache = {} #{(syspath, serial): (PCI address str, port)}
 
     def Update(self):
+        """
+        Forces every port detective to re-read its controllers. Prefer Invalidate(), which only touches one controller.
+        """
         self.logger.debug("Updating port detectives...")
+        self._port_cache.clear()
         self.ahcidet.Update()
+        self.encdet.Update()
         self.sasdet.Update()
+
+    def Invalidate(self, pci=None):
+        """
+        Forgets what we know about the ports on a controller (or all controllers, if pci is None) after a hot-plug event.
+        Returns the SAS controllers that need a refresh, see RefreshAsync().
+        """
+        address = pci.Address if pci != None else None
+        for key, (cached_address, _port) in list(self._port_cache.items()):
+            if address == None or cached_address == address:
+                self._port_cache.pop(key, None)
+        self.encdet.Update()
+        return self.sasdet.Invalidate(pci)
+
+    def InvalidateNode(self, node):
+        """
+        Invalidates the controller a device node is attached to.
+        """
+        syspath = os.path.realpath('/sys/block/' + str(node).replace('/dev/', ''))
+        if not os.path.exists(syspath):
+            return []
+        self._pci_cache.pop(syspath, None)
+        return self.Invalidate(self.GetPci(syspath))
+
+    async def RefreshAsync(self, controllers):
+        """
+        Refreshes invalidated SAS controllers in the background, so the next port lookup is a dictionary hit.
+        """
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, sas.Refresh) for sas in controllers))
         
     def GetPci(self, syspath):
+        pci = self._pci_cache.get(syspath, None)
+        if pci != None:
+            return pci
         cols = syspath.split('/')
         check = cols[4]
         #print(check)
         pci = PciAddress.ParseAddr(check)
         if(pci in self.blacklistPcis):
             pci = PciAddress.ParseAddr(cols[5])
+        self._pci_cache[syspath] = pci
         return pci
 
     def GetPort(self, syspath, pci, serial):
+        cached = self._port_cache.get((syspath, serial), None)
+        if cached != None:
+            return cached[1]
+
         self.logger.debug(f"Trying to find a port for {serial}...")
         p = self.ahcidet.GetPortFromSysPath(syspath)
+        if p == None:
+            p = self.encdet.GetSlotFromSysPath(syspath) #Straight from sysfs, no subprocess.
+            if p == None:
+                p = self.sasdet.GetDevicePort(pci, serial) #Ask sas2ircu as a last resort.
+            if p != None:
+                p = "sas" + str(p)
+
         if p != None:
-            #print("Setting port to " + str(p))
+            self._port_cache[(syspath, serial)] = (pci.Address if pci != None else None, p)
             return p
-        
-        p = self.sasdet.GetDevicePort(pci, serial)
-        if p != None:
-            #print("Setting port to sas" + str(p))
-            return "sas" + str(p)
         self.logger.warn(f"Couldn't find the port for {serial}!")
         return None
 
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import logging
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+#
+#   The ProcessSnapshot keeps an index of which processes mention which block devices on their command line, so
+#   finding the external process working on a drive is a dictionary lookup instead of a walk over every process.
+#
+#   Each update() lists /proc once. Only processes that weren't there last time have their command line read, and
+#   tokenized once: every argument is split on '=', ',' and ':', /dev/ paths are resolved, and partitions are also
+#   indexed under their parent disk ('of=/dev/sdb1' is found under 'sdb1' and 'sdb'). Young processes are re-read
+#   for a few seconds, since a freshly forked process may not have exec'd its real command line yet.
+#
+
+@dataclass(frozen=True)
+class ProcessEntry:
+    pid: int
+    exe: str
+    cmdline: List[str]
+
+    def __str__(self):
+        return f"{self.pid} ({' '.join(self.cmdline)})"
+
+class ProcessSnapshot:
+
+    _separators = re.compile(r'[=,:]')
+    _partition = re.compile(r'^((?:sd|hd|vd|xvd)[a-z]+)\d+$|^((?:nvme\d+n\d+)|(?:mmcblk\d+))p\d+$')
+    _device = re.compile(r'^((?:sd|hd|vd|xvd)[a-z]+\d*|nvme\d+n\d+(?:p\d+)?|mmcblk\d+(?:p\d+)?)$')
+
+    def __init__(self, proc_root='/proc', settle=5, ignore_exe=('smartctl',)):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self._root = proc_root
+        self._settle = settle #seconds a new process is re-read for
+        self._ignore_exe = ignore_exe #Processes whose executable name contains one of these are never indexed
+        self._own_pid = os.getpid()
+        self._processes: Dict[int, ProcessEntry] = {}
+        self._devices: Dict[int, Set[str]] = {} #{pid: device names the process mentions}
+        self._first_seen: Dict[int, float] = {}
+        self._index: Dict[str, Set[int]] = {} #{device name: pids}
+
+    def update(self):
+        """
+        Brings the snapshot up to date with the process table.
+        """
+        try:
+            pids = set(int(p) for p in os.listdir(self._root) if p.isdigit())
+        except OSError as e:
+            self.logger.error(f"Couldn't list processes: {str(e)}")
+            return
+
+        for pid in set(self._first_seen.keys()) - pids:
+            self._forget(pid)
+
+        now = time.monotonic()
+        for pid in pids:
+            first_seen = self._first_seen.get(pid, None)
+            if first_seen == None:
+                self._first_seen[pid] = now
+            elif now - first_seen > self._settle:
+                continue #Settled, nothing to re-read.
+            self._read(pid)
+
+    def find(self, name: str) -> Optional[ProcessEntry]:
+        """
+        Returns a process whose command line mentions the device (i.e. 'sda' or '/dev/sda'), if there is one.
+        """
+        pids = self._index.get(os.path.basename(str(name)), None)
+        if pids == None or len(pids) <= 0:
+            return None
+        return self._processes[min(pids)] #The oldest is most likely the one doing the work.
+
+    def _read(self, pid: int):
+        base = os.path.join(self._root, str(pid))
+        try:
+            with open(os.path.join(base, 'cmdline'), 'rb') as fd:
+                raw = fd.read()
+        except OSError:
+            return #Gone already, or not ours to read. It is forgotten once it leaves the process table.
+        try:
+            exe = os.readlink(os.path.join(base, 'exe'))
+        except OSError:
+            exe = ''
+        cmdline = [a.decode(errors='replace') for a in raw.split(b'\0') if len(a) > 0]
+
+        old = self._processes.get(pid, None)
+        if old != None and old.cmdline == cmdline:
+            return
+        self._unindex(pid)
+        self._processes[pid] = ProcessEntry(pid, exe, cmdline)
+        if pid == self._own_pid or any(i in os.path.basename(exe) for i in self._ignore_exe):
+            return
+
+        devices = self.tokenize(cmdline)
+        if len(devices) > 0:
+            self._devices[pid] = devices
+            for d in devices:
+                self._index.setdefault(d, set()).add(pid)
+
+    @staticmethod
+    def tokenize(cmdline: List[str]) -> Set[str]:
+        """
+        Returns the names of the block devices mentioned in a command line, along with the parent disks of partitions.
+        """
+        devices = set()
+        for arg in cmdline[1:]:
+            for token in ProcessSnapshot._separators.split(arg):
+                if token.startswith('/dev/'):
+                    if not token.startswith('/dev/sd') and not token.startswith('/dev/nvme'):
+                        token = os.path.realpath(token) #i.e. /dev/disk/by-id/...
+                    token = os.path.basename(token)
+                if ProcessSnapshot._device.match(token) == None:
+                    continue
+                devices.add(token)
+                m = ProcessSnapshot._partition.match(token)
+                if m != None:
+                    devices.add(m.group(1) or m.group(2))
+        return devices
+
+    def _unindex(self, pid: int):
+        for d in self._devices.pop(pid, ()):
+            pids = self._index.get(d, None)
+            if pids != None:
+                pids.discard(pid)
+                if len(pids) <= 0:
+                    del self._index[d]
+
+    def _forget(self, pid: int):
+        self._unindex(pid)
+        self._processes.pop(pid, None)
+        self._first_seen.pop(pid, None)
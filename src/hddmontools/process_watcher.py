@@ -0,0 +1,147 @@
+import os
+import time
+import errno
+import select
+import ctypes
+import asyncio
+import logging
+
+from typing import Dict, Optional
+from injectable import injectable
+
+#
+#   The ProcessWatcher tells us when a process exits, the moment it exits, without polling it. A pidfd (Linux 5.3+)
+#   becomes readable when its process exits, so it is registered with the event loop like any other file descriptor
+#   and nothing runs until then. Processes don't need to be our children.
+#
+#   Where pidfds aren't available, the watcher falls back to checking /proc, starting quickly and backing off to
+#   poll_interval.
+#
+#   A pidfd doesn't carry the exit status. For our own children, reap them (i.e. Popen.poll()) once the watcher says
+#   they are gone.
+#
+
+_SYS_pidfd_open = 434 #The same on every architecture
+
+def pidfd_open(pid: int) -> int:
+    if hasattr(os, 'pidfd_open'): #Python 3.9+
+        return os.pidfd_open(pid)
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.syscall(_SYS_pidfd_open, ctypes.c_int(pid), ctypes.c_uint(0))
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return fd
+
+@injectable(singleton=True)
+class ProcessWatcher:
+
+    def __init__(self, poll_interval=5):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.poll_interval = poll_interval #seconds, the slowest the fallback checks a process
+        self.pidfd = None #Unknown until the first process is watched
+        self._exits: Dict[int, asyncio.Future] = {} #{pid: future resolved when the process exits}
+
+    def _open(self, pid: int) -> Optional[int]:
+        """
+        Returns a pidfd for the process, None if pidfds aren't supported. Raises ProcessLookupError if it's gone.
+        """
+        if self.pidfd == False:
+            return None
+        try:
+            fd = pidfd_open(pid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                raise ProcessLookupError(pid)
+            if e.errno in (errno.ENOSYS, errno.EPERM, errno.EINVAL):
+                self.logger.info(f"pidfds aren't available ({str(e)}), falling back to polling processes.")
+                self.pidfd = False
+                return None
+            raise
+        self.pidfd = True
+        return fd
+
+    @staticmethod
+    def alive(pid: int) -> bool:
+        """
+        Checks /proc for the process. A zombie counts as exited.
+        """
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as fd:
+                stat = fd.read()
+        except OSError:
+            return False
+        state = stat[stat.rfind(b')') + 2:][:1] #The command name may contain spaces and parentheses.
+        return state not in (b'Z', b'X')
+
+    async def wait(self, pid: int, timeout: float = None) -> bool:
+        """
+        Waits for a process to exit. Returns True once it has, or False if the timeout passed first. Any number of
+        waiters may wait on the same process, and cancelling one doesn't affect the others.
+        """
+        fut = self._exits.get(pid, None)
+        if fut == None or fut.done():
+            fut = self._watch(pid)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _watch(self, pid: int) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        try:
+            fd = self._open(pid)
+        except ProcessLookupError:
+            fut.set_result(None)
+            return fut
+
+        self._exits[pid] = fut
+        fut.add_done_callback(lambda f: self._exits.pop(pid, None) if self._exits.get(pid, None) is f else None)
+        if fd != None:
+            def readable():
+                loop.remove_reader(fd)
+                os.close(fd)
+                if not fut.done():
+                    fut.set_result(None)
+            loop.add_reader(fd, readable)
+        else:
+            loop.create_task(self._poll(pid, fut))
+        return fut
+
+    async def _poll(self, pid: int, fut: asyncio.Future):
+        interval = 0.1
+        while ProcessWatcher.alive(pid):
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.poll_interval)
+        if not fut.done():
+            fut.set_result(None)
+
+    def wait_sync(self, pid: int, timeout: float = None) -> bool:
+        """
+        Blocks the calling thread until the process exits, or the timeout passes. Returns True if it exited. For code
+        that already lives in its own thread.
+        """
+        try:
+            fd = self._open(pid)
+        except ProcessLookupError:
+            return True
+
+        if fd == None:
+            deadline = None if timeout == None else time.monotonic() + timeout
+            interval = 0.1
+            while ProcessWatcher.alive(pid):
+                if deadline != None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(interval if deadline == None else max(0, min(interval, deadline - time.monotonic())))
+                interval = min(interval * 2, self.poll_interval)
+            return True
+
+        try:
+            p = select.poll()
+            p.register(fd, select.POLLIN)
+            return len(p.poll(None if timeout == None else int(timeout * 1000))) > 0
+        finally:
+            os.close(fd)
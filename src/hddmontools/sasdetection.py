@@ -1,4 +1,5 @@
 import subprocess
+import threading
 import logging
 
 from injectable import injectable
@@ -14,8 +15,11 @@ class SasDevice:
         self.Index = int(index)
         self.PciAddress = None
         self.Devices = {} #{Serial *str: slot *int}
+        self._lock = threading.Lock()
+        self._generation = 0 #Bumped every time the device list is invalidated
+        self._refreshed_generation = 0 #The generation the device list was last refreshed at
 
-        displayInfo = subprocess.run([SasDetective.sas2ircu, str(self.Index), 'DISPLAY'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        displayInfo = self._display()
         if (displayInfo.returncode == 0):
 
             startIndex = 0
@@ -62,15 +66,44 @@ class SasDevice:
             #print(self.PciAddress)
         else:
             self.logger.error(f"Got non-zero exit code {displayInfo.returncode} from sas2ircu!")
-        self.GetDevices()
+        self.GetDevices(displayInfo) #The same DISPLAY output has the device list too, no need to ask twice.
         self.logger.debug(f"Found {len(self.Devices)} devices attached to this device.")
-    
+
+    @property
+    def Dirty(self):
+        """
+        If the device list may be out of date because of a hot-plug event on this controller.
+        """
+        return self._generation != self._refreshed_generation
+
+    def Invalidate(self):
+        self._generation += 1
+
+    def Refresh(self, force=False):
+        """
+        Re-reads the device list if it was invalidated. Concurrent callers wait for one refresh instead of all running sas2ircu.
+        """
+        with self._lock:
+            if not (self.Dirty or force):
+                return
+            generation = self._generation
+            self.GetDevices()
+            self._refreshed_generation = generation
+
     def GetPortFromSerial(self, serial:str):
-        return self.Devices.get(serial, None)
+        slot = self.Devices.get(serial, None)
+        if slot == None and self.Dirty:
+            self.Refresh() #The drive may have been plugged in since we last looked.
+            slot = self.Devices.get(serial, None)
+        return slot
+
+    def _display(self):
+        return subprocess.run([SasDetective.sas2ircu, str(self.Index), 'DISPLAY'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
 
-    def GetDevices(self):
+    def GetDevices(self, displayInfo=None):
         self.logger.debug("Looking for attached devices...")
-        displayInfo = subprocess.run([SasDetective.sas2ircu, str(self.Index), 'DISPLAY'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if displayInfo == None:
+            displayInfo = self._display()
 
         #Example output:
         # LSI Corporation SAS2 IR Configuration Utility.
@@ -142,6 +175,7 @@ class SasDevice:
                     break  
             
             data = lines[startIndex:endIndex]   #If startIndex and endIndex are never set for some reason, our data will consist of lines[0:0]
+            devices = {}
             for i in range(len(data)):
                 if(data[i].strip().startswith("Device is a Hard disk")):
                     #The next 10 lines are device information
@@ -159,9 +193,10 @@ class SasDevice:
                     #   Drive Type                              : SATA_HDD          | i+10
                     serial = str(data[i+8].split(':')[1].strip())
                     slot = int(str(data[i+2].split(':')[1].strip()))
-                    self.Devices.update({serial: slot})
+                    devices.update({serial: slot})
                     self.logger.debug(f"Found device {serial} on slot {slot}")
                     i += 10 #advance to the next block of data
+            self.Devices = devices #Swap in the whole list at once, so drives that were pulled don't linger.
         else:
             pass #Do something else?
 
@@ -176,6 +211,7 @@ class SasDetective:
         listSas = subprocess.run([SasDetective.sas2ircu, 'LIST'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
         
         self.SasDevices = []
+        self._by_pci = {} #{PciAddress: SasDevice}
         
         if(listSas.returncode == 0):
             output = str(listSas.stdout)
@@ -201,6 +237,8 @@ class SasDetective:
 
                         device = SasDevice(index=int(cols[0])) #SasDevice will remove the h from the PCI address
                         self.SasDevices.append(device)
+                        if device.PciAddress != None:
+                            self._by_pci[device.PciAddress] = device
                         self.logger.debug(f"Found SAS device with index {device.Index}.")
                     else:
                         pass #The line was just informational text, not data we needed
@@ -213,13 +251,11 @@ class SasDetective:
             self.logger.debug(f"Looking for port for {serial} using PCI address {pci} as a hint...")
             #print("Got PCI: " + str(pci))
             #First find the device with the same leading PCI address
-            for sas in self.SasDevices:
-                #print("Check " + str(pci) + " == " + str(sas.PciAddress))
-                if sas.PciAddress == pci:
-                    #print("Looking in SAS index " + str(sas.Index))
-                    return sas.GetPortFromSerial(serial) #We found a SAS device with that PCI address. Let it try and find the device
+            sas = self._by_pci.get(pci, None)
+            if sas != None:
+                return sas.GetPortFromSerial(serial) #We found a SAS device with that PCI address. Let it try and find the device
             
-            #The loop finished and we didn't find anything at that PCI address
+            #We didn't find anything at that PCI address
             self.logger.debug(f"No SAS port found for {serial} on PCI address {pci}.")
             return None
         
@@ -237,7 +273,25 @@ class SasDetective:
         else:
             return None #What do you want us to do if you didn't give us anything?
                 
+    def GetController(self, pci):
+        if pci == None:
+            return None
+        return self._by_pci.get(pci, None)
+
+    def Invalidate(self, pci=None):
+        """
+        Marks a controller's device list (or all of them, if pci is None) as out of date. Returns the invalidated controllers.
+        """
+        if pci == None:
+            controllers = self.SasDevices.copy()
+        else:
+            sas = self.GetController(pci)
+            controllers = [sas] if sas != None else []
+        for sas in controllers:
+            sas.Invalidate()
+        return controllers
+
     def Update(self):
         self.logger.debug("Updating all SAS device listings...")
         for sasdevice in self.SasDevices:
-            sasdevice.GetDevices()
\ No newline at end of file
+            sasdevice.Refresh(force=True)
\ No newline at end of file
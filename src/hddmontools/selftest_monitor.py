@@ -0,0 +1,229 @@
+import asyncio
+import logging
+
+from typing import Callable, Dict, Optional
+from injectable import injectable, inject
+
+from hddmontools.config_service import ConfigService
+from hddmontools.smartctl_client import SmartctlClient, SmartctlError, SmartctlUnsupported, SelfTestStatus
+from hddmontools.smart_guard import SmartGuard
+
+#
+#   The SelfTestMonitor watches every running SMART self-test from a single task on the event loop, so a test costs
+#   one short smartctl call every so often instead of a thread for its whole duration.
+#
+#   Each drive is polled on its own schedule. The interval is half the time the drive needs for 10% of the test
+#   (drives report progress in 10% steps), worked out from the rate progress has been moving at, or from the
+#   drive's recommended polling time until progress has moved. It's kept between selftest.min_interval and
+#   selftest.max_interval.
+#
+#   Without JSON output from smartctl, tests are started and polled through pySMART in an executor. Each of those
+#   calls is short too.
+#
+
+class _Watch:
+    def __init__(self, hdd, test_type: Optional[str], progress_callback: Optional[Callable], min_interval: float):
+        self.hdd = hdd
+        self.node = hdd.node
+        self.test_type = test_type
+        self.progress_callback = progress_callback
+        self.min_interval = min_interval
+        self.future = asyncio.get_event_loop().create_future()
+        self.pysmart = False #Poll through pySMART instead of smartctl's JSON output
+        self.polling_minutes = {}
+        self.status: Optional[SelfTestStatus] = None
+        self.progress = 0
+        self.first_seen = None #(loop time, progress) when the test was first seen running
+        self.start_polls = 0 #Polls left during which a stopped test may just not have started yet
+        self.errors = 0
+        self.next_poll = 0
+        self.polling = False
+
+@injectable(singleton=True)
+class SelfTestMonitor:
+
+    # smartctl's names for the recommended polling times, by test type
+    polling_keys = {'short': 'short', 'long': 'extended', 'extended': 'extended', 'conveyance': 'conveyance'}
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        cfg = inject(ConfigService).data.get('selftest', {})
+        self.min_interval = cfg.get('min_interval', 5) #seconds
+        self.max_interval = cfg.get('max_interval', 300) #seconds
+        self.max_errors = cfg.get('max_errors', 5) #failed polls in a row before we lose track of a test
+        self._watches: Dict[str, _Watch] = {}
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def active(self):
+        return list(self._watches.keys())
+
+    async def run(self, hdd, test_type: str = None, progress_callback: Callable[[int], None] = None, min_interval: float = None) -> SelfTestStatus:
+        """
+        Starts a self-test on a drive and waits for it to finish, or for release() to be called. Without a test_type,
+        waits for a test that is already running. Raises SmartctlError if the test couldn't be started.
+        """
+        if hdd.node in self._watches:
+            raise SmartctlError(f"A self-test on {hdd.node} is already being monitored")
+        w = _Watch(hdd, test_type, progress_callback, max(self.min_interval, min_interval or 0))
+        guard = inject(SmartGuard)
+        if test_type != None:
+            try:
+                await guard.call(w.node, inject(SmartctlClient).start_selftest, w.node, test_type)
+            except SmartctlUnsupported:
+                w.pysmart = True
+                await guard.call(w.node, self._pysmart_start, hdd, test_type)
+            w.start_polls = 3 #The drive may report the previous test's result for a moment after a new one was started.
+
+        self._watches[w.node] = w
+        self._schedule()
+        return await w.future
+
+    def release(self, node: str) -> bool:
+        """
+        Stops monitoring a drive without aborting its test. The waiting run() returns the last status seen.
+        """
+        w = self._watches.get(node, None)
+        if w == None:
+            return False
+        status = w.status if w.status != None else SelfTestStatus(True, w.progress, "No longer monitored")
+        self._finish(w, status)
+        return True
+
+    def poll_soon(self, node: str):
+        """
+        Polls a drive on the next pass, i.e. right after its test was aborted.
+        """
+        w = self._watches.get(node, None)
+        if w != None:
+            w.next_poll = 0
+            self._schedule()
+
+    def _schedule(self):
+        if self._task == None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._poll_loop())
+        else:
+            self._wakeup.set()
+
+    async def _poll_loop(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while len(self._watches) > 0:
+                now = loop.time()
+                for w in list(self._watches.values()):
+                    if not w.polling and w.next_poll <= now:
+                        w.polling = True
+                        loop.create_task(self._poll(w)) #A slow drive doesn't hold up the others.
+
+                waiting = [w.next_poll for w in self._watches.values() if not w.polling]
+                delay = (min(waiting) - loop.time()) if len(waiting) > 0 else self.max_interval
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0, delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._task = None
+
+    async def _poll(self, w: _Watch):
+        loop = asyncio.get_event_loop()
+        guard = inject(SmartGuard)
+        try:
+            try:
+                if w.pysmart:
+                    status = await guard.call(w.node, self._pysmart_status, w.hdd)
+                else:
+                    status = await guard.call(w.node, inject(SmartctlClient).get_selftest_status, w.node)
+            except SmartctlUnsupported:
+                w.pysmart = True
+                w.next_poll = 0
+                return
+            except Exception as e:
+                # A sick drive can miss a poll or two without us losing track of its test.
+                w.errors += 1
+                self.logger.debug(f"Couldn't poll the self-test on {w.node} ({w.errors}/{self.max_errors}): {str(e)}")
+                if w.errors >= self.max_errors:
+                    self._finish(w, SelfTestStatus(False, w.progress, "Lost track of the test: " + str(e)))
+                else:
+                    w.next_poll = loop.time() + max(w.min_interval, guard.breaker(w.node).retry_in)
+                return
+
+            if self._watches.get(w.node, None) is not w:
+                return #Released while we were polling.
+            w.errors = 0
+            w.status = status
+            if len(status.polling_minutes) > 0:
+                w.polling_minutes = status.polling_minutes
+
+            if status.running:
+                w.start_polls = 0
+                self._progress(w, status.progress)
+                w.next_poll = loop.time() + self._interval(w)
+            elif w.start_polls > 0:
+                w.start_polls -= 1
+                w.next_poll = loop.time() + w.min_interval
+            else:
+                self._finish(w, status)
+        finally:
+            w.polling = False
+            if self._wakeup != None:
+                self._wakeup.set()
+
+    def _progress(self, w: _Watch, progress: int):
+        now = asyncio.get_event_loop().time()
+        if w.first_seen == None:
+            w.first_seen = (now, progress)
+        if progress != w.progress:
+            w.progress = progress
+            if w.progress_callback != None and callable(w.progress_callback):
+                w.progress_callback(progress)
+
+    def _interval(self, w: _Watch) -> float:
+        """
+        How long to wait before polling a running test again.
+        """
+        now = asyncio.get_event_loop().time()
+        step = None #Seconds the drive takes for 10% of the test
+        t0, p0 = w.first_seen
+        if w.progress > p0 and now > t0:
+            step = 10 * (now - t0) / (w.progress - p0)
+        else:
+            minutes = w.polling_minutes.get(self.polling_keys.get(str(w.test_type).lower(), ''), None)
+            if minutes != None and minutes > 0:
+                step = minutes * 60 / 10
+
+        if step == None:
+            return w.min_interval
+        remaining = step * (100 - w.progress) / 10
+        return min(self.max_interval, max(w.min_interval, min(step / 2, remaining)))
+
+    def _finish(self, w: _Watch, status: SelfTestStatus):
+        if self._watches.get(w.node, None) is w:
+            del self._watches[w.node]
+        if not w.future.done():
+            w.future.set_result(status)
+        if self._wakeup != None:
+            self._wakeup.set()
+
+    async def _pysmart_start(self, hdd, test_type: str):
+        rc, msg, _ = await asyncio.get_event_loop().run_in_executor(None, hdd._smart.run_selftest, str(test_type).lower())
+        if rc != 0:
+            raise SmartctlError(f"Couldn't start {test_type} self-test on {hdd.node}: {msg}")
+
+    async def _pysmart_status(self, hdd) -> SelfTestStatus:
+        r, t, p = await asyncio.get_event_loop().run_in_executor(None, hdd._smart.get_selftest_result)
+        if r == 1: #Running
+            return SelfTestStatus(True, int(p) if p != None else 0, "Self-test in progress")
+        if r == 0 and t != None:
+            text = str(t.status)
+            if 'abort' in text.lower() or 'interrupt' in text.lower():
+                return SelfTestStatus(False, 100, text, aborted=True)
+            if 'without error' in text.lower():
+                return SelfTestStatus(False, 100, text, passed=True)
+            if 'fail' in text.lower():
+                return SelfTestStatus(False, 100, text, passed=False)
+            return SelfTestStatus(False, 100, text)
+        return SelfTestStatus(False, 100, "No self-test result available")
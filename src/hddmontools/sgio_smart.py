@@ -0,0 +1,453 @@
+import os
+import time
+import fcntl
+import ctypes
+import datetime
+import dataclasses
+import logging
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from injectable import injectable, inject
+
+from hddmondtools.hddmon_dataclasses import SmartData, AttributeData
+from hddmontools.config_service import ConfigService
+
+#
+#   The SgioSmartReader reads SMART data in-process, by sending commands to the drive with the SG_IO ioctl instead of
+#   running smartctl. SATA drives (including ones behind a SAS HBA, through the kernel's SCSI/ATA translation) are
+#   sent ATA PASS-THROUGH(16) SMART READ DATA, READ THRESHOLDS and RETURN STATUS. SCSI drives are sent LOG SENSE for
+#   a handful of log pages.
+#
+#   Only the attributes and health assessment are read this way. Everything else in SmartData (firmware, interface,
+#   test capabilities...) doesn't change, so it is carried over from the previous snapshot.
+#
+#   The decode_* functions only take bytes, so captured pages can be decoded without a drive. To capture a drive's
+#   raw pages into a directory, and decode them again later:
+#
+#       python -m hddmontools.sgio_smart -d /dev/sda --dump ./sda-pages
+#       python -m hddmontools.sgio_smart --load ./sda-pages
+#
+
+class SgioError(Exception):
+    pass
+
+class SgioUnsupported(SgioError):
+    pass
+
+class SgIoHdr(ctypes.Structure):
+    _fields_ = [
+        ('interface_id', ctypes.c_int),
+        ('dxfer_direction', ctypes.c_int),
+        ('cmd_len', ctypes.c_ubyte),
+        ('mx_sb_len', ctypes.c_ubyte),
+        ('iovec_count', ctypes.c_ushort),
+        ('dxfer_len', ctypes.c_uint),
+        ('dxferp', ctypes.c_void_p),
+        ('cmdp', ctypes.c_void_p),
+        ('sbp', ctypes.c_void_p),
+        ('timeout', ctypes.c_uint),
+        ('flags', ctypes.c_uint),
+        ('pack_id', ctypes.c_int),
+        ('usr_ptr', ctypes.c_void_p),
+        ('status', ctypes.c_ubyte),
+        ('masked_status', ctypes.c_ubyte),
+        ('msg_status', ctypes.c_ubyte),
+        ('sb_len_wr', ctypes.c_ubyte),
+        ('host_status', ctypes.c_ushort),
+        ('driver_status', ctypes.c_ushort),
+        ('resid', ctypes.c_int),
+        ('duration', ctypes.c_uint),
+        ('info', ctypes.c_uint),
+    ]
+
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_FROM_DEV = -3
+SG_INFO_OK_MASK = 0x1
+
+SENSE_RECOVERED_ERROR = 0x1
+SENSE_ILLEGAL_REQUEST = 0x5
+SENSE_ABORTED_COMMAND = 0xb
+
+ATA_SMART_READ_DATA = 0xd0
+ATA_SMART_READ_THRESHOLDS = 0xd1
+ATA_SMART_RETURN_STATUS = 0xda
+
+SCSI_LOG_SUPPORTED_PAGES = 0x00
+SCSI_LOG_WRITE_ERRORS = 0x02
+SCSI_LOG_READ_ERRORS = 0x03
+SCSI_LOG_VERIFY_ERRORS = 0x05
+SCSI_LOG_TEMPERATURE = 0x0d
+SCSI_LOG_START_STOP = 0x0e
+SCSI_LOG_INFORMATIONAL_EXCEPTIONS = 0x2f
+
+# The names smartctl uses for the attributes most drives report.
+ATA_ATTRIBUTE_NAMES = {
+    1: 'Raw_Read_Error_Rate',
+    2: 'Throughput_Performance',
+    3: 'Spin_Up_Time',
+    4: 'Start_Stop_Count',
+    5: 'Reallocated_Sector_Ct',
+    7: 'Seek_Error_Rate',
+    8: 'Seek_Time_Performance',
+    9: 'Power_On_Hours',
+    10: 'Spin_Retry_Count',
+    11: 'Calibration_Retry_Count',
+    12: 'Power_Cycle_Count',
+    170: 'Available_Reservd_Space',
+    171: 'Program_Fail_Count',
+    172: 'Erase_Fail_Count',
+    173: 'Wear_Leveling_Count',
+    174: 'Unexpect_Power_Loss_Ct',
+    177: 'Wear_Leveling_Count',
+    179: 'Used_Rsvd_Blk_Cnt_Tot',
+    181: 'Program_Fail_Cnt_Total',
+    182: 'Erase_Fail_Count_Total',
+    183: 'Runtime_Bad_Block',
+    184: 'End-to-End_Error',
+    187: 'Reported_Uncorrect',
+    188: 'Command_Timeout',
+    189: 'High_Fly_Writes',
+    190: 'Airflow_Temperature_Cel',
+    191: 'G-Sense_Error_Rate',
+    192: 'Power-Off_Retract_Count',
+    193: 'Load_Cycle_Count',
+    194: 'Temperature_Celsius',
+    195: 'Hardware_ECC_Recovered',
+    196: 'Reallocated_Event_Count',
+    197: 'Current_Pending_Sector',
+    198: 'Offline_Uncorrectable',
+    199: 'UDMA_CRC_Error_Count',
+    200: 'Multi_Zone_Error_Rate',
+    220: 'Disk_Shift',
+    222: 'Loaded_Hours',
+    223: 'Load_Retry_Count',
+    224: 'Load_Friction',
+    226: 'Load-in_Time',
+    231: 'Temperature_Celsius',
+    232: 'Available_Reservd_Space',
+    233: 'Media_Wearout_Indicator',
+    240: 'Head_Flying_Hours',
+    241: 'Total_LBAs_Written',
+    242: 'Total_LBAs_Read',
+}
+
+# Temperature attributes keep the current temperature in the lowest raw byte, and min/max in the others.
+ATA_TEMPERATURE_ATTRIBUTES = (190, 194, 231)
+
+SCSI_ATTRIBUTES = { #{(page, parameter): name}
+    (SCSI_LOG_TEMPERATURE, 0x0000): 'Temperature_Celsius',
+    (SCSI_LOG_READ_ERRORS, 0x0006): 'Read_Total_Uncorrected_Errors',
+    (SCSI_LOG_WRITE_ERRORS, 0x0006): 'Write_Total_Uncorrected_Errors',
+    (SCSI_LOG_VERIFY_ERRORS, 0x0006): 'Verify_Total_Uncorrected_Errors',
+    (SCSI_LOG_START_STOP, 0x0004): 'Accumulated_Start_Stop_Cycles',
+}
+
+def ata_smart_cdb(feature: int, check_condition=False) -> bytes:
+    """
+    Builds an ATA PASS-THROUGH(16) CDB for a SMART subcommand.
+    """
+    data_in = feature != ATA_SMART_RETURN_STATUS
+    protocol = 4 if data_in else 3 #PIO data-in, or non-data
+    flags = (0x20 if check_condition else 0) | (0x0e if data_in else 0) #ck_cond, and t_dir/byt_blok/t_length for a 1 sector transfer
+    return bytes([
+        0x85, protocol << 1, flags,
+        0, feature,
+        0, 1 if data_in else 0,
+        0, 0,
+        0, 0x4f,
+        0, 0xc2,
+        0, 0xb0, 0,
+    ])
+
+def log_sense_cdb(page: int, length: int = 0xfffc) -> bytes:
+    """
+    Builds a LOG SENSE(10) CDB asking for the cumulative values of a log page.
+    """
+    return bytes([0x4d, 0, 0x40 | (page & 0x3f), 0, 0, 0, 0, (length >> 8) & 0xff, length & 0xff, 0])
+
+def sense_key(sense: bytes) -> Optional[int]:
+    if len(sense) < 3:
+        return None
+    if sense[0] & 0x7f in (0x72, 0x73): #Descriptor format
+        return sense[1] & 0xf
+    return sense[2] & 0xf
+
+def decode_ata_smart_attributes(data: bytes, thresholds: bytes = None, verify_checksum=True) -> List[AttributeData]:
+    """
+    Decodes the 512 byte pages returned by SMART READ DATA and SMART READ THRESHOLDS into AttributeData.
+    """
+    if len(data) < 512:
+        raise SgioError(f"SMART data page is {len(data)} bytes, expected 512")
+    if verify_checksum and sum(data[:512]) & 0xff != 0:
+        raise SgioError("SMART data page has a bad checksum")
+
+    thresh = {}
+    if thresholds != None and len(thresholds) >= 512:
+        for i in range(30):
+            entry = thresholds[2 + i * 12: 2 + (i + 1) * 12]
+            if entry[0] != 0:
+                thresh[entry[0]] = entry[1]
+
+    attrs = []
+    for i in range(30): #The page has room for 30 attributes of 12 bytes each, after a 2 byte revision number.
+        entry = data[2 + i * 12: 2 + (i + 1) * 12]
+        num = entry[0]
+        if num == 0:
+            continue
+        flags = int.from_bytes(entry[1:3], 'little')
+        value = entry[3]
+        worst = entry[4]
+        raw = int.from_bytes(entry[5:11], 'little')
+        if num in ATA_TEMPERATURE_ATTRIBUTES:
+            raw = raw & 0xff
+        threshold = thresh.get(num, None)
+        when_failed = '-'
+        if threshold != None and threshold != 0:
+            if value <= threshold:
+                when_failed = 'FAILING_NOW'
+            elif worst <= threshold:
+                when_failed = 'In_the_past'
+        attrs.append(AttributeData(
+            num,
+            ATA_ATTRIBUTE_NAMES.get(num, 'Unknown_Attribute'),
+            flags,
+            raw,
+            threshold,
+            'Pre-fail' if flags & 0x1 else 'Old_age',
+            'Always' if flags & 0x2 else 'Offline',
+            value,
+            when_failed,
+            worst,
+        ))
+    return attrs
+
+def decode_ata_return_status(sense: bytes) -> Optional[str]:
+    """
+    Decodes the ATA registers returned by SMART RETURN STATUS into 'PASS' or 'FAIL', or None if they can't be found.
+    """
+    if len(sense) < 8:
+        return None
+    response = sense[0] & 0x7f
+    lba_mid = lba_high = None
+    if response in (0x72, 0x73): #Descriptor format, look for the ATA Status Return descriptor.
+        end = min(len(sense), 8 + sense[7])
+        i = 8
+        while i + 1 < end:
+            code, length = sense[i], sense[i + 1]
+            if code == 0x09 and length >= 0x0c and i + 13 < len(sense):
+                lba_mid, lba_high = sense[i + 9], sense[i + 11]
+                break
+            i += 2 + length
+    elif response in (0x70, 0x71) and len(sense) >= 12: #Fixed format
+        lba_mid, lba_high = sense[10], sense[11] #LBA(15:8) and LBA(23:16), after LBA(7:0) in byte 9
+
+    if (lba_mid, lba_high) == (0x4f, 0xc2):
+        return 'PASS'
+    if (lba_mid, lba_high) == (0xf4, 0x2c):
+        return 'FAIL'
+    return None
+
+def decode_scsi_log_page(page: bytes) -> Tuple[int, Dict[int, bytes]]:
+    """
+    Splits a SCSI log page into its parameters. Returns the page code and {parameter code: parameter bytes}.
+    """
+    if len(page) < 4:
+        raise SgioError(f"Log page is {len(page)} bytes, too short for a header")
+    code = page[0] & 0x3f
+    end = min(len(page), 4 + int.from_bytes(page[2:4], 'big'))
+    params = {}
+    i = 4
+    while i + 4 <= end:
+        param = int.from_bytes(page[i:i + 2], 'big')
+        length = page[i + 3]
+        params[param] = bytes(page[i + 4:i + 4 + length])
+        i += 4 + length
+    return code, params
+
+def decode_scsi_supported_pages(page: bytes) -> List[int]:
+    if len(page) < 4:
+        return []
+    end = min(len(page), 4 + int.from_bytes(page[2:4], 'big'))
+    return [p & 0x3f for p in page[4:end]]
+
+def decode_scsi_attributes(pages: Dict[int, bytes]) -> Tuple[List[AttributeData], Optional[str]]:
+    """
+    Turns the raw SCSI log pages we know about into AttributeData, and the informational exceptions page into an
+    assessment. pages is {page code: raw page}.
+    """
+    params = {}
+    for raw in pages.values():
+        code, p = decode_scsi_log_page(raw)
+        params[code] = p
+
+    attrs = []
+    for (page, param), name in SCSI_ATTRIBUTES.items():
+        b = params.get(page, {}).get(param, None)
+        if b == None or len(b) <= 0:
+            continue
+        raw = int.from_bytes(b, 'big')
+        if page == SCSI_LOG_TEMPERATURE:
+            raw = raw & 0xff
+            if raw == 0xff: #Temperature not available
+                continue
+        attrs.append(AttributeData((page << 16) | param, name, None, raw, None, 'Old_age', 'Always', None, '-', None))
+
+    assessment = None
+    ie = params.get(SCSI_LOG_INFORMATIONAL_EXCEPTIONS, {}).get(0x0000, None)
+    if ie != None and len(ie) >= 2:
+        assessment = 'FAIL' if ie[0] != 0 else 'PASS' #A non-zero ASC means the drive predicts its own failure.
+    return attrs, assessment
+
+@injectable(singleton=True)
+class SgioSmartReader:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        cfg = inject(ConfigService).data.get('smart', {})
+        self.enabled = bool(cfg.get('sgio', False))
+        self.timeout = cfg.get('timeout', 60) * 0.9 #seconds for a whole read, below the SmartGuard's timeout so the kernel gives up on the drive first
+
+    def _io(self, fd: int, cdb: bytes, length: int, check_condition=False, deadline: float = None) -> Tuple[bytes, bytes]:
+        """
+        Sends a command through SG_IO, which the kernel aborts at the deadline (a time.monotonic() time). Returns the
+        data read and the sense data.
+        """
+        remaining = self.timeout if deadline == None else deadline - time.monotonic()
+        if remaining <= 0:
+            raise SgioError(f"Ran out of time before command {cdb[0]:#04x}")
+        cdb_buf = ctypes.create_string_buffer(cdb, len(cdb))
+        data_buf = ctypes.create_string_buffer(length) if length > 0 else None
+        sense_buf = ctypes.create_string_buffer(64)
+
+        hdr = SgIoHdr()
+        hdr.interface_id = ord('S')
+        hdr.dxfer_direction = SG_DXFER_FROM_DEV if length > 0 else SG_DXFER_NONE
+        hdr.cmd_len = len(cdb)
+        hdr.mx_sb_len = len(sense_buf)
+        hdr.dxfer_len = length
+        hdr.dxferp = ctypes.cast(data_buf, ctypes.c_void_p) if data_buf != None else None
+        hdr.cmdp = ctypes.cast(cdb_buf, ctypes.c_void_p)
+        hdr.sbp = ctypes.cast(sense_buf, ctypes.c_void_p)
+        hdr.timeout = max(1, int(remaining * 1000)) #The kernel aborts the command after this, in milliseconds
+
+        try:
+            fcntl.ioctl(fd, SG_IO, hdr)
+        except OSError as e:
+            raise SgioUnsupported(f"SG_IO failed: {str(e)}")
+
+        sense = sense_buf.raw[:hdr.sb_len_wr]
+        if hdr.host_status != 0 or (hdr.driver_status & 0xf) not in (0, 0x8): #0x8 is DRIVER_SENSE, which we look at ourselves
+            raise SgioError(f"SG_IO command failed (host status {hdr.host_status}, driver status {hdr.driver_status})")
+        if hdr.info & SG_INFO_OK_MASK:
+            key = sense_key(sense)
+            if key == SENSE_RECOVERED_ERROR and check_condition:
+                pass #We asked for the ATA registers back.
+            elif key in (SENSE_ILLEGAL_REQUEST, SENSE_ABORTED_COMMAND):
+                raise SgioUnsupported(f"Command {cdb[0]:#04x} was rejected (sense key {key:#x})")
+            else:
+                raise SgioError(f"Command {cdb[0]:#04x} failed (status {hdr.status:#x}, sense key {key})")
+        data = data_buf.raw[:length - max(0, hdr.resid)] if data_buf != None else b''
+        return data, sense
+
+    def _is_ata(self, node: str) -> bool:
+        name = os.path.basename(os.path.realpath(node))
+        if name.startswith('nvme'):
+            raise SgioUnsupported("NVMe devices aren't read through SG_IO")
+        try:
+            vendor = (Path('/sys/block') / name / 'device' / 'vendor').read_text().strip()
+        except OSError:
+            raise SgioUnsupported(f"Couldn't read the SCSI vendor of {node}")
+        return vendor == 'ATA' #libata, and SAS HBAs translating for SATA drives, report the vendor as "ATA".
+
+    def read_pages(self, node: str) -> Dict[str, bytes]:
+        """
+        Reads a drive's raw SMART pages. Keys are 'ata_data', 'ata_thresholds' and 'ata_status' for ATA drives, or
+        'scsi_<page code in hex>' for SCSI drives.
+        """
+        ata = self._is_ata(node)
+        deadline = time.monotonic() + self.timeout #For all of the commands together
+        fd = os.open(node, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            pages = {}
+            if ata:
+                pages['ata_data'], _ = self._io(fd, ata_smart_cdb(ATA_SMART_READ_DATA), 512, deadline=deadline)
+                pages['ata_thresholds'], _ = self._io(fd, ata_smart_cdb(ATA_SMART_READ_THRESHOLDS), 512, deadline=deadline)
+                _, pages['ata_status'] = self._io(fd, ata_smart_cdb(ATA_SMART_RETURN_STATUS, check_condition=True), 0, check_condition=True, deadline=deadline)
+            else:
+                supported, _ = self._io(fd, log_sense_cdb(SCSI_LOG_SUPPORTED_PAGES), 0xfc, deadline=deadline)
+                wanted = set(p for p, _ in SCSI_ATTRIBUTES.keys()) | {SCSI_LOG_INFORMATIONAL_EXCEPTIONS}
+                for page in decode_scsi_supported_pages(supported):
+                    if page in wanted:
+                        pages[f'scsi_{page:02x}'], _ = self._io(fd, log_sense_cdb(page), 0xfffc, deadline=deadline)
+            return pages
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def decode_pages(pages: Dict[str, bytes]) -> Tuple[List[AttributeData], Optional[str]]:
+        if 'ata_data' in pages:
+            attrs = decode_ata_smart_attributes(pages['ata_data'], pages.get('ata_thresholds', None))
+            assessment = decode_ata_return_status(pages.get('ata_status', b''))
+            if assessment == None: #Some SATA bridges don't hand back the ATA registers.
+                assessment = 'FAIL' if any(a.when_failed == 'FAILING_NOW' and a.attr_type == 'Pre-fail' for a in attrs) else 'PASS'
+            return attrs, assessment
+        scsi = {int(k[len('scsi_'):], 16): v for k, v in pages.items() if k.startswith('scsi_')}
+        return decode_scsi_attributes(scsi)
+
+    def read_smart(self, node: str, previous: SmartData) -> SmartData:
+        """
+        Reads a drive's attributes and assessment, and returns them in a copy of the previous snapshot. Blocks while
+        the drive answers. Raises SgioUnsupported when the drive can't be read this way.
+        """
+        attrs, assessment = SgioSmartReader.decode_pages(self.read_pages(node))
+        return dataclasses.replace(
+            previous,
+            last_captured=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            attributes=attrs,
+            assessment=assessment if assessment != None else previous.assessment,
+        )
+
+if __name__ == "__main__":
+    import getopt, sys
+
+    unixOptions = "hd:"
+    gnuOptions = ["help", "disk=", "dump=", "load="]
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], unixOptions, gnuOptions)
+    except getopt.error as err:
+        print(str(err))
+        sys.exit(2)
+
+    disk = None
+    dump = None
+    load = None
+    for currentArgument, currentValue in arguments:
+        if currentArgument in ("-h", "--help"):
+            print("Reads SMART pages through SG_IO.\n\t-d, --disk <node>\tThe disk to read\n\t--dump <dir>\t\tSave the raw pages into a directory\n\t--load <dir>\t\tDecode raw pages saved with --dump instead of reading a disk")
+            sys.exit(0)
+        elif currentArgument in ("-d", "--disk"):
+            disk = currentValue
+        elif currentArgument == "--dump":
+            dump = Path(currentValue)
+        elif currentArgument == "--load":
+            load = Path(currentValue)
+
+    if load != None:
+        pages = {p.stem: p.read_bytes() for p in load.glob('*.bin')}
+    elif disk != None:
+        pages = SgioSmartReader().read_pages(disk)
+        if dump != None:
+            dump.mkdir(parents=True, exist_ok=True)
+            for name, raw in pages.items():
+                (dump / (name + '.bin')).write_bytes(raw)
+    else:
+        print("Specify a disk with -d, or captured pages with --load.")
+        sys.exit(2)
+
+    attrs, assessment = SgioSmartReader.decode_pages(pages)
+    print(f"Assessment: {assessment}")
+    for a in attrs:
+        print(f"{a.index:>8} {a.name:<32} {str(a.value):>5} {str(a.worst):>5} {str(a.threshold):>5} {a.attr_type:<9} {a.raw_value} {a.when_failed}")
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import threading
+import logging
+
+from typing import Awaitable, Callable, Optional
+from hddmondtools.hddmon_dataclasses import SmartData
+
+#
+#   SmartSnapshotCache holds the last SmartData read from a device, so reading a drive's SMART data doesn't mean
+#   running smartctl every time. Snapshots younger than max_age are handed out as-is. When a refresh is needed and
+#   one is already running (in another thread), callers wait for that one instead of starting their own.
+#
+#   With an async_refresh_func, the same goes for coroutines through refresh_async(). A get() on the event loop
+#   thread never blocks: it hands out the stale snapshot and refreshes in the background.
+#
+
+class SmartSnapshotCache:
+
+    def __init__(self, refresh_func: Callable[[], SmartData], max_age: float = 30, name: str = '', async_refresh_func: Callable[[], Awaitable[SmartData]] = None):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__ + f'[{name}]')
+        self.logger.setLevel(logging.DEBUG)
+        self._refresh_func = refresh_func
+        self._async_refresh_func = async_refresh_func
+        self._async_inflight: Optional[asyncio.Task] = None
+        self.max_age = max_age #seconds
+        self._snapshot: Optional[SmartData] = None
+        self._captured = None #time.monotonic() of the last snapshot
+        self._lock = threading.Lock()
+        self._inflight: Optional[threading.Event] = None
+        self._last_error = None
+
+    @property
+    def age(self) -> Optional[float]:
+        """
+        Seconds since the snapshot was taken, or None if there isn't one.
+        """
+        if self._captured == None:
+            return None
+        return time.monotonic() - self._captured
+
+    @property
+    def fresh(self) -> bool:
+        age = self.age
+        return age != None and age <= self.max_age
+
+    def peek(self) -> Optional[SmartData]:
+        """
+        Returns the current snapshot without refreshing it, no matter how old it is.
+        """
+        return self._snapshot
+
+    def seed(self, snapshot: SmartData):
+        """
+        Stores a snapshot that was read some other way, like while the device was being identified.
+        """
+        self._snapshot = snapshot
+        self._captured = time.monotonic()
+
+    def invalidate(self):
+        self._captured = None
+
+    def get(self, max_age: float = None) -> SmartData:
+        """
+        Returns the snapshot if it is fresh enough, otherwise refreshes it.
+        """
+        max_age = self.max_age if max_age == None else max_age
+        age = self.age
+        if self._snapshot != None and age != None and age <= max_age:
+            return self._snapshot
+        if self._snapshot != None and self._async_refresh_func != None and self._on_loop():
+            self.refresh_background()
+            return self._snapshot
+        return self.refresh()
+
+    @staticmethod
+    def _on_loop() -> bool:
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def refresh_background(self) -> asyncio.Task:
+        """
+        Starts an async refresh without waiting for it. Must be called on the event loop thread.
+        """
+        if self._async_inflight == None:
+            self._async_inflight = asyncio.get_event_loop().create_task(self._refresh_async())
+            self._async_inflight.add_done_callback(self._background_done)
+        return self._async_inflight
+
+    def _background_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() != None:
+            self.logger.warn(f"Background SMART refresh failed: {str(task.exception())}")
+
+    async def get_async(self, max_age: float = None) -> SmartData:
+        max_age = self.max_age if max_age == None else max_age
+        age = self.age
+        if self._snapshot != None and age != None and age <= max_age:
+            return self._snapshot
+        return await self.refresh_async()
+
+    async def refresh_async(self) -> SmartData:
+        """
+        Takes a new snapshot without blocking the event loop. Concurrent callers share one refresh.
+        """
+        if self._async_refresh_func == None:
+            return await asyncio.get_event_loop().run_in_executor(None, self.refresh)
+        return await asyncio.shield(self.refresh_background())
+
+    async def _refresh_async(self) -> SmartData:
+        try:
+            snapshot = await self._async_refresh_func()
+            self._snapshot = snapshot
+            self._captured = time.monotonic()
+            self._last_error = None
+            return snapshot
+        except Exception as e:
+            self._last_error = e
+            raise
+        finally:
+            self._async_inflight = None
+
+    def refresh(self) -> SmartData:
+        """
+        Takes a new snapshot. If a refresh is already in flight, waits for it and returns its result instead.
+        """
+        with self._lock:
+            event = self._inflight
+            leader = event == None
+            if leader:
+                event = threading.Event()
+                self._inflight = event
+
+        if not leader:
+            event.wait()
+            if self._last_error != None and self._snapshot == None:
+                raise self._last_error
+            return self._snapshot
+
+        try:
+            snapshot = self._refresh_func()
+            self._snapshot = snapshot
+            self._captured = time.monotonic()
+            self._last_error = None
+            return snapshot
+        except Exception as e:
+            self._last_error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
@@ -0,0 +1,227 @@
+import math
+import time
+import asyncio
+import logging
+import threading
+
+from typing import Dict, Optional
+from injectable import injectable, inject
+
+from hddmontools.config_service import ConfigService
+from hddmontools.smartctl_client import SmartctlError, SmartctlUnsupported
+
+#
+#   The SmartGuard is what SMART calls go through, so a dying drive can only ever hurt itself. Each drive gets:
+#
+#       - One SMART command at a time, whether it comes from call() or call_sync(). A drive stuck in the kernel's SCSI
+#         error handling doesn't pile up processes or threads.
+#       - A hard timeout on every call. smartctl processes are killed by SmartctlClient when they run over, calls
+#         that fall back to pySMART in a thread are given up on. A call that was given up on still holds the drive
+#         until it really returns, so the next one can't start underneath it.
+#       - A circuit breaker. After a few failures in a row the drive is marked degraded and calls are refused for a
+#         backoff period, which doubles every time a trial call fails. One successful call closes the breaker again.
+#
+#   call() is for coroutines on the event loop. call_blocking() is for blocking functions awaited from the loop (i.e. SG_IO
+#   reads). call_sync() does the same for blocking callers off the loop (onboarding workers, executor threads). Blocking
+#   functions run on a thread of their own, never on the loop's executor, and are given up on when they run over.
+#
+
+class DriveDegraded(SmartctlError):
+    pass
+
+class DriveBreaker:
+    def __init__(self, node: str):
+        self.node = node
+        self.failures = 0 #Consecutive failures
+        self.open_until = None #time.monotonic() until which calls are refused, None while closed
+        self.backoff = None #seconds, the length of the current open period
+        self.last_error = None
+        self.gate = threading.Lock() #Held while a SMART call to the drive is running, from either call() or call_sync()
+
+    @property
+    def busy(self) -> bool:
+        return self.gate.locked()
+
+    @property
+    def degraded(self) -> bool:
+        return self.open_until != None
+
+    @property
+    def retry_in(self) -> float:
+        """
+        Seconds until the next call is let through, 0 if calls are allowed now.
+        """
+        if self.open_until == None:
+            return 0
+        return max(0, self.open_until - time.monotonic())
+
+@injectable(singleton=True)
+class SmartGuard:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        cfg = inject(ConfigService).data.get('smart', {})
+        self.timeout = cfg.get('timeout', 60) #seconds
+        self.threshold = cfg.get('breaker_threshold', 3) #consecutive failures before a drive is marked degraded
+        self.backoff_min = cfg.get('backoff_min', 60) #seconds
+        self.backoff_max = cfg.get('backoff_max', 3600) #seconds
+        self._breakers: Dict[str, DriveBreaker] = {}
+        self._lock = threading.Lock() #Breakers are made from the loop and from worker threads
+
+    def breaker(self, node: str) -> DriveBreaker:
+        with self._lock:
+            b = self._breakers.get(node, None)
+            if b == None:
+                b = DriveBreaker(node)
+                self._breakers[node] = b
+            return b
+
+    def degraded(self, node: str) -> bool:
+        b = self._breakers.get(node, None)
+        return b != None and b.degraded
+
+    def forget(self, node: str):
+        """
+        Drops a drive's breaker, i.e. when the device is removed and the node may be reused by another drive.
+        """
+        self._breakers.pop(node, None)
+
+    async def call(self, node: str, func, *args, timeout: Optional[float] = None):
+        """
+        Awaits func(*args) for a drive, with the drive's breaker and a hard timeout around it.
+        """
+        timeout = self.timeout if timeout == None else timeout
+        b = self.breaker(node)
+        self._check(b)
+
+        deadline = time.monotonic() + timeout
+        while not b.gate.acquire(blocking=False): #Polled, a call_sync() on a worker thread may be holding it.
+            if time.monotonic() >= deadline:
+                raise SmartctlError(f"Timed out waiting for another SMART call to {node}")
+            await asyncio.sleep(0.1)
+        try:
+            self._check(b) #Another call failed while we were waiting.
+            task = asyncio.ensure_future(func(*args))
+        except BaseException:
+            b.gate.release()
+            raise
+        task.add_done_callback(lambda t: self._finished(b, t))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), timeout + 5) #SmartctlClient enforces the timeout itself, this catches executor fallbacks.
+        except SmartctlUnsupported:
+            raise
+        except asyncio.TimeoutError:
+            self._failed(b, f"timed out after {timeout} seconds")
+            raise SmartctlError(f"SMART call to {node} timed out after {timeout} seconds")
+        except Exception as e:
+            self._failed(b, str(e))
+            raise
+        self._succeeded(b)
+        return result
+
+    async def call_blocking(self, node: str, func, *args, timeout: Optional[float] = None):
+        """
+        Awaits a blocking func(*args) for a drive, like call(). It runs on a thread of its own, so a call stuck in the
+        kernel's error handling doesn't tie up a thread of the loop's executor.
+        """
+        return await self.call(node, self._in_thread, node, func, *args, timeout=timeout)
+
+    def call_sync(self, node: str, func, *args, timeout: Optional[float] = None):
+        """
+        Calls func(*args) for a drive from a blocking context, with the drive's breaker and a hard timeout around it.
+        """
+        timeout = self.timeout if timeout == None else timeout
+        b = self.breaker(node)
+        self._check(b)
+
+        if not b.gate.acquire(timeout=timeout):
+            raise SmartctlError(f"Timed out waiting for another SMART call to {node}")
+        outcome = {}
+        def target():
+            try:
+                outcome['result'] = func(*args)
+            except BaseException as e:
+                outcome['error'] = e
+            finally:
+                b.gate.release() #Only once the call has really returned, even if we gave up on it.
+        try:
+            self._check(b) #Another call failed while we were waiting.
+            t = threading.Thread(target=target, name=f"{node}_smart", daemon=True)
+            t.start()
+        except BaseException:
+            b.gate.release()
+            raise
+        t.join(timeout)
+        if t.is_alive():
+            self._failed(b, f"timed out after {timeout} seconds")
+            raise SmartctlError(f"SMART call to {node} timed out after {timeout} seconds")
+        e = outcome.get('error', None)
+        if isinstance(e, SmartctlUnsupported):
+            raise e
+        if e != None:
+            self._failed(b, str(e))
+            raise e
+        self._succeeded(b)
+        return outcome.get('result', None)
+
+    @staticmethod
+    def _in_thread(node: str, func, *args) -> asyncio.Future:
+
+        #   Runs func(*args) on a daemon thread of its own, and returns a future of the loop for its outcome.
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        def settle(result, error):
+            if future.done():
+                return
+            if error != None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        def target():
+            result, error = None, None
+            try:
+                result = func(*args)
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(settle, result, error)
+            except RuntimeError:
+                pass #The loop was closed while we were stuck.
+        threading.Thread(target=target, name=f"{node}_smart", daemon=True).start()
+        return future
+
+    def _check(self, b: DriveBreaker):
+        if b.retry_in > 0:
+            raise DriveDegraded(f"{b.node} is degraded, SMART calls are held off for another {math.ceil(b.retry_in)} seconds (last error: {b.last_error})")
+
+    def _finished(self, b: DriveBreaker, task: asyncio.Future):
+
+        #   A call() has really finished, maybe long after we gave up on it.
+
+        b.gate.release()
+        if not task.cancelled():
+            task.exception() #Retrieved, so a call we gave up on doesn't log an unretrieved exception.
+
+    def _failed(self, b: DriveBreaker, error: str):
+        b.failures += 1
+        b.last_error = error
+        if b.degraded:
+            b.backoff = min(b.backoff * 2, self.backoff_max)
+        elif b.failures >= self.threshold:
+            b.backoff = self.backoff_min
+            self.logger.warn(f"{b.node} failed {b.failures} SMART calls in a row and is now degraded.")
+        else:
+            self.logger.debug(f"SMART call to {b.node} failed ({b.failures}/{self.threshold}): {error}")
+            return
+        b.open_until = time.monotonic() + b.backoff
+        self.logger.debug(f"Holding off SMART calls to {b.node} for {b.backoff} seconds.")
+
+    def _succeeded(self, b: DriveBreaker):
+        if b.degraded:
+            self.logger.info(f"{b.node} answered SMART calls again, no longer degraded.")
+        b.failures = 0
+        b.open_until = None
+        b.backoff = None
+        b.last_error = None
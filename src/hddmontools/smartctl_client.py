@@ -0,0 +1,214 @@
+import json
+import asyncio
+import logging
+import datetime
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from injectable import injectable, inject
+
+from hddmondtools.hddmon_dataclasses import SmartData, AttributeData, smart_int
+from hddmontools.config_service import ConfigService
+
+#
+#   SmartctlClient talks to smartctl without blocking the event loop or tying up a thread. It runs smartctl with
+#   --json through asyncio's subprocess support and parses the output into our own dataclasses.
+#
+#   smartctl only has JSON output since 7.0. On older versions every call raises SmartctlUnsupported, and callers
+#   should fall back to pySMART in an executor.
+#
+#   Every run has a hard timeout. smartctl can hang for minutes on a failing drive, so when it runs over it is
+#   killed and SmartctlTimeout is raised.
+#
+
+class SmartctlError(Exception):
+    pass
+
+class SmartctlUnsupported(SmartctlError):
+    pass
+
+class SmartctlTimeout(SmartctlError):
+    pass
+
+@dataclass
+class SelfTestStatus:
+    running: bool
+    progress: int #Percent complete, 0-100
+    status: str
+    passed: Optional[bool] = None #None while running, or when the result is unknown
+    aborted: bool = False
+    polling_minutes: Dict[str, int] = field(default_factory=dict) #{'short': 2, 'extended': 120, ...}
+
+@injectable(singleton=True)
+class SmartctlClient:
+
+    smartctl = 'smartctl'
+
+    # Bits of smartctl's exit status, see smartctl(8)
+    EXIT_CMDLINE = 0x01
+    EXIT_OPEN_FAILED = 0x02
+    EXIT_COMMAND_FAILED = 0x04
+
+    # smartctl's JSON says 'now' and 'past' where its table (and so pySMART) says these
+    WHEN_FAILED = {'': '-', 'now': 'FAILING_NOW', 'past': 'In_the_past'}
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.supported = None #Unknown until smartctl is first run
+        self.timeout = inject(ConfigService).data.get('smart', {}).get('timeout', 60) #seconds
+
+    async def run(self, node: str, *args, timeout: Optional[float] = None) -> dict:
+        """
+        Runs smartctl with JSON output against a device and returns the parsed output.
+        """
+        if self.supported == False:
+            raise SmartctlUnsupported("smartctl doesn't support JSON output")
+
+        timeout = self.timeout if timeout == None else timeout
+        proc = await asyncio.create_subprocess_exec(self.smartctl, '--json=c', *args, node, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            self._kill(proc)
+            raise SmartctlTimeout(f"smartctl {' '.join(args)} on {node} didn't finish within {timeout} seconds and was killed")
+        except asyncio.CancelledError:
+            self._kill(proc)
+            raise
+        rc = proc.returncode
+
+        try:
+            data = json.loads(out)
+        except ValueError:
+            if rc & self.EXIT_CMDLINE:
+                self.supported = False
+                self.logger.warn("smartctl doesn't support --json (7.0 or newer is needed). Falling back to pySMART.")
+                raise SmartctlUnsupported("smartctl doesn't support JSON output")
+            raise SmartctlError(f"smartctl gave unreadable output for {node} (exit status {rc}): {err.decode(errors='replace').strip()}")
+        self.supported = True
+
+        if rc & (self.EXIT_CMDLINE | self.EXIT_OPEN_FAILED):
+            raise SmartctlError(f"smartctl failed on {node} (exit status {rc}): {'; '.join(SmartctlClient.messages(data))}")
+        return data
+
+    def _kill(self, proc):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            return
+        # A process stuck in uninterruptible sleep only dies once the kernel lets go of it, so reap it in the background.
+        asyncio.get_event_loop().create_task(proc.wait())
+
+    async def read_smart(self, node: str) -> SmartData:
+        return SmartctlClient.parse_smart(await self.run(node, '-a'))
+
+    async def get_selftest_status(self, node: str) -> SelfTestStatus:
+        return SmartctlClient.parse_selftest_status(await self.run(node, '-c', '-l', 'selftest'))
+
+    async def start_selftest(self, node: str, test_type: str) -> dict:
+        """
+        Starts a self-test ('short', 'long', 'conveyance', ...) and returns immediately. smartctl's -t is case sensitive,
+        the test type is lowercased for it ('Short' from the UI is 'short').
+        """
+        test_type = str(test_type).lower()
+        data = await self.run(node, '-t', test_type)
+        if data.get('smartctl', {}).get('exit_status', 0) & self.EXIT_COMMAND_FAILED:
+            raise SmartctlError(f"Couldn't start {test_type} self-test on {node}: {'; '.join(SmartctlClient.messages(data))}")
+        return data
+
+    async def abort_selftest(self, node: str) -> dict:
+        return await self.run(node, '-X')
+
+    @staticmethod
+    def messages(data: dict) -> List[str]:
+        return [str(m.get('string', '')) for m in data.get('smartctl', {}).get('messages', [])]
+
+    @staticmethod
+    def parse_smart(data: dict) -> SmartData:
+        attrs = []
+        for a in data.get('ata_smart_attributes', {}).get('table', []):
+            flags = a.get('flags', {})
+            raw = smart_int(a.get('raw', {}).get('string', None)) #The raw value as smartctl prints it, like pySMART has it
+            if raw == None:
+                raw = smart_int(a.get('raw', {}).get('value'))
+            when_failed = a.get('when_failed', '') or ''
+            attrs.append(AttributeData(
+                smart_int(a.get('id')),
+                a.get('name'),
+                smart_int(flags.get('value')),
+                raw,
+                smart_int(a.get('thresh')),
+                'Pre-fail' if flags.get('prefailure', False) else 'Old_age',
+                'Always' if flags.get('updated_online', False) else 'Offline',
+                smart_int(a.get('value')),
+                SmartctlClient.WHEN_FAILED.get(when_failed, when_failed),
+                smart_int(a.get('worst')),
+            ))
+
+        capabilities = data.get('ata_smart_data', {}).get('capabilities', {})
+        if len(capabilities) > 0:
+            test_capabilities = [
+                ('offline', bool(capabilities.get('exec_offline_immediate_supported', False))),
+                ('short', bool(capabilities.get('self_tests_supported', False))),
+                ('long', bool(capabilities.get('self_tests_supported', False))),
+                ('conveyance', bool(capabilities.get('conveyance_self_test_supported', False))),
+                ('selective', bool(capabilities.get('selective_self_test_supported', False))),
+            ]
+        else:
+            selftests = ('nvme_self_test_log' in data) or ('scsi_self_test_0' in data)
+            test_capabilities = [('offline', False), ('short', selftests), ('long', selftests), ('conveyance', False), ('selective', False)]
+
+        status = data.get('smart_status', {})
+        if 'passed' in status:
+            assessment = 'PASS' if status['passed'] else 'FAIL'
+        else:
+            assessment = None
+
+        support = data.get('smart_support', {})
+        return SmartData(
+            datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            attrs,
+            data.get('firmware_version'),
+            data.get('device', {}).get('type'),
+            SmartctlClient.messages(data),
+            bool(support.get('available', False)),
+            bool(support.get('enabled', False)),
+            assessment,
+            test_capabilities,
+        )
+
+    @staticmethod
+    def parse_selftest_status(data: dict) -> SelfTestStatus:
+        ata = data.get('ata_smart_data', {}).get('self_test', None)
+        if ata != None:
+            status = ata.get('status', {})
+            value = int(status.get('value', 0))
+            code = value >> 4 #The high nibble is the result, the low nibble is the remaining tenths while running
+            polling = ata.get('polling_minutes', {})
+            if code == 0xf:
+                remaining = status.get('remaining_percent', (value & 0xf) * 10)
+                return SelfTestStatus(True, 100 - int(remaining), status.get('string', ''), polling_minutes=polling)
+            return SelfTestStatus(False, 100, status.get('string', ''), passed=(code == 0) if code not in (1, 2) else None, aborted=code in (1, 2), polling_minutes=polling)
+
+        nvme = data.get('nvme_self_test_log', None)
+        if nvme != None:
+            operation = nvme.get('current_self_test_operation', {})
+            if int(operation.get('value', 0)) != 0:
+                return SelfTestStatus(True, int(nvme.get('current_self_test_completion_percent', 0)), operation.get('string', ''))
+            table = nvme.get('table', [])
+            if len(table) <= 0:
+                return SelfTestStatus(False, 100, "No self-tests have been logged")
+            result = table[0].get('self_test_result', {})
+            value = int(result.get('value', 0xf))
+            return SelfTestStatus(False, 100, result.get('string', ''), passed=(value == 0) if value not in (1, 2, 0xf) else None, aborted=value in (1, 2))
+
+        scsi = data.get('scsi_self_test_0', None)
+        if scsi != None:
+            result = scsi.get('result', {})
+            value = int(result.get('value', 0))
+            if value == 0xf:
+                return SelfTestStatus(True, 0, result.get('string', '')) #SCSI drives don't report progress this way.
+            polling = {'extended': int(data.get('scsi_extended_self_test_seconds', 0)) // 60}
+            return SelfTestStatus(False, 100, result.get('string', ''), passed=(value == 0) if value not in (1, 2) else None, aborted=value in (1, 2), polling_minutes=polling)
+
+        return SelfTestStatus(False, 100, "No self-test information available")
@@ -1,4 +1,5 @@
 from hddmontools.hdd_detector import HddDetector
+from hddmontools.sysfs_enumerator import SysfsEnumerator
 from pySMART import DeviceList, Device
 
 import threading
@@ -13,9 +14,10 @@ class SmartctlDetector(HddDetector):
         self.logger.setLevel(logging.DEBUG)
         self.logger.info("Initializing SmartctlDetector...")
         self._callbacks = []
-        self._dev_cache = []
+        self._dev_cache = set() #{(node, serial, wwn)}
         self._loopgo = True
         self._poll_interval = poll_interval
+        self._enumerator = SysfsEnumerator()
 
     async def start(self):
         self.logger.info("Starting SmartctlDetector...")
@@ -26,33 +28,30 @@ class SmartctlDetector(HddDetector):
         self._loopgo = False
 
     def _make_device_list(self):
-        return DeviceList()
+        """
+        Returns a set of (node, serial, wwn) identities. Sysfs is read when possible, since asking smartctl probes every drive.
+        """
+        if self._enumerator.available:
+            return {d.identity for d in self._enumerator.enumerate().values()}
+        return {(f"/dev/{d.name}", d.serial, None) for d in DeviceList().devices}
 
     async def _poll_method(self):
         loop = asyncio.get_event_loop()
         while self._loopgo:
-            dev_list = await loop.run_in_executor(None, self._make_device_list)
-            devices = dev_list.devices
-            for d in devices:
-                for cd in self._dev_cache:
-                    if d.serial == cd.serial:
-                        self._dev_cache.remove(cd) #It exists!
-                        break
-                else:
-                    self._do_callback('add', d) #It doesn't exist, let people know it is new.
-            
-            for d in self._dev_cache:
-                #These devices weren't found during the last comparison, so they must have been removed.
-                #self._dev_cache.remove(d)
-                self._do_callback('remove', d)
-
-            self._dev_cache = devices.copy() #Our new cache is what we were given this round.
+            current = await loop.run_in_executor(None, self._make_device_list)
+
+            for node, serial, _wwn in self._dev_cache - current:
+                self._do_callback('remove', serial, node) #These devices weren't found during this comparison, so they must have been removed.
+            for node, serial, _wwn in current - self._dev_cache:
+                self._do_callback('add', serial, node) #It doesn't exist, let people know it is new.
+
+            self._dev_cache = current #Our new cache is what we were given this round.
             await asyncio.sleep(self._poll_interval)
 
-    def _do_callback(self, action, device: Device):
+    def _do_callback(self, action, serial, node):
         for c in self._callbacks:
             if callable(c):
-                c(action=action, serial=device.serial, node=f"/dev/{device.name}")
+                c(action=action, serial=serial, node=node)
 
     def add_change_callback(self, callback):
-        self._callbacks.append(callback)
\ No newline at end of file
+        self._callbacks.append(callback)
@@ -0,0 +1,107 @@
+import os
+import re
+import logging
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+#
+#   This file holds a cheap way of finding out which block devices exist, straight from sysfs. It doesn't touch the
+#   drives at all, so it can be run as often as needed. The expensive Hdd(node) construction (smartctl, udev, port
+#   detection) should only happen for nodes this enumerator reports as new.
+#
+
+@dataclass(frozen=True)
+class SysfsDevice:
+    name: str
+    node: str
+    model: Optional[str]
+    serial: Optional[str]
+    wwn: Optional[str]
+    size: int #in bytes
+
+    @property
+    def identity(self) -> Tuple[str, Optional[str], Optional[str]]:
+        """
+        The key used to tell devices apart between enumerations. A different drive on the same node is a different device.
+        """
+        return (self.node, self.serial, self.wwn)
+
+class SysfsEnumerator:
+
+    # Whole-disk kernel names only. Partitions (sda1, nvme0n1p1) and virtual devices (loop, dm, zram) are ignored.
+    disk_name_pattern = re.compile(r'^(sd[a-z]+|hd[a-z]+|nvme\d+n\d+)$')
+
+    def __init__(self, sysfs_root='/sys'):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self._block = Path(sysfs_root) / 'block'
+
+    @property
+    def available(self) -> bool:
+        return self._block.is_dir()
+
+    def names(self) -> List[str]:
+        """
+        Returns the kernel names of all whole disks, without reading any of their attributes.
+        """
+        try:
+            return sorted(n for n in os.listdir(self._block) if self.disk_name_pattern.match(n))
+        except OSError:
+            return []
+
+    def enumerate(self) -> Dict[str, SysfsDevice]:
+        """
+        Reads every disk's identity in one pass. Returns {node: SysfsDevice}
+        """
+        devices = {}
+        for name in self.names():
+            d = self.read_device(name)
+            if d != None:
+                devices[d.node] = d
+        return devices
+
+    def read_device(self, name: str) -> Optional[SysfsDevice]:
+        name = name.replace('/dev/', '')
+        block = self._block / name
+        if not block.exists():
+            return None
+        device = block / 'device'
+
+        serial = self._read_attr(device / 'serial')
+        if serial == None:
+            serial = self._read_vpd_serial(device / 'vpd_pg80')
+        wwn = self._read_attr(device / 'wwid')
+        if wwn == None:
+            wwn = self._read_attr(block / 'wwid') #NVMe namespaces keep it here
+        model = self._read_attr(device / 'model')
+
+        try:
+            size = int(self._read_attr(block / 'size') or 0) * 512 #Always in 512-byte sectors, no matter the drive's sector size
+        except ValueError:
+            size = 0
+
+        return SysfsDevice(name, '/dev/' + name, model, serial, wwn, size)
+
+    @staticmethod
+    def _read_attr(path: Path) -> Optional[str]:
+        try:
+            s = path.read_text().strip()
+        except (OSError, UnicodeDecodeError):
+            return None
+        return s if s != '' else None
+
+    @staticmethod
+    def _read_vpd_serial(path: Path) -> Optional[str]:
+        # The unit serial number VPD page is a 4 byte header followed by the ASCII serial. SATA drives behind
+        # libata only expose their serial this way.
+        try:
+            page = path.read_bytes()
+        except OSError:
+            return None
+        if len(page) < 4:
+            return None
+        length = page[3]
+        s = page[4:4 + length].decode('ascii', errors='ignore').strip()
+        return s if s != '' else None
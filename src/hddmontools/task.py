@@ -1,4 +1,5 @@
 import os
+import json
 import enum
 import subprocess
 from subprocess import TimeoutExpired
@@ -12,7 +13,14 @@ from .image import ImageManager
 from .task_service import TaskService
 import datetime
 from hddmontools.hdd_interface import TaskQueueInterface
-from injectable import Autowired, autowired, injectable
+from injectable import Autowired, autowired, injectable, inject
+from .process_watcher import ProcessWatcher
+from .erase_engine import EraseEngine, EraseAborted, describe_pattern
+from .erase_journal import EraseJournal, EraseCheckpoint
+from .verify_engine import VerifyEngine, SampleVerifyEngine
+from .io_scheduler import IoScheduler
+from .thread_drain import ThreadDrain
+from .config_service import ConfigService
 from abc import ABC, abstractmethod
 from typing import Coroutine
 
@@ -28,14 +36,14 @@ class Task:
     display_name = "Task"
 
     @staticmethod
-    def GetTaskParameterSchema(task):
+    def GetTaskParameterSchema(task, hdd=None):
         s: str = None
 
         if task.parameter_schema == None:
             return None
 
         if callable(task.parameter_schema):
-            s = task.parameter_schema(task)
+            s = task.parameter_schema(task, hdd=hdd)
         else:
             s = str(task.parameter_schema)
         return s
@@ -210,10 +218,7 @@ class TaskQueue(TaskQueueInterface): #TODO: Use asyncio for polling and looping!
         Helper method to create the queue thread if none exists in the moment.
         """
         if threading.current_thread() != threading.main_thread():
-            async def thread_shim():
-                nonlocal self
-                asyncio.get_event_loop().create_task(self._launch_new_task())
-            asyncio.run_coroutine_threadsafe(thread_shim())
+            ThreadDrain.for_loop(self._loop).call(self._create_queue_thread)
         else:
             loop = asyncio.get_event_loop()
             self._queue_thread = loop.create_task(self._launch_new_task()) #This async task should exit soon after the start() function of the task exits. This async task is just to offload the sleep between tasks, and detach from the last finished thread.
@@ -327,7 +332,9 @@ class TaskQueue(TaskQueueInterface): #TODO: Use asyncio for polling and looping!
         if(self.CurrentTask != None):
             self.Pause = pause
             t = self.CurrentTask
-            self.CurrentTask.abort()
+            r = self.CurrentTask.abort()
+            if asyncio.iscoroutine(r):
+                asyncio.ensure_future(r)
             self._taskchanged_cb(action='taskabort', data={'task': t})
         
     def _taskchanged_cb(self, *args, **kw):
@@ -341,15 +348,9 @@ class TaskQueue(TaskQueueInterface): #TODO: Use asyncio for polling and looping!
             if threading.current_thread() != threading.main_thread():
 
                 #! Important! Since some tasks use threads to call back, higher-up async stuff will fail!
-                #  Use loop.call_soon_threadsafe or asyncio.run_coroutine_threadsafe to schedule async tasks back in the main loop.
+                #  Thread events are handed to the main loop, in batches, through the loop's ThreadDrain.
 
-                async def _callback_shim():
-                    nonlocal self
-                    nonlocal args
-                    nonlocal kw
-                    self._task_change_callback(*args, **kw)
-
-                asyncio.run_coroutine_threadsafe(_callback_shim(), self._loop)
+                ThreadDrain.for_loop(self._loop).call(self._taskchanged_cb, *args, **kw)
             else:
                 if(isinstance(self._task_change_callback, Coroutine)):
                     asyncio.get_event_loop().create_task(self._task_change_callback(*args, **kw))
@@ -412,11 +413,12 @@ class ExternalTask(Task):
             return True
 
     async def _pollProcess(self):
-        while self._poll == True and self._finished == False:
-            if(self._procview.is_alive == False): # is_alive is a generated bool, evaluating every time we check it. This should be a real-time status. 
+        if self._poll == True and self._finished == False:
+            try:
+                await inject(ProcessWatcher).wait(self._PID) #Wakes up the moment the process exits, costs nothing until then.
                 self._finished = True
-            else:
-                await asyncio.sleep(self._pollingInterval)
+            except asyncio.CancelledError:
+                pass #Detached
 
         self.notes.add("The process has exited.", note_taker="hddmond")
         self.time_ended = datetime.datetime.now(datetime.timezone.utc)
@@ -446,64 +448,262 @@ class ExternalTask(Task):
         Should be used only when quitting the hddmon-daemon program
         '''
         self._poll = False
-        while not self._pollingTask.done():
-            await asyncio.sleep(0)
+        if self._pollingTask != None:
+            self._pollingTask.cancel()
+            await asyncio.wait([self._pollingTask])
         self.notes.add("The process was detatched from the hddmond monitor.", note_taker="hddmond")
 
     
 class EraseTask(Task):
 
-    display_name = "Scrub Erase"
+    display_name = "Erase"
 
-    parameter_schema = None
+    @staticmethod
+    def parameter_schema(task, hdd=None, **kw):
+
+        #   The passes default to the configured ones. Resuming is only offered when there is an interrupted erase of
+        #   this drive.
+
+        passes = inject(ConfigService).data.get('erase', {}).get('passes', ['ff'])
+        c = inject(EraseJournal).load(hdd.serial, hdd.wwn) if hdd != None else None
+        default = {'passes': passes}
+        resume = ""
+        if c != None:
+            default['resume'] = True
+            resume = """,
+        "resume": {{
+            "default": true,
+            "description": "An erase of this drive was interrupted at {0}% ({1}). Resume it from there with the passes it was started with, or start over?",
+            "examples": [
+                true
+            ],
+            "title": "Resume erase",
+            "type": "boolean"
+        }}""".format(c.progress, c.updated)
+
+        schema = """{{
+    "default": {0},
+    "description": "Parameters that are needed for the Erase task",
+    "examples": [
+        {{
+            "passes": ["00", "ff"]
+        }}
+    ],
+    "required": [],
+    "title": "Erase task parameters",
+    "properties": {{
+        "passes": {{
+            "default": {1},
+            "description": "The patterns written over the whole drive, one pass each, in order. A pattern is one or more bytes in hex (i.e. 'ff', '55aa'), or 'random'. The last pass is what a Verify checks for.",
+            "examples": [
+                ["ff"],
+                ["random", "00"]
+            ],
+            "title": "Passes",
+            "type": "array",
+            "minItems": 1,
+            "items": {{
+                "type": "string"
+            }}
+        }}{2}
+    }},
+    "additionalProperties": true
+}}""".format(json.dumps(default), json.dumps(passes), resume)
+        return schema
 
     def __getstate__(self):
         state = self.__dict__.copy()
-        state['_pollingThread'] = None
-        state['_subproc'] = None
+        state['_engine'] = None
+        state['_loop'] = None
+        state['_done'] = None
+        state['_journal'] = None
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._journal = inject(EraseJournal)
 
-    def __init__(self, hdd, pollingInterval = 5, callback=None):
-        self._subproc = None
-        self._procview = None
-        self._PID = None
-        self._diskusage = None
-        self._cap_in_bytes = None
-        self._progress = 0
+    def __init__(self, hdd, passes=None, callback=None, resume=False, **kw):
+        cfg = inject(ConfigService).data.get('erase', {})
         self.node = hdd.node
-        self.Capacity = int(hdd.capacity if hdd.capacity != None else -1)
-        self._monitor = True
-        self._started = False
+        self.serial = hdd.serial
+        self.wwn = hdd.wwn
+        self._journal = inject(EraseJournal)
+        self._resume_from = self._journal.load(self.serial, self.wwn) if resume == True else None
+        if self._resume_from != None:
+            passes = self._resume_from.passes #The rest of the erase that was started, not a different one.
+        self.passes = list(passes if passes != None else cfg.get('passes', ['ff'])) #Patterns, one per pass. See erase_engine.py
+        self._chunk_size = cfg.get('chunk_size', 4 * 1024 * 1024) #bytes per write
+        self._engine = EraseEngine(self.node, self.passes, self._chunk_size, progress_callback=self._engine_progress,
+                                   checkpoint_callback=self._checkpoint, checkpoint_interval=cfg.get('checkpoint_interval', 30),
+                                   budget=inject(IoScheduler).budget(hdd)) #Validates the patterns now, not when the task comes up.
+        self._detached = False
+        self._loop = None
+        self._done = None
+        self._progress = 0
+        self._bytes_done = 0
+        self._total_bytes = None
         self._returncode = None
-        self._pollingInterval = pollingInterval
-        self._pollingTask = None #threading.Thread(target=self._monitorProgress, name=str(self.node) + "_eraseTask")
-        self._subproc = None
-        self._PID = None
-        self._procview = None
         super(EraseTask, self).__init__("Erase", hdd)
         self._callback = callback
         self._progress_cb = None
 
     @property
-    def Capacity(self):
-        '''
-        Get the capacity in GIGAbytes
-        '''
-        return float(self._cap_in_bytes / 10000000) #1*10^7
+    def PID(self):
+        return None #Erasing runs in a thread of our own process.
 
-    @Capacity.setter
-    def Capacity(self, value):
+    @property
+    def Progress(self):
+        return self._progress
+
+    @property
+    def BytesDone(self):
+        return self._bytes_done
+
+    @property
+    def TotalBytes(self):
+        return self._total_bytes
+
+    @property
+    def Finished(self):
+        return self._returncode != None
+        
+    def start(self, progress_callback=None):
+        self.time_started = datetime.datetime.now(datetime.timezone.utc)
+        self._progress_cb = progress_callback
+        self._loop = asyncio.get_event_loop()
+        self._done = self._loop.create_future()
+        c = self._resume_from
+        if c != None:
+            self._progress = c.progress
+            self.notes.add(f"Erasing was resumed on this storage device at {c.progress}%, from a checkpoint of {c.updated}.", note_taker="hddmond")
+            start = (c.pass_index, c.offset, c.size)
+        else:
+            self._journal.clear(self.serial, self.wwn) #Starting over, if there was anything to resume.
+            self.notes.add(f"Erasing was started on this storage device, writing {self._describe_passes()}.", note_taker="hddmond")
+            start = (0, 0, None)
+        self._progressString = "Erasing " + str(self.Progress) + "%"
+        self._engine.start(lambda e: self._loop.call_soon_threadsafe(self._engine_done, e), *start)
+
+    async def abort(self, wait=False):
+        if self._engine == None or self._done == None:
+            return
+        if not self.Finished:
+            self.notes.add("Erase task aborted at " + str(self.Progress) + "%.", note_taker="hddmond")
+        self._engine.abort()
+        if wait == True:
+            print("\tWaiting for the erase of {0} to stop...".format(self.node))
+            await asyncio.wait([self._done])
+
+    async def detach(self):
         '''
-        Set the capacity in GIGAbytes
+        Stops erasing but keeps the checkpoint, so the erase can be resumed when the drive comes back.
         '''
-        self._cap_in_bytes = float(float(value) * 10000000.0)
+        if self._engine == None or self._done == None or self.Finished:
+            return
+        self._detached = True
+        self._engine.abort()
+        await asyncio.wait([self._done])
+
+    def _checkpoint(self, engine: EraseEngine):
+
+        #   Called from the engine's thread, after it flushed the drive.
+
+        self._journal.save(EraseCheckpoint(self.serial, self.wwn, engine.size, engine.sector_size, self.passes, engine.pass_index, engine.offset // engine.sector_size))
+
+    def _engine_progress(self, done: int, total: int):
+
+        #   Called from the engine's thread after every write. The loop only hears about it when the percentage moves.
+
+        self._bytes_done = done
+        self._total_bytes = total
+        progress = int(done * 100 / total) if total > 0 else 0
+        if progress != self._progress:
+            self._progress = progress
+            self._loop.call_soon_threadsafe(self._report_progress)
+
+    def _report_progress(self):
+        engine = self._engine
+        self._progressString = "Erasing " + str(self.Progress) + "%" + (f" (pass {min(engine.pass_index + 1, len(self.passes))}/{len(self.passes)})" if len(self.passes) > 1 else '')
+        if(self._progress_cb != None) and callable(self._progress_cb):
+            self._progress_cb(self.Progress, self._progressString)
+
+    def _engine_done(self, engine: EraseEngine):
+        self.time_ended = datetime.datetime.now(datetime.timezone.utc)
+        if engine.error == None:
+            self._returncode = 0
+            self.notes.add(f"Full erase performed on storage device. Wrote {self._describe_passes()} to all {engine.size} bytes.", note_taker="hddmond")
+            self._journal.clear(self.serial, self.wwn)
+        elif isinstance(engine.error, EraseAborted):
+            self._returncode = -1
+            if self._detached:
+                self.notes.add(f"Erasing was detached at {self.Progress}%. It can be resumed when the drive is connected again.", note_taker="hddmond")
+            else:
+                self._journal.clear(self.serial, self.wwn)
+        else:
+            self._returncode = 1
+            self.notes.add(f"Erase task failed at {self.Progress}%: {str(engine.error)}. It can be resumed from the last checkpoint.", note_taker="hddmond")
+        self.returncode = self._returncode
+        self._progressString = "Erased" if self._returncode == 0 else "Erase stopped at " + str(self.Progress) + "%"
+        if not self._done.done():
+            self._done.set_result(self._returncode)
+        if(self._callback != None):
+            self._callback(self._returncode)
+
+    def _describe_passes(self):
+        described = [describe_pattern(p) for p in self.passes]
+        return (f"{len(described)} passes of " if len(described) > 1 else '') + ", then ".join(described)
+
+TaskService.register(EraseTask.display_name, EraseTask)
+
+class VerifyTask(Task):
+
+    display_name = "Verify"
+
+    parameter_schema = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_engine'] = None
+        state['_loop'] = None
+        state['_done'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __init__(self, hdd, pattern=None, callback=None, **kw):
+        cfg = inject(ConfigService).data
+        self.node = hdd.node
+        self.pattern = pattern if pattern != None else VerifyTask._erased_with(hdd, cfg.get('erase', {}).get('passes', ['ff']))
+        self._engine = self._make_engine(cfg, budget=inject(IoScheduler).budget(hdd), **kw)
+        self._loop = None
+        self._done = None
+        self._progress = 0
+        self._returncode = None
+        super(VerifyTask, self).__init__(self.display_name, hdd)
+        self._callback = callback
+        self._progress_cb = None
+
+    def _make_engine(self, cfg, budget=None, **kw) -> VerifyEngine:
+        return VerifyEngine(self.node, self.pattern, cfg.get('erase', {}).get('chunk_size', 4 * 1024 * 1024),
+                            progress_callback=self._engine_progress, max_ranges=cfg.get('verify', {}).get('max_ranges', 100), budget=budget)
+
+    @staticmethod
+    def _erased_with(hdd, passes):
+
+        #   The pattern of the last pass of the most recent erase in the drive's queue, or else of the configured erase.
+
+        tq = hdd.TaskQueue
+        tasks = [t[1] for t in reversed(tq.Queue)] + [tq.CurrentTask] + list(tq.history)
+        for t in tasks:
+            if isinstance(t, EraseTask):
+                return t.passes[-1]
+        return passes[-1]
 
     @property
     def PID(self):
-        return self._PID
+        return None
 
     @property
     def Progress(self):
@@ -512,68 +712,158 @@ class EraseTask(Task):
     @property
     def Finished(self):
         return self._returncode != None
-        
+
     def start(self, progress_callback=None):
         self.time_started = datetime.datetime.now(datetime.timezone.utc)
         self._progress_cb = progress_callback
-        self._subproc = asyncio.create_subprocess_exec('scrub', '-f', '-p', 'fillff', self.node, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self._PID = self._subproc.pid
-        self._procview = proc.core.Process.from_pid(self._PID)
-        self._pollingTask = asyncio.get_event_loop().create_task(self._monitorProgress(), name="erase_task_poll")
-        self._progressString = "Erasing" + (" " + str(self.Progress) + "%" if self.Capacity != 0 else '') 
-        self.notes.add("Erasing was started on this storage device.", note_taker="hddmond")
+        self._loop = asyncio.get_event_loop()
+        self._done = self._loop.create_future()
+        self._progressString = "Verifying 0%"
+        self.notes.add(f"Verifying that this storage device reads back as {describe_pattern(self.pattern)}.", note_taker="hddmond")
+        self._engine.start(lambda e: self._loop.call_soon_threadsafe(self._engine_done, e))
 
     async def abort(self, wait=False):
-        if(self._subproc):
-            if(self.Finished == False):
-                self.notes.add("Erase task aborted at " + str(self.Progress) + "%.", note_taker="hddmond")
-            self._subproc.terminate()
+        if self._engine == None or self._done == None:
+            return
+        if not self.Finished:
+            self.notes.add("Verify task aborted at " + str(self.Progress) + "%.", note_taker="hddmond")
+        self._engine.abort()
         if wait == True:
-            print("\tWaiting for {0} to stop...".format(self._pollingTask.name))
-            while not self._pollingTask.done():
-                await asyncio.sleep(0)
+            await asyncio.wait([self._done])
 
+    def _engine_progress(self, done: int, total: int):
 
-    async def _monitorProgress(self):
+        #   Called from the engine's thread after every chunk.
 
-        if(self.Capacity > 0):
-            self._progress = int(self._procview.io['write_bytes'] / self._cap_in_bytes)
-            self._progressString = "Erasing " + str(self.Progress) + "%" 
-        else:
-            self._progress = -1
-            self._progressString = "Erasing"
+        progress = int(done * 100 / total) if total > 0 else 0
+        if progress != self._progress:
+            self._progress = progress
+            self._loop.call_soon_threadsafe(self._report_progress)
 
+    def _report_progress(self):
+        bad = self._engine.bad_sectors
+        self._progressString = "Verifying " + str(self.Progress) + "%" + (f" ({bad} bad sectors)" if bad > 0 else '')
         if(self._progress_cb != None) and callable(self._progress_cb):
             self._progress_cb(self.Progress, self._progressString)
 
-        lastprogress = self._progress
-        while self._monitor and (self._returncode == None):
-            
-            self._returncode = self._subproc.returncode
-            if(self._returncode == None):
-                io = self._procview.io
-                if(self.Capacity > 0):
-                    self._progress = int(io['write_bytes'] / self._cap_in_bytes)
-                    self._progressString = "Erasing " + str(self.Progress) + "%" 
-                else:
-                    self._progress = -1
-                    self._progressString = "Erasing"
-                time.sleep(self._pollingInterval)
-
-                if(self._progress != lastprogress):
-                    if(self._progress_cb != None) and callable(self._progress_cb):
-                        self._progress_cb(self.Progress, self._progressString)
-                    lastprogress = self._progress
-        self.returncode = self._returncode
+    def _engine_done(self, engine: VerifyEngine):
         self.time_ended = datetime.datetime.now(datetime.timezone.utc)
-        if(self._returncode == 0):
-            self.notes.add("Full erase performed on storage device. Wrote 0xFF to all bits.", note_taker="hddmond")
+        pattern = describe_pattern(self.pattern)
+        if isinstance(engine.error, EraseAborted):
+            self._returncode = -1
+        elif engine.error != None:
+            self._returncode = 1
+            self.notes.add(f"Verify task failed at {self.Progress}%: {str(engine.error)}", note_taker="hddmond")
+        elif engine.passed:
+            self._returncode = 0
+            self.notes.add(self._passed_note(engine, pattern), note_taker="hddmond")
         else:
-            self.notes.add(f"Erase task failed. Return code: {self.returncode}", note_taker="hddmond")
+            self._returncode = 1
+            ranges = ', '.join(f"{a}-{b - 1}" if b - a > 1 else str(a) for a, b in engine.mismatches)
+            more = " and more" if sum(b - a for a, b in engine.mismatches) < engine.bad_sectors else ''
+            unreadable = f", {engine.unreadable_sectors} of them unreadable" if engine.unreadable_sectors > 0 else ''
+            self.notes.add(f"{engine.bad_sectors} sectors don't read back as {pattern}{unreadable}. LBAs: {ranges}{more}.", note_taker="hddmond")
+        self.returncode = self._returncode
+        self._progressString = ("Verified" if self._returncode == 0 else "Verify stopped at " + str(self.Progress) + "%") if engine.bad_sectors == 0 else f"{engine.bad_sectors} bad sectors"
+        if not self._done.done():
+            self._done.set_result(self._returncode)
         if(self._callback != None):
             self._callback(self._returncode)
 
-TaskService.register(EraseTask.display_name, EraseTask)
+    def _passed_note(self, engine: VerifyEngine, pattern: str) -> str:
+        return f"Verified that all {engine.size} bytes read back as {pattern}."
+
+TaskService.register(VerifyTask.display_name, VerifyTask)
+
+class SampleVerifyTask(VerifyTask):
+
+    display_name = "Sample Verify"
+
+    @staticmethod
+    def parameter_schema(task, hdd=None, **kw):
+
+        #   The defaults are the configured ones.
+
+        vcfg = inject(ConfigService).data.get('verify', {})
+        schema = """{{
+    "default": {{
+        "confidence": {0},
+        "defect_rate": {1},
+        "samples": null
+    }},
+    "description": "Parameters that are needed for the Sample Verify task",
+    "examples": [
+        {{
+            "confidence": 0.999,
+            "defect_rate": 0.0001,
+            "samples": null
+        }}
+    ],
+    "required": [],
+    "title": "Sample Verify task parameters",
+    "properties": {{
+        "confidence": {{
+            "default": {0},
+            "description": "How sure the result has to be, between 0 and 1. More confidence reads more blocks.",
+            "examples": [
+                0.99
+            ],
+            "title": "Confidence",
+            "type": "number",
+            "exclusiveMinimum": 0,
+            "exclusiveMaximum": 1
+        }},
+        "defect_rate": {{
+            "default": {1},
+            "description": "The fraction of bad blocks to rule out, between 0 and 1. A smaller fraction reads more blocks.",
+            "examples": [
+                0.001
+            ],
+            "title": "Defect rate",
+            "type": "number",
+            "exclusiveMinimum": 0,
+            "exclusiveMaximum": 1
+        }},
+        "samples": {{
+            "default": null,
+            "description": "How many blocks to read, instead of working it out from the defect rate. The result then says which fraction of bad blocks that many rule out.",
+            "examples": [
+                4096
+            ],
+            "title": "Samples",
+            "type": ["integer", "null"],
+            "minimum": 1
+        }}
+    }},
+    "additionalProperties": true
+}}""".format(vcfg.get('confidence', 0.99), vcfg.get('defect_rate', 0.001))
+        return schema
+
+    def _make_engine(self, cfg, budget=None, confidence=None, defect_rate=None, samples=None, **kw) -> SampleVerifyEngine:
+        vcfg = cfg.get('verify', {})
+        return SampleVerifyEngine(self.node, self.pattern,
+                                  confidence=float(confidence if confidence != None else vcfg.get('confidence', 0.99)),
+                                  defect_rate=float(defect_rate if defect_rate != None else vcfg.get('defect_rate', 0.001)),
+                                  samples=int(samples) if samples not in (None, '') else None,
+                                  block_size=vcfg.get('sample_size', 1024 * 1024),
+                                  zones=vcfg.get('zones', 64),
+                                  workers=vcfg.get('workers', 4),
+                                  progress_callback=self._engine_progress,
+                                  max_ranges=vcfg.get('max_ranges', 100),
+                                  budget=budget)
+
+    @property
+    def statistics(self):
+        if self._engine == None or self._engine.size == None:
+            return None
+        return self._engine.statistics()
+
+    def _passed_note(self, engine: SampleVerifyEngine, pattern: str) -> str:
+        st = engine.statistics()
+        return (f"Sampled {st['samples']} blocks of {st['block_size']} bytes across {st['zones']} zones ({st['coverage'] * 100:.4f}% of the drive), all read back as {pattern}. "
+                f"With {engine.confidence * 100:g}% confidence, fewer than {st['defect_rate_bound'] * 100:.4f}% of the drive's blocks are bad.")
+
+TaskService.register(SampleVerifyTask.display_name, SampleVerifyTask)
 
 ### ImageTask needs some serious TLC. Clonezilla isn't reliable for this task. TODO: Research Partclone for this task.
 class ImageTask(Task):
@@ -651,6 +941,8 @@ class ImageTask(Task):
 
         #self._partitions = image.partitions.copy()
         self._diskname = hdd.node
+        self._pci_address = getattr(hdd, 'pci_address', None)
+        self._cgroup = None
         self._subproc = None
         self._PID = None
         self._returncode = None
@@ -670,6 +962,7 @@ class ImageTask(Task):
         self.time_started = datetime.datetime.now(datetime.timezone.utc)
         self._subproc = subprocess.Popen(['/usr/sbin/ocs-sr', '-e1', 'auto', '-e2', '-nogui', '-batch', '-r', '-irhr', '-ius', '-icds', '-j2', '-k1', '-cmf', '-scr', '-p', 'true', 'restoredisk', self._image.name, self._diskname], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)        
         self._PID = self._subproc.pid
+        self._cgroup = inject(IoScheduler).limit_process(self._PID, self._diskname, self._pci_address) #Before ocs-sr starts partclone, which inherits the cap.
         self._proctree = get_process_tree().find(pid=self.PID, recursive=True)
         self._progressString = "Loading " + self._image.name
         self._pollingThread.start()
@@ -681,6 +974,7 @@ class ImageTask(Task):
             self._progress_cb(None, self._progressString)
 
     def _monitor(self):
+        watcher = inject(ProcessWatcher)
         for i in range(len(self._image.partitions)): #The partclone.ntfs process will spawn once for each partition. Watch for partclone.ntfs as many times as there are partitions to clone.
 
             while self._poll == True and self._partclone_procview == None and self._md5sum_procview == None: #Watch for the creation of the partclone.ntfs process
@@ -697,16 +991,16 @@ class ImageTask(Task):
                     self._call_progress_cb()
                     self._cloning = True
                 if m != None:
-                    self._md5sum_procview = p
+                    self._md5sum_procview = m
                     self._progressString = "Checking " + self._image.name
                     self.notes.add("Checking " + self._image.name + ".", note_taker="hddmond")
                     self._call_progress_cb()
                     self._checking = True
 
             while self._cloning == True and self._poll == True and self._md5sum_procview == None: #Wait for the end of the partclone.ntfs process, or skip these loops if we see the md5sum process. Possibility to incorrectly count partitions
-                time.sleep(self._pollingInterval/4) #Increased pollrate to catch the death of the process.
+                exited = watcher.wait_sync(self._partclone_procview.pid, timeout=self._pollingInterval) #Returns the moment partclone exits.
                 self._check_subproc()
-                if(self._partclone_procview.is_alive == False):
+                if exited:
                     self._partclone_procview = None
                     self._cloning = False
                     
@@ -724,15 +1018,16 @@ class ImageTask(Task):
                 self._checking = True
 
         while self._checking == True and self._poll == True: #Wait for the end of the md5sum process
-            time.sleep(self._pollingInterval/4)
+            exited = watcher.wait_sync(self._md5sum_procview.pid, timeout=self._pollingInterval)
             self._check_subproc()
-            if(self._md5sum_procview.is_alive == False):
+            if exited:
                 self._checking = False
 
         while self._poll:
-            time.sleep(self._pollingInterval)
+            watcher.wait_sync(self.PID, timeout=self._pollingInterval)
             self._check_subproc()
 
+        inject(IoScheduler).release_process(self._cgroup)
         self.returncode = self._returncode
         self.time_started = datetime.datetime.now(datetime.timezone.utc)
         if(self._returncode == 0):
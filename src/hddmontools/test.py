@@ -1,11 +1,13 @@
-import threading
 import enum
 import datetime
 import asyncio
-import functools
 
+from injectable import inject
 from .task import Task
 from .task_service import TaskService
+from .smartctl_client import SmartctlClient, SmartctlError, SmartctlUnsupported, SelfTestStatus
+from .smart_guard import SmartGuard
+from .selftest_monitor import SelfTestMonitor
 
 class TestResult(enum.Enum):
     FINISH_PASSED = 0
@@ -68,13 +70,17 @@ class Test(Task):
     def __getstate__(self):
         state = self.__dict__.copy()
         state['_testingThread'] = None
+        state['_monitor'] = None
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._monitor = inject(SelfTestMonitor)
 
     def __init__(self, hdd, test_type: str="short", pollingInterval=5, callback=None, progressCallback=None):
+        self.hdd = hdd
         self.device = hdd._smart
+        self._monitor = inject(SelfTestMonitor)
         self.test_type = test_type
         self.result = None
         self._progress = 0
@@ -109,37 +115,49 @@ class Test(Task):
         else:
             return
 
-    async def _loose_test(self, *args):
-        while self._testing:
-            r, t, p = await asyncio.get_event_loop().run_in_executor(None, self.device.get_selftest_result)
-            if(r == 1):
-                if(p != None):
-                    self._progressHandler(p)
-                await asyncio.sleep(args[0])
-            else:
-                self._testing = False
-
-        self._processReturnCode(r, t)    
+    async def _loose_test(self, polling_interval):
+        try:
+            status = await self._monitor.run(self.hdd, progress_callback=self._progressHandler, min_interval=polling_interval)
+        except SmartctlError as e:
+            self.notes.add("Couldn't read the test status: " + str(e), note_taker="hddmond")
+            status = SelfTestStatus(False, self._progress, str(e))
+        self._processStatus(status)
+        await self._refresh_smart()
         self._callCallbacks()
 
     async def _captive_test(self, test_type, polling_interval):
         self.time_started = datetime.datetime.now(datetime.timezone.utc)
-        r, t = await asyncio.get_event_loop().run_in_executor(None, functools.partial(self.device.run_selftest_and_wait, test_type, polling=polling_interval, progress_handler=self._progressHandler))
+        try:
+            status = await self._monitor.run(self.hdd, test_type, progress_callback=self._progressHandler, min_interval=polling_interval)
+        except SmartctlError as e:
+            self.notes.add(str(e), note_taker="hddmond")
+            status = None
         self.time_ended = datetime.datetime.now(datetime.timezone.utc)
         #After we finish the test
-        self._processReturnCode(r, t)
+        self._processStatus(status)
         self._testing = False
         self._finished = True
+        await self._refresh_smart()
         self._callCallbacks()
 
+    async def _refresh_smart(self):
+        # The test result and the attributes it touched should show up right away, not when the SMART snapshot expires.
+        try:
+            await self.hdd.update_smart_async()
+        except Exception as e:
+            self.notes.add("Couldn't refresh SMART data after the test: " + str(e), note_taker="hddmond")
+
     async def abort(self, wait=False):
         self.notes.add("Aborted test.", note_taker="hddmond")
-        await asyncio.get_event_loop().run_in_executor(None, self.device.abort_selftest)
-        #The _test function takes care of the result management
+        guard = inject(SmartGuard)
+        try:
+            await guard.call(self.hdd.node, inject(SmartctlClient).abort_selftest, self.hdd.node)
+        except SmartctlUnsupported:
+            await guard.call(self.hdd.node, asyncio.get_event_loop().run_in_executor, None, self.device.abort_selftest)
+        self._monitor.poll_soon(self.hdd.node) #The monitor picks up the aborted status and finishes the test.
         if wait == True:
-            print("\tWaiting for {0} to stop...".format(self._testingTask.name))
-            while not self._testingTask.done():
-                await asyncio.sleep(0)
+            print("\tWaiting for {0} to stop...".format(self._testingTask.get_name()))
+            await asyncio.wait([self._testingTask])
 
     async def detach(self):
         '''
@@ -147,36 +165,33 @@ class Test(Task):
         '''
         
         self._testing = False
-        while not self._testingTask.done():
-            await asyncio.sleep(0)
+        self._monitor.release(self.hdd.node)
+        await asyncio.wait([self._testingTask])
         self.notes.add("Detached test, no longer monitored by hddmon.", note_taker="hddmond")
 
-    def _processReturnCode(self, r, t):
-        lock = threading.Lock() #Lock this thread so we can do some instant variable assignments without sleeping and risking reporting wrong variables
-        lock.acquire()
-        self.result = TestResult.UNKNOWN
-        if (r == 0): #Completed
-            if 'failure' in t.status.lower():
-                self.result = TestResult.FINISH_FAILED
-                self.passed = False
-            elif 'without error' in t.status.lower():
-                self.result = TestResult.FINISH_PASSED
-                self.passed = True
-            
-        elif (r == 1): #Selftest running
+    def _processStatus(self, status: SelfTestStatus):
+        """
+        Sets the result from the self-test's final status. A status of None means the test never started.
+        """
+        if status == None:
             self.result = TestResult.CANT_START
-            self.passed = False
-            self.notes.add("A test is already running", note_taker="hddmond")
-        elif (r == 3): #Aborted
+            self.notes.add("The test couldn't be started", note_taker="hddmond")
+        elif status.running:
+            self.result = TestResult.UNKNOWN
+            self.notes.add("The test is still running", note_taker="hddmond")
+        elif status.aborted:
             self.result = TestResult.ABORTED
-            self.passed = False
             self.notes.add("The test was aborted", note_taker="hddmond")
-        else: #2 = No new selftests,    4 = Unknown smartctl error
+        elif status.passed == True:
+            self.result = TestResult.FINISH_PASSED
+        elif status.passed == False:
+            self.result = TestResult.FINISH_FAILED
+            self.notes.add("The test finished with: " + status.status, note_taker="hddmond")
+        else:
             self.result = TestResult.UNKNOWN
-            self.passed = False
             self.notes.add("The test result is unknown", note_taker="hddmond")
+        self.passed = self.result == TestResult.FINISH_PASSED
         self.returncode = int(self.result)
-        lock.release()
         self.notes.add("Test " + ("passed" if self.passed else "failed"), note_taker="hddmond")
 
     def _callCallbacks(self):
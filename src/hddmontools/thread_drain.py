@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import threading
+
+from typing import Callable, Dict
+
+#
+#   A ThreadDrain runs calls made from worker threads on the event loop, in batches. The first call after a drain
+#   wakes the loop with one call_soon_threadsafe(); calls made before the loop gets to it join the same batch. A burst
+#   of events from many task threads costs the loop one wakeup, instead of one scheduled coroutine each.
+#
+#   There is one drain per event loop, shared by everything that uses it, so calls keep their order.
+#
+
+class ThreadDrain:
+
+    _drains: Dict[asyncio.AbstractEventLoop, 'ThreadDrain'] = {}
+    _drains_lock = threading.Lock()
+
+    @staticmethod
+    def for_loop(loop: asyncio.AbstractEventLoop) -> 'ThreadDrain':
+        with ThreadDrain._drains_lock:
+            d = ThreadDrain._drains.get(loop, None)
+            if d == None:
+                d = ThreadDrain(loop)
+                ThreadDrain._drains[loop] = d
+            return d
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._calls = []
+        self._scheduled = False
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) on the loop soon. Safe to call from any thread.
+        """
+        with self._lock:
+            self._calls.append((func, args, kwargs))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            calls = self._calls
+            self._calls = []
+            self._scheduled = False
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.logger.error(f"Exception raised by {getattr(func, '__qualname__', func)} while draining thread calls: {str(e)}")
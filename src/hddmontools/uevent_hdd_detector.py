@@ -0,0 +1,210 @@
+from hddmontools.hdd_detector import HddDetector
+from hddmontools.sysfs_enumerator import SysfsEnumerator
+
+import os
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+
+#
+#   This file holds the UeventDetector, which watches for block devices being added or removed without
+#   polling smartctl. In order of preference, it uses:
+#
+#       1. udev netlink events (through pyudev), when running on a host with udev.
+#       2. inotify on /dev, when running in a container where udev events don't reach us.
+#       3. Adaptive-backoff polling of /sys/block, when neither of the above are available.
+#
+#   Whichever it uses, serials are always read through the SysfsEnumerator, so the same drive reports the same serial
+#   in every mode (the CoalescingDetector matches reenumerated drives by serial).
+#
+
+class UeventDetector(HddDetector):
+
+    disk_name_pattern = SysfsEnumerator.disk_name_pattern
+
+    # inotify constants, see inotify(7)
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+    _inotify_event = struct.Struct('iIII')
+
+    def __init__(self, min_poll_interval=1, max_poll_interval=30, use_netlink=None):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.info("Initializing UeventDetector...")
+        self._callbacks = []
+        self._known = {} #{node: serial}
+        self._loopgo = True
+        self._min_poll_interval = min_poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._use_netlink = (not UeventDetector.in_container()) if use_netlink == None else use_netlink
+        self._monitor = None
+        self._inotify_fd = None
+        self._poll_task = None
+        self._enumerator = SysfsEnumerator()
+        self.mode = None
+
+    @staticmethod
+    def in_container() -> bool:
+        """
+        Best guess at whether we are running inside of a container, where udev netlink events won't be delivered.
+        """
+        if os.path.exists('/.dockerenv') or os.path.exists('/run/.containerenv'):
+            return True
+        try:
+            with open('/proc/1/cgroup') as fd:
+                cgroup = fd.read()
+            return any(s in cgroup for s in ('docker', 'kubepods', 'containerd', 'lxc'))
+        except OSError:
+            return False
+
+    async def start(self):
+        self.logger.info("Starting UeventDetector...")
+        self._loopgo = True
+        loop = asyncio.get_event_loop()
+
+        # Report what is already attached before listening for changes, like the smartctl poller did on its first pass.
+        for node in self._scan():
+            self._device_seen(node)
+
+        if self._use_netlink and self._start_netlink(loop):
+            self.mode = 'netlink'
+        elif self._start_inotify(loop):
+            self.mode = 'inotify'
+        else:
+            self.mode = 'poll'
+            self._poll_task = loop.create_task(self._poll_method())
+        self.logger.info(f"UeventDetector is watching for devices using {self.mode}.")
+
+    async def stop(self):
+        self.logger.info("Stopping UeventDetector...")
+        self._loopgo = False
+        loop = asyncio.get_event_loop()
+        if self._monitor != None:
+            loop.remove_reader(self._monitor.fileno())
+            self._monitor = None
+        if self._inotify_fd != None:
+            loop.remove_reader(self._inotify_fd)
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def add_change_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def _start_netlink(self, loop) -> bool:
+        try:
+            import pyudev
+            context = pyudev.Context()
+            self._monitor = pyudev.Monitor.from_netlink(context)
+            self._monitor.filter_by(subsystem='block', device_type='disk')
+            self._monitor.start()
+            loop.add_reader(self._monitor.fileno(), self._netlink_readable)
+            return True
+        except Exception as e:
+            self.logger.warn(f"Couldn't listen for udev netlink events: {str(e)}")
+            self._monitor = None
+            return False
+
+    def _netlink_readable(self):
+        while True:
+            device = self._monitor.poll(timeout=0)
+            if device == None:
+                break
+            node = device.device_node
+            if node == None or not self.disk_name_pattern.match(device.sys_name):
+                continue
+            if device.action == 'add':
+                self._device_seen(node)
+            elif device.action == 'remove':
+                self._device_gone(node)
+
+    def _start_inotify(self, loop) -> bool:
+        libc_name = ctypes.util.find_library('c')
+        if libc_name == None:
+            return False
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            wd = libc.inotify_add_watch(fd, b'/dev', self._IN_CREATE | self._IN_DELETE)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch on /dev failed")
+            self._inotify_fd = fd
+            loop.add_reader(fd, self._inotify_readable)
+            return True
+        except (OSError, AttributeError) as e:
+            self.logger.warn(f"Couldn't watch /dev with inotify: {str(e)}")
+            return False
+
+    def _inotify_readable(self):
+        try:
+            buf = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + self._inotify_event.size <= len(buf):
+            _wd, mask, _cookie, length = self._inotify_event.unpack_from(buf, offset)
+            offset += self._inotify_event.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if not self.disk_name_pattern.match(name):
+                continue
+            node = '/dev/' + name
+            if mask & self._IN_CREATE:
+                self._device_seen(node)
+            elif mask & self._IN_DELETE:
+                self._device_gone(node)
+
+    async def _poll_method(self):
+        interval = self._min_poll_interval
+        while self._loopgo:
+            await asyncio.sleep(interval)
+            devices = self._enumerator.enumerate()
+            current = set(devices.keys())
+            known = set(self._known.keys()) #By node alone, a serial showing up late isn't a new device.
+            for node in known - current:
+                self._device_gone(node)
+            for node in current - known:
+                self._device_seen(node, UeventDetector._serial_of(devices[node]))
+
+            if current != known:
+                interval = self._min_poll_interval #Something is happening, look again soon.
+            else:
+                interval = min(interval * 2, self._max_poll_interval)
+
+    def _scan(self):
+        return ['/dev/' + n for n in self._enumerator.names()]
+
+    @staticmethod
+    def _serial_of(d):
+        return d.serial if d.serial != None else d.wwn
+
+    def _read_serial(self, node):
+        d = self._enumerator.read_device(node)
+        if d == None:
+            return None
+        return UeventDetector._serial_of(d)
+
+    def _device_seen(self, node, serial=None):
+        if node in self._known:
+            return
+        if serial == None:
+            serial = self._read_serial(node)
+        self._known[node] = serial
+        self._do_callback('add', serial, node)
+
+    def _device_gone(self, node):
+        if node not in self._known:
+            return
+        serial = self._known.pop(node)
+        self._do_callback('remove', serial, node)
+
+    def _do_callback(self, action, serial, node):
+        for c in self._callbacks:
+            if callable(c):
+                c(action=action, serial=serial, node=node)
@@ -0,0 +1,294 @@
+import os
+import mmap
+import math
+import errno
+import random
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from hddmontools.erase_engine import EraseError, EraseAborted, parse_pattern, fill_pattern, device_size, logical_block_size
+
+#
+#   The VerifyEngine reads a whole device back and checks that every sector holds the pattern it was erased with. Like
+#   the EraseEngine it runs on its own thread per drive and reads large O_DIRECT chunks into one page-aligned mmap
+#   buffer.
+#
+#   Each chunk is checked with a single comparison against a prebuilt copy of the pattern (a memcmp, several GB/s on
+#   one core). Only a chunk that doesn't match is checked sector by sector, to find which LBAs are wrong. Chunks that
+#   can't be read are read again sector by sector too, and unreadable sectors count as mismatches.
+#
+#   The SampleVerifyEngine only reads enough randomly chosen blocks to say, with a given confidence, that no more than
+#   a given fraction of the drive's blocks are wrong. If a fraction p of the blocks were bad, n random blocks would all
+#   miss them with probability (1-p)^n, so n = ceil(ln(1-C)/ln(1-p)) clean blocks give confidence C. The samples are
+#   spread evenly over zones of the drive (stratified), so no region goes unsampled by chance, and are read by a few
+#   threads at once to keep the drive's queue busy. Given a number of samples instead of a fraction, it works out the
+#   fraction that many clean blocks rule out: p = 1 - (1-C)^(1/n).
+#
+#   Both wait for their turn on the controller and take their reads from its bandwidth, like the EraseEngine.
+#
+
+class VerifyEngine:
+
+    def __init__(self, node: str, pattern: str = 'ff', chunk_size: int = 4 * 1024 * 1024, progress_callback: Callable[[int, int], None] = None, max_ranges=100, budget=None):
+        self.logger = logging.getLogger(__name__ + "." + self.__class__.__qualname__ + f'[{node}]')
+        self.logger.setLevel(logging.DEBUG)
+        self.node = node
+        self.pattern = parse_pattern(pattern)
+        if self.pattern == None:
+            raise EraseError("Random data can't be verified")
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback #Called from the engine's thread with (bytes read, total bytes)
+        self.max_ranges = max_ranges #Mismatching ranges kept, the rest are only counted
+        self.budget = budget #The controller's ControllerBudget, if it has one
+        self.size = None
+        self.sector_size = None
+        self.offset = 0
+        self.mismatches: List[Tuple[int, int]] = [] #[(first LBA, last LBA + 1)]
+        self.bad_sectors = 0
+        self.unreadable_sectors = 0
+        self.error = None
+        self._abort = threading.Event()
+        self._thread = None
+
+    @property
+    def passed(self) -> bool:
+        return self.error == None and self.bad_sectors == 0
+
+    def start(self, done_callback: Callable[['VerifyEngine'], None] = None):
+        """
+        Starts verifying on a dedicated thread. done_callback is called from that thread when the engine stops.
+        """
+        def target():
+            try:
+                self.run()
+            except Exception as e:
+                self.error = e
+            if done_callback != None:
+                done_callback(self)
+        self._thread = threading.Thread(target=target, name=f"{self.node}_verify", daemon=True)
+        self._thread.start()
+
+    def abort(self):
+        self._abort.set()
+
+    def _open(self) -> int:
+        try:
+            return os.open(self.node, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+        self.logger.warn("The device doesn't take O_DIRECT, falling back to buffered reads.")
+        return os.open(self.node, os.O_RDONLY)
+
+    def _mismatch(self, lba: int, count: int = 1):
+        self.bad_sectors += count
+        if len(self.mismatches) > 0 and self.mismatches[-1][1] == lba:
+            self.mismatches[-1] = (self.mismatches[-1][0], lba + count)
+        elif len(self.mismatches) < self.max_ranges:
+            self.mismatches.append((lba, lba + count))
+
+    def _read(self, fd: int, view: memoryview, offset: int) -> int:
+        got = 0
+        while got < len(view):
+            n = os.preadv(fd, [view[got:]], offset + got)
+            if n <= 0:
+                raise EraseError(f"The device ended at byte {offset + got}, before its reported size")
+            got += n
+        return got
+
+    def _check_sectors(self, fd: int, buf: mmap.mmap, view: memoryview, expected: bytes, n: int, readable: bool):
+
+        #   The slow path, for a chunk that didn't match or couldn't be read.
+
+        s = self.sector_size
+        for i in range(0, n, s):
+            if not readable:
+                try:
+                    self._read(fd, view[i:i + s], self.offset + i)
+                except OSError:
+                    self.unreadable_sectors += 1
+                    self._mismatch((self.offset + i) // s)
+                    continue
+            if buf[i:i + s] != expected[i:i + s]:
+                self._mismatch((self.offset + i) // s)
+
+    def run(self):
+        """
+        Verifies the device on the calling thread.
+        """
+        if self.budget != None and not self.budget.acquire(self._abort):
+            raise EraseAborted("Aborted while waiting for the controller")
+        try:
+            self._run()
+        finally:
+            if self.budget != None:
+                self.budget.release()
+
+    def _run(self):
+        fd = self._open()
+        buf = None
+        try:
+            self.size = device_size(fd)
+            s = self.sector_size = logical_block_size(fd)
+            chunk = max(s, self.chunk_size - self.chunk_size % s)
+            buf = mmap.mmap(-1, chunk) #Page aligned, as O_DIRECT wants.
+            view = memoryview(buf)
+            fill_pattern(buf, self.pattern)
+            expected = buf[:] #Every chunk starts on a sector, so every chunk should look like this.
+            self.logger.info(f"Verifying {self.size} bytes read back as 0x{self.pattern.hex().upper()}.")
+
+            while self.offset < self.size:
+                if self._abort.is_set():
+                    raise EraseAborted(f"Aborted at byte {self.offset}")
+                n = min(chunk, self.size - self.offset)
+                if self.budget != None:
+                    self.budget.consume(n, self._abort)
+                try:
+                    self._read(fd, view[:n], self.offset)
+                    readable = True
+                except OSError:
+                    readable = False
+                if not readable or buf[:n] != (expected if n == chunk else expected[:n]):
+                    self._check_sectors(fd, buf, view, expected, n, readable)
+                self.offset += n
+                if self.progress_callback != None:
+                    self.progress_callback(self.offset, self.size)
+        finally:
+            if buf != None:
+                view.release()
+                buf.close()
+            os.close(fd)
+
+class SampleVerifyEngine(VerifyEngine):
+
+    def __init__(self, node: str, pattern: str = 'ff', confidence: float = 0.99, defect_rate: float = 0.001, block_size: int = 1024 * 1024,
+                 zones: int = 64, workers: int = 4, progress_callback: Callable[[int, int], None] = None, max_ranges=100, budget=None,
+                 samples: int = None):
+        super(SampleVerifyEngine, self).__init__(node, pattern, block_size, progress_callback, max_ranges, budget)
+        if not (0 < confidence < 1) or (samples == None and not (0 < defect_rate < 1)):
+            raise EraseError("The confidence and defect rate have to be between 0 and 1")
+        if samples != None and samples < 1:
+            raise EraseError("At least one block has to be sampled")
+        self.confidence = confidence
+        self.zones = zones
+        self.workers = workers
+        if samples != None:
+            self.samples = int(samples)
+            self.defect_rate = 1 - (1 - confidence) ** (1 / self.samples) #What that many clean blocks rule out
+        else:
+            self.samples = SampleVerifyEngine.sample_count(confidence, defect_rate)
+            self.defect_rate = defect_rate #The fraction of bad blocks we want to be able to rule out
+        self.sampled = 0
+        self.bad_samples = 0
+        self._lock = threading.Lock()
+
+    @property
+    def passed(self) -> bool:
+        return super(SampleVerifyEngine, self).passed and self.sampled > 0 #Nothing read says nothing about the drive.
+
+    @staticmethod
+    def sample_count(confidence: float, defect_rate: float) -> int:
+        return math.ceil(math.log(1 - confidence) / math.log(1 - defect_rate))
+
+    def statistics(self) -> Dict[str, Any]:
+        blocks = self.size // self.chunk_size if self.size else 0
+        stats = {
+            'confidence': self.confidence,
+            'defect_rate': self.defect_rate,
+            'samples': self.sampled,
+            'samples_planned': self.samples,
+            'bad_samples': self.bad_samples,
+            'block_size': self.chunk_size,
+            'zones': self.zones,
+            'bytes_read': self.sampled * self.chunk_size,
+            'coverage': (self.sampled / blocks) if blocks > 0 else 0,
+        }
+        if self.sampled > 0 and self.bad_samples == 0:
+            # The largest bad fraction still consistent with every sample being clean, at our confidence.
+            stats['defect_rate_bound'] = 1 - (1 - self.confidence) ** (1 / self.sampled)
+        return stats
+
+    def _plan(self, blocks: int) -> List[int]:
+        """
+        Picks the blocks to read, the same number from every zone.
+        """
+        rng = random.SystemRandom() #Nobody can know ahead of time which blocks will be read.
+        zones = max(1, min(self.zones, blocks))
+        per_zone = math.ceil(min(self.samples, blocks) / zones)
+        picked = []
+        for z in range(zones):
+            first, last = blocks * z // zones, blocks * (z + 1) // zones
+            picked.extend(rng.sample(range(first, last), min(per_zone, last - first)))
+        picked.sort() #Fewer long seeks
+        return picked
+
+    def _check_block(self, fd: int, local: threading.local, block: int):
+        if self._abort.is_set():
+            return
+        if getattr(local, 'buf', None) == None:
+            local.buf = mmap.mmap(-1, self.chunk_size) #One aligned buffer per thread
+        buf, s = local.buf, self.sector_size
+        offset = block * self.chunk_size
+        bad = []
+        if self.budget != None:
+            self.budget.consume(self.chunk_size, self._abort)
+        try:
+            with memoryview(buf) as view:
+                self._read(fd, view, offset)
+            readable = True
+        except OSError:
+            readable = False
+        if not readable:
+            bad = [(offset // s, self.chunk_size // s)]
+        elif buf[:] != self._expected:
+            bad = [((offset + i) // s, 1) for i in range(0, self.chunk_size, s) if buf[i:i + s] != self._expected[i:i + s]]
+        with self._lock:
+            self.sampled += 1
+            if len(bad) > 0:
+                self.bad_samples += 1
+                if not readable:
+                    self.unreadable_sectors += bad[0][1]
+                for lba, count in bad:
+                    self._mismatch(lba, count)
+            sampled = self.sampled
+        if self.progress_callback != None:
+            self.progress_callback(sampled, self._planned)
+
+    def _run(self):
+
+        #   Reads the sample on a few threads of its own.
+
+        fd = self._open()
+        try:
+            self.size = device_size(fd)
+            s = self.sector_size = logical_block_size(fd)
+            self.chunk_size = max(s, self.chunk_size - self.chunk_size % s)
+            buf = mmap.mmap(-1, self.chunk_size)
+            fill_pattern(buf, self.pattern)
+            self._expected = buf[:]
+            buf.close()
+
+            plan = self._plan(self.size // self.chunk_size)
+            self._planned = len(plan)
+            if len(plan) <= 0:
+                raise EraseError(f"The device is smaller than one block of {self.chunk_size} bytes, there is nothing to sample")
+            self.logger.info(f"Verifying {len(plan)} blocks of {self.chunk_size} bytes read back as 0x{self.pattern.hex().upper()}, for {self.confidence * 100:g}% confidence that fewer than {self.defect_rate * 100:g}% of blocks are bad.")
+
+            local = threading.local()
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.node}_sample") as pool:
+                for f in [pool.submit(self._check_block, fd, local, b) for b in plan]:
+                    f.result()
+            merged = [] #Blocks finish out of order.
+            for lba, end in sorted(self.mismatches):
+                if len(merged) > 0 and merged[-1][1] == lba:
+                    merged[-1] = (merged[-1][0], end)
+                else:
+                    merged.append((lba, end))
+            self.mismatches = merged
+            if self._abort.is_set():
+                raise EraseAborted(f"Aborted after {self.sampled} samples")
+        finally:
+            os.close(fd)
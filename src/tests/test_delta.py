@@ -0,0 +1,53 @@
+import asyncio
+
+from hddmondtools.delta import DeltaPublisher
+
+class FakeSnapshot:
+
+    def __init__(self, data, version=1):
+        self.data = data
+        self.version = version
+
+    def get(self):
+        return self.data, self.version
+
+class FakeHdd:
+
+    locality = 'local'
+
+    def __init__(self, serial, data, version=1):
+        self.serial = serial
+        self._data_snapshot = FakeSnapshot(data, version)
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+def test_patch():
+    hdd = FakeHdd('A', {'serial': 'A', 'node': '/dev/sda'})
+    delta = DeltaPublisher(lambda: [hdd], encode=lambda m: m)
+    queue = []
+    run(delta.subscribe('client', queue))
+    hdd._data_snapshot.data = {'serial': 'A', 'node': '/dev/sdb'}
+    hdd._data_snapshot.version = 2
+    run(delta.update('A'))
+    assert queue[-1] == {'update': 'patch', 'data': {'serial': 'A', 'from': 1, 'version': 2, 'patch': [
+        {'op': 'replace', 'path': '/node', 'value': '/dev/sdb'}]}}
+
+def test_removed_without_subscribers():
+    hdds = [FakeHdd('A', {'serial': 'A'}), FakeHdd('B', {'serial': 'B'})]
+    delta = DeltaPublisher(lambda: hdds, encode=lambda m: m)
+    run(delta.update())
+    hdds.pop()
+    queue = []
+    run(delta.subscribe('client', queue))
+    assert queue == [{'update': 'snapshot', 'data': {'hdds': {'A': {'serial': 'A'}}, 'versions': {'A': 1}}}]
+
+def test_plugged_back_in():
+    old = FakeHdd('A', {'serial': 'A', 'node': '/dev/sda'}, version=5)
+    hdds = [old]
+    delta = DeltaPublisher(lambda: hdds, encode=lambda m: m)
+    queue = []
+    run(delta.subscribe('client', queue))
+    hdds[0] = FakeHdd('A', {'serial': 'A', 'node': '/dev/sdc'}, version=1) #A new snapshot, its versions start over
+    run(delta.update('A'))
+    assert queue[-1] == {'update': 'add', 'data': {'serial': 'A', 'version': 1, 'hdd': {'serial': 'A', 'node': '/dev/sdc'}}}
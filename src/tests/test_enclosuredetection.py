@@ -0,0 +1,78 @@
+import os
+
+from hddmontools.enclosuredetection import EnclosureDetective
+
+HOST = 'devices/pci0000:00/0000:00:01.0/0000:01:00.0/host0'
+PORT = HOST + '/port-0:3'
+SCSI_DEVICE = PORT + '/end_device-0:3/target0:0:3/0:0:3:0'
+SYSPATH = '/sys/' + SCSI_DEVICE + '/block/sdc'
+
+def fake_sysfs(root, bay=None, phy=None):
+    """
+    A sysfs tree with one SAS drive, sdc, hanging off of HBA port 0:3.
+    """
+    (root / SCSI_DEVICE / 'block' / 'sdc').mkdir(parents=True)
+    (root / PORT / 'phy-0:3').mkdir()
+    end_device = root / 'class' / 'sas_device' / 'end_device-0:3'
+    end_device.mkdir(parents=True)
+    if bay != None:
+        (end_device / 'bay_identifier').write_text(f"{bay}\n")
+    if phy != None:
+        sas_phy = root / 'class' / 'sas_phy' / 'phy-0:3'
+        sas_phy.mkdir(parents=True)
+        (sas_phy / 'phy_identifier').write_text(f"{phy}\n")
+    return root
+
+def add_enclosure(root, components):
+    """
+    An SES enclosure with {component name: SCSI device path or None for an empty slot}.
+    """
+    enclosure = root / 'class' / 'enclosure' / '0:0:8:0'
+    enclosure.mkdir(parents=True)
+    (enclosure / 'components').write_text("12\n")
+    for name, device in components.items():
+        (enclosure / name).mkdir()
+        if device != None:
+            os.symlink(root / device, enclosure / name / 'device')
+    return enclosure
+
+def test_enclosure_component(tmp_path):
+    root = fake_sysfs(tmp_path, bay=9, phy=3)
+    add_enclosure(root, {'Slot 04': None, 'Slot 05': SCSI_DEVICE})
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(SYSPATH) == 5
+
+def test_enclosure_slot_attribute(tmp_path):
+    root = fake_sysfs(tmp_path)
+    enclosure = add_enclosure(root, {'ArrayDevice00': SCSI_DEVICE})
+    (enclosure / 'ArrayDevice00' / 'slot').write_text("11\n") # Newer kernels say which slot it is.
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(SYSPATH) == 11
+
+def test_bay_identifier(tmp_path):
+    root = fake_sysfs(tmp_path, bay=9, phy=3)
+    add_enclosure(root, {'Slot 05': None}) # In an enclosure, but its slot doesn't point at the drive.
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(SYSPATH) == 9
+
+def test_phy_identifier(tmp_path):
+    root = fake_sysfs(tmp_path, bay=-1, phy=3)
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(SYSPATH) == 3
+
+def test_phy_identifier_behind_expander(tmp_path):
+    root = fake_sysfs(tmp_path, phy=3)
+    expander = PORT + '/expander-0:0/port-0:0:3'
+    (root / expander / 'end_device-0:0:3' / 'target0:0:4' / '0:0:4:0' / 'block' / 'sdd').mkdir(parents=True)
+    syspath = '/sys/' + expander + '/end_device-0:0:3/target0:0:4/0:0:4:0/block/sdd'
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(syspath) == None # Two ports in, the HBA phy says nothing.
+
+def test_not_sas(tmp_path):
+    root = fake_sysfs(tmp_path, bay=9, phy=3)
+    syspath = '/sys/devices/pci0000:00/0000:00:17.0/ata1/host1/target1:0:0/1:0:0:0/block/sda'
+    assert EnclosureDetective(sysfs_root=root).GetSlotFromSysPath(syspath) == None
+
+def test_update_rebuilds_slot_map(tmp_path):
+    root = fake_sysfs(tmp_path)
+    detective = EnclosureDetective(sysfs_root=root)
+    assert detective.GetSlotFromSysPath(SYSPATH) == None
+    add_enclosure(root, {'Slot 02': SCSI_DEVICE})
+    assert detective.GetSlotFromSysPath(SYSPATH) == None # Still the old map
+    detective.Update()
+    assert detective.GetSlotFromSysPath(SYSPATH) == 2
@@ -0,0 +1,60 @@
+import pytest
+
+from hddmondtools import hdd_snapshot
+from hddmondtools.hdd_snapshot import HddSnapshot
+from hddmondtools.hddmon_dataclasses import SmartData, AttributeData
+
+class FakeConfig:
+
+    data = {}
+
+class FakeCache:
+
+    def __init__(self, smart):
+        self.smart = smart
+
+    def peek(self):
+        return self.smart
+
+class FakeHdd:
+
+    serial = 'ZA000001'
+    model = 'ST4000NM0035'
+    wwn = None
+    capacity = 4000.787
+    node = '/dev/sda'
+    port = None
+    seen = 1
+    locality = 'local'
+    degraded = False
+
+    def __init__(self, smart):
+        self.smart_cache = FakeCache(smart)
+
+    def get_available_tasks(self):
+        return {}
+
+def smart(captured, raw='0'):
+    attrs = [AttributeData(5, 'Reallocated_Sector_Ct', 0x33, raw, 10, 'Pre-fail', 'Always', 100, '-', 100)]
+    return SmartData(captured, attrs, 'SN04', 'sat', [], True, True, 'PASS', [])
+
+@pytest.fixture
+def hdd(monkeypatch):
+    monkeypatch.setattr(hdd_snapshot, 'inject', lambda cls: FakeConfig())
+    hdd = FakeHdd(smart('2026-01-01T00:00:00+00:00'))
+    HddSnapshot.of(hdd)._build_tasks = lambda: {'task_queue': None}
+    return hdd
+
+def test_refresh_without_changes(hdd):
+    s = HddSnapshot.of(hdd)
+    _, version = s.get()
+    hdd.smart_cache.smart = smart('2026-01-01T00:05:00+00:00')
+    data, again = s.get()
+    assert again == version
+    assert data.smart.last_captured == '2026-01-01T00:05:00+00:00'
+
+def test_refresh_with_changes(hdd):
+    s = HddSnapshot.of(hdd)
+    _, version = s.get()
+    hdd.smart_cache.smart = smart('2026-01-01T00:05:00+00:00', raw='8')
+    assert s.get()[1] == version + 1
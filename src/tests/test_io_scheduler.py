@@ -0,0 +1,28 @@
+from hddmontools import io_scheduler
+from hddmontools.io_scheduler import IoScheduler
+from hddmontools.pciaddress import PciAddress
+
+class FakeConfig:
+
+    def __init__(self, data):
+        self.data = data
+
+def scheduler(monkeypatch, io):
+    monkeypatch.setattr(io_scheduler, 'inject', lambda cls: FakeConfig({'io': io}))
+    return IoScheduler()
+
+def test_controller_override(monkeypatch):
+    s = scheduler(monkeypatch, {'max_concurrent': 4, 'bandwidth': 0, 'controllers': {'0000:03:00.0': {'max_concurrent': 2, 'bandwidth': 1000}}})
+    b = s.controller_budget(PciAddress.ParseAddr('0000:03:00.0'))
+    assert (b.max_concurrent, b.bandwidth) == (2, 1000)
+    other = s.controller_budget(PciAddress.ParseAddr('0000:04:00.0'))
+    assert (other.max_concurrent, other.bandwidth) == (4, 0)
+
+def test_controller_override_short_address(monkeypatch):
+    s = scheduler(monkeypatch, {'controllers': {'03:00.0': {'max_concurrent': 1}}})
+    assert s.controller_budget(PciAddress.ParseAddr('[0000:03:00.0]')).max_concurrent == 1
+    assert s.controller_budget('0000:03:00.0') is s.controller_budget(PciAddress.ParseAddr('0000:03:00.0'))
+
+def test_unknown_controller(monkeypatch):
+    s = scheduler(monkeypatch, {})
+    assert s.controller_budget(None).controller == 'unknown'
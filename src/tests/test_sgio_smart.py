@@ -0,0 +1,105 @@
+import pytest
+
+from conftest import FIXTURES
+from hddmontools.sgio_smart import (
+    SgioError, SgioSmartReader, decode_ata_smart_attributes, decode_ata_return_status, decode_scsi_log_page,
+    decode_scsi_supported_pages, decode_scsi_attributes, sense_key,
+)
+
+SGIO = FIXTURES / 'sgio'
+
+def load(directory):
+    # The same layout as `python -m hddmontools.sgio_smart --dump`
+    return {p.stem: p.read_bytes() for p in (SGIO / directory).glob('*.bin')}
+
+def by_index(attrs):
+    return {a.index: a for a in attrs}
+
+def test_ata_attributes():
+    pages = load('ata_healthy')
+    attrs = by_index(decode_ata_smart_attributes(pages['ata_data'], pages['ata_thresholds']))
+    assert sorted(attrs.keys()) == [1, 3, 5, 9, 12, 194, 197, 199]
+    assert attrs[9].name == 'Power_On_Hours'
+    assert attrs[9].raw_value == 12345
+    assert (attrs[1].value, attrs[1].worst, attrs[1].threshold) == (117, 99, 6)
+    assert attrs[1].attr_type == 'Pre-fail'
+    assert attrs[1].updated_freq == 'Always'
+    assert attrs[194].raw_value == 32 # The min/max bytes are dropped from temperatures
+    assert all(a.when_failed == '-' for a in attrs.values())
+
+def test_ata_attributes_failing():
+    pages = load('ata_failing')
+    attrs = by_index(decode_ata_smart_attributes(pages['ata_data'], pages['ata_thresholds']))
+    assert attrs[5].when_failed == 'FAILING_NOW'
+    assert attrs[1].when_failed == 'In_the_past'
+    assert attrs[197].raw_value == 1544
+
+def test_ata_attributes_bad_checksum():
+    data = bytearray(load('ata_healthy')['ata_data'])
+    data[100] ^= 0xff
+    with pytest.raises(SgioError):
+        decode_ata_smart_attributes(bytes(data))
+    decode_ata_smart_attributes(bytes(data), verify_checksum=False)
+
+def test_ata_attributes_short_page():
+    with pytest.raises(SgioError):
+        decode_ata_smart_attributes(bytes(100))
+
+@pytest.mark.parametrize('name, expected', [
+    ('sense_fixed_pass', 'PASS'),
+    ('sense_fixed_fail', 'FAIL'),
+    ('sense_descriptor_pass', 'PASS'),
+    ('sense_descriptor_fail', 'FAIL'),
+])
+def test_return_status(name, expected):
+    assert decode_ata_return_status((SGIO / (name + '.bin')).read_bytes()) == expected
+
+def test_return_status_without_registers():
+    assert decode_ata_return_status(b'') == None
+    assert decode_ata_return_status(bytes([0x72, 0x05, 0x24, 0x00, 0, 0, 0, 0])) == None # No ATA descriptor
+    assert decode_ata_return_status(bytes([0x70, 0, 0x05, 0, 0, 0, 0, 10, 0, 0, 0, 0, 0x24, 0, 0, 0, 0, 0])) == None
+
+def test_sense_key():
+    assert sense_key((SGIO / 'sense_fixed_pass.bin').read_bytes()) == 0x1
+    assert sense_key((SGIO / 'sense_descriptor_pass.bin').read_bytes()) == 0x1
+    assert sense_key(b'\x70') == None
+
+def test_decode_pages_ata():
+    attrs, assessment = SgioSmartReader.decode_pages(load('ata_healthy'))
+    assert assessment == 'PASS'
+    assert len(attrs) == 8
+    attrs, assessment = SgioSmartReader.decode_pages(load('ata_failing'))
+    assert assessment == 'FAIL'
+
+def test_decode_pages_ata_without_status():
+    pages = load('ata_failing')
+    del pages['ata_status'] # Bridges that don't hand back the registers: judged by the pre-fail attributes
+    assert SgioSmartReader.decode_pages(pages)[1] == 'FAIL'
+    pages = load('ata_healthy')
+    del pages['ata_status']
+    assert SgioSmartReader.decode_pages(pages)[1] == 'PASS'
+
+def test_scsi_supported_pages():
+    assert decode_scsi_supported_pages((SGIO / 'scsi_supported.bin').read_bytes()) == [0x00, 0x02, 0x03, 0x05, 0x0d, 0x0e, 0x2f]
+
+def test_scsi_log_page():
+    code, params = decode_scsi_log_page(load('scsi')['scsi_0d'])
+    assert code == 0x0d
+    assert params == {0x0000: bytes([0, 35]), 0x0001: bytes([0, 65])}
+    with pytest.raises(SgioError):
+        decode_scsi_log_page(b'\x0d\x00')
+
+def test_decode_pages_scsi():
+    attrs, assessment = SgioSmartReader.decode_pages(load('scsi'))
+    assert assessment == 'PASS'
+    named = {a.name: a.raw_value for a in attrs}
+    assert named == {
+        'Temperature_Celsius': 35,
+        'Read_Total_Uncorrected_Errors': 3,
+        'Write_Total_Uncorrected_Errors': 0,
+        'Accumulated_Start_Stop_Cycles': 1234,
+    }
+
+def test_scsi_failure_prediction():
+    ie = bytes([0x2f, 0, 0, 7, 0, 0, 0x03, 0x03, 0x5d, 0x00, 40]) # ASC 5D: failure prediction threshold exceeded
+    assert decode_scsi_attributes({0x2f: ie})[1] == 'FAIL'
@@ -0,0 +1,75 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from hddmontools import smart_guard
+from hddmontools.smart_guard import SmartGuard
+from hddmontools.smartctl_client import SmartctlError
+
+class FakeConfig:
+
+    data = {'smart': {'timeout': 0.2, 'breaker_threshold': 3}}
+
+@pytest.fixture
+def guard(monkeypatch):
+    monkeypatch.setattr(smart_guard, 'inject', lambda cls: FakeConfig())
+    return SmartGuard()
+
+def test_breaker_from_worker_thread(guard):
+    result = []
+    t = threading.Thread(target=lambda: result.append(guard.call_sync('/dev/sda', lambda: 'ok')))
+    t.start()
+    t.join()
+    assert result == ['ok']
+
+def test_timed_out_call_holds_drive(guard):
+    release = threading.Event()
+    with pytest.raises(SmartctlError):
+        guard.call_sync('/dev/sda', release.wait)
+    assert guard.breaker('/dev/sda').busy #The hung call is still running.
+
+    async def other():
+        return 'ok'
+    async def later():
+        await asyncio.sleep(0.05)
+        release.set()
+    async def both():
+        asyncio.ensure_future(later())
+        return await guard.call('/dev/sda', other, timeout=1)
+    assert asyncio.new_event_loop().run_until_complete(both()) == 'ok'
+    assert not guard.breaker('/dev/sda').busy
+
+def test_sync_and_async_exclusive(guard):
+    running = []
+    overlap = []
+    def blocking():
+        running.append(1)
+        overlap.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+    async def coro():
+        running.append(1)
+        overlap.append(len(running))
+        await asyncio.sleep(0.05)
+        running.pop()
+    t = threading.Thread(target=lambda: guard.call_sync('/dev/sda', blocking, timeout=1))
+    async def main():
+        t.start()
+        await asyncio.gather(*(guard.call('/dev/sda', coro, timeout=1) for _ in range(2)))
+    asyncio.new_event_loop().run_until_complete(main())
+    t.join()
+    assert overlap == [1, 1, 1]
+
+def test_call_blocking(guard):
+    release = threading.Event()
+    async def main():
+        with pytest.raises(SmartctlError):
+            await guard.call_blocking('/dev/sda', release.wait, timeout=0.1)
+        assert guard.breaker('/dev/sda').busy #Still stuck in its own thread
+        release.set()
+        await asyncio.sleep(0.1)
+        assert not guard.breaker('/dev/sda').busy
+        return await guard.call_blocking('/dev/sda', lambda: 'ok')
+    assert asyncio.new_event_loop().run_until_complete(main()) == 'ok'
@@ -0,0 +1,35 @@
+import json
+
+from types import SimpleNamespace
+
+from conftest import FIXTURES
+from hddmondtools.hddmon_dataclasses import SmartData
+from hddmontools.smartctl_client import SmartctlClient
+
+SMARTCTL = FIXTURES / 'smartctl'
+
+def pysmart_device(table: str):
+    """
+    What pySMART makes of `smartctl -a`: the attribute table's columns, as strings.
+    """
+    attrs = []
+    for line in table.splitlines()[1:]:
+        c = line.split()
+        attrs.append(SimpleNamespace(num=c[0], name=c[1], flags=c[2], value=c[3], worst=c[4], thresh=c[5], type=c[6],
+                                     updated=c[7], when_failed=c[8], raw=' '.join(c[9:])))
+    return SimpleNamespace(attributes=attrs, test_capabilities={'short': True}, firmware='TN03', interface='sat',
+                           messages=[], smart_capable=True, smart_enabled=True, assessment='PASS')
+
+def test_json_and_pysmart_agree():
+    from_json = SmartctlClient.parse_smart(json.loads((SMARTCTL / 'ata.json').read_text()))
+    from_pysmart = SmartData.FromSmartDev(pysmart_device((SMARTCTL / 'ata_attributes.txt').read_text()))
+    assert from_json.attributes == from_pysmart.attributes
+
+def test_attribute_types():
+    smart = SmartctlClient.parse_smart(json.loads((SMARTCTL / 'ata.json').read_text()))
+    attrs = {a.index: a for a in smart.attributes}
+    for a in attrs.values():
+        assert all(isinstance(v, int) for v in (a.index, a.flags, a.raw_value, a.threshold, a.value, a.worst))
+    assert attrs[190].raw_value == 37
+    assert attrs[10].when_failed == 'In_the_past'
+    assert attrs[5].when_failed == '-'
@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+from hddmontools.erase_engine import EraseError
+from hddmontools.verify_engine import SampleVerifyEngine
+
+BLOCK = 64 * 1024
+
+def image(tmp_path, size):
+    path = tmp_path / 'disk.img'
+    path.write_bytes(b'\xff' * size)
+    return str(path)
+
+def run(engine):
+    done = threading.Event()
+    engine.start(lambda e: done.set())
+    assert done.wait(10)
+    return engine
+
+def test_samples(tmp_path):
+    engine = run(SampleVerifyEngine(image(tmp_path, 64 * BLOCK), 'ff', confidence=0.9, block_size=BLOCK, zones=4, samples=16))
+    assert engine.passed
+    assert engine.sampled == 16
+    assert engine.defect_rate == pytest.approx(1 - 0.1 ** (1 / 16))
+    assert engine.statistics()['defect_rate_bound'] == pytest.approx(engine.defect_rate)
+
+def test_smaller_than_a_block(tmp_path):
+    engine = run(SampleVerifyEngine(image(tmp_path, 4096), 'ff', block_size=BLOCK))
+    assert isinstance(engine.error, EraseError)
+    assert not engine.passed
+    assert 'defect_rate_bound' not in engine.statistics()
+
+def test_bad_samples_parameter():
+    with pytest.raises(EraseError):
+        SampleVerifyEngine('/dev/null', samples=0)
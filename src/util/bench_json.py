@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+#   Compares jsonpickle with the compiled encoders in hddmondtools/fast_json.py, on the payloads the websocket sends
+#   for a rack of drives: the 'hdds' reply, and one task progress update.
+#
+#   Run from the src directory:  python3 util/bench_json.py [drives] [rounds]
+#
+
+import os
+import sys
+import json
+import time
+import datetime
+import jsonpickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hddmondtools import fast_json
+from hddmondtools.hddmon_dataclasses import HddData, SmartData, AttributeData, TaskQueueData, TaskData, NoteData
+
+ATTRIBUTES = [
+    (1, 'Raw_Read_Error_Rate'), (3, 'Spin_Up_Time'), (4, 'Start_Stop_Count'), (5, 'Reallocated_Sector_Ct'),
+    (7, 'Seek_Error_Rate'), (9, 'Power_On_Hours'), (10, 'Spin_Retry_Count'), (12, 'Power_Cycle_Count'),
+    (183, 'Runtime_Bad_Block'), (184, 'End-to-End_Error'), (187, 'Reported_Uncorrect'), (188, 'Command_Timeout'),
+    (189, 'High_Fly_Writes'), (190, 'Airflow_Temperature_Cel'), (191, 'G-Sense_Error_Rate'), (192, 'Power-Off_Retract_Count'),
+    (193, 'Load_Cycle_Count'), (194, 'Temperature_Celsius'), (195, 'Hardware_ECC_Recovered'), (197, 'Current_Pending_Sector'),
+    (198, 'Offline_Uncorrectable'), (199, 'UDMA_CRC_Error_Count'), (240, 'Head_Flying_Hours'), (241, 'Total_LBAs_Written'),
+    (242, 'Total_LBAs_Read'),
+]
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def task(i: int, name: str) -> TaskData:
+    notes = [NoteData(['task'], f"{name} finished with code 0", 'hddmond', now()) for _ in range(2)]
+    return TaskData(name, True, 42.5, f"{name} 42.5% (pass 1/1)", None, notes, now(), None)
+
+def drive(i: int) -> HddData:
+    attrs = [AttributeData(n, name, 0x32, 1000 + i * n, 10, 'Old_age', 'Always', 100, '-', 98) for n, name in ATTRIBUTES]
+    smart = SmartData(now(), attrs, 'SN04', 'sat', [], True, True, 'PASS', [('short', True), ('long', True), ('conveyance', False)])
+    queue = TaskQueueData(8, False, [task(i, 'Verify')], [task(i, 'Short test'), task(i, 'Erase')], task(i, 'Erase'))
+    return HddData(f"ZA{i:06d}", 'ST4000NM0035-1V4107', f"0x5000c500{i:08x}", 4000.787, None, 'PASS', queue, f"/dev/sd{i}",
+                   f"0:{i % 16}", smart, [], 3, 'local', {'ShortTest': 'Short test', 'EraseTask': 'Erase'})
+
+def bench(name: str, f, payload, rounds: int):
+    f(payload)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        out = f(payload)
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"  {name:<12} {elapsed * 1000:9.3f} ms  {len(out.encode()):>10} bytes")
+    return out
+
+def main():
+    drives = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    hdds = [drive(i) for i in range(drives)]
+    payloads = {
+        f"hdds reply, {drives} drives": {'hdds': hdds},
+        "task progress, 1 drive": {'update': 'taskprogress', 'data': {'serial': hdds[0].serial, 'taskqueue': hdds[0].task_queue}},
+    }
+    print(f"fast_json backend: {fast_json.BACKEND}")
+    for title, payload in payloads.items():
+        print(title)
+        reference = bench('jsonpickle', lambda p: jsonpickle.dumps(p, unpicklable=False, make_refs=False), payload, rounds)
+        fast = bench('fast_json', fast_json.dumps, payload, rounds)
+        if json.loads(reference) != json.loads(fast):
+            print("  The outputs differ!")
+
+if __name__ == '__main__':
+    main()